@@ -0,0 +1,245 @@
+'''
+Scattered-light background subtraction for NRES images, as done by
+backsub.pro.
+
+Pixels lying within the active orders are masked (set to NaN), the image
+is rebinned by a factor of 4 in each direction, a smooth background is
+estimated from the pixels that are left, and the background is expanded
+back to full size and subtracted.
+
+The background estimator is chosen with the estimator keyword, or the
+NRES_BACKSUB_ESTIMATOR environment variable:
+  'median'     an nwid x nwid median filter of the rebinned image, ignoring
+               NaNs.  This is what backsub.pro does, and the slowest.
+  'separable'  a running median of length nwid along x, then along y
+               (the default).
+  'block'      the median of each nwid x nwid block of the rebinned image,
+               interpolated linearly between block centers.
+  'spline'     the same block medians, interpolated with a bicubic spline.
+'''
+import os
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+estimators = ('median', 'separable', 'block', 'spline')
+default_estimator = os.getenv('NRES_BACKSUB_ESTIMATOR', 'separable')
+binning = 4
+
+
+def order_mask(shape, ovec, owid, objects):
+    '''
+    Return a boolean (ny,nx) array that is True for pixels lying within the
+    orders of illuminated fibers.  ovec(nx,nord,nfib) holds the order center
+    positions and owid the order width; objects holds the object name of
+    each fiber, and fibers named NONE or NULL are left out.  The band of
+    ceil(owid) rows starting at long(ovec-owid/2) is masked, as in
+    backsub.pro, but for all orders and fibers at once.
+    '''
+    ny, nx = shape
+    cowid = int(np.ceil(owid))
+    fibers = [j for j, obj in enumerate(objects[:ovec.shape[2]]) if obj.strip().upper() not in ('NONE', 'NULL')]
+    mask = np.zeros((ny, nx), dtype=bool)
+    if not fibers:
+        return mask
+    # truncate towards zero, as IDL long() does
+    ybot = np.trunc(ovec[:nx, :, fibers] - owid / 2.).astype(int)
+    rows = ybot[..., np.newaxis] + np.arange(cowid)
+    cols = np.broadcast_to(np.arange(nx)[:, np.newaxis, np.newaxis, np.newaxis], rows.shape)
+    legal = (rows >= 0) & (rows < ny)
+    mask[rows[legal], cols[legal]] = True
+    return mask
+
+
+def rebin(dat, factor=binning):
+    '''
+    Average dat(ny,nx) over factor x factor blocks.  As with IDL rebin, a
+    block containing a NaN becomes NaN.
+    '''
+    ny, nx = dat.shape
+    return dat.reshape(ny // factor, factor, nx // factor, factor).mean(axis=(1, 3))
+
+
+def _nanmedian(values, axis):
+    # Windows with no good pixels give NaN, which is dealt with by fill_bad
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(values, axis=axis)
+
+
+def _window_median(windows):
+    '''
+    Median over the last axis of windows, ignoring NaNs.  Sorting puts the
+    NaNs at the end of each window, so the median is found from the number
+    of good values, which is much quicker than np.nanmedian for many short
+    windows.
+    '''
+    ordered = np.sort(windows, axis=-1)
+    ngood = np.isfinite(ordered).sum(axis=-1)
+    lo = np.maximum(ngood - 1, 0)[..., np.newaxis] // 2
+    hi = ngood[..., np.newaxis] // 2
+    median = 0.5 * (np.take_along_axis(ordered, lo, -1) + np.take_along_axis(ordered, hi, -1))[..., 0]
+    return np.where(ngood > 0, median, np.nan)
+
+
+def _running_median(tc, nwid, axis):
+    '''
+    Running median of length nwid along one axis of tc, ignoring NaNs.  The
+    ends are padded by reflection.
+    '''
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (nwid // 2, nwid - 1 - nwid // 2)
+    windows = sliding_window_view(np.pad(tc, pad, mode='symmetric'), nwid, axis=axis)
+    return _window_median(windows)
+
+
+def median_filter(tc, nwid, chunk=64):
+    '''
+    nwid x nwid median filter of tc, ignoring NaNs, as IDL median(tc,nwid)
+    does.  The edges are padded by reflection, rather than with copies of
+    the edge strips as in backsub.pro.  Rows are done chunk at a time to
+    limit the memory used.
+    '''
+    lo = nwid // 2
+    hi = nwid - 1 - lo
+    windows = sliding_window_view(np.pad(tc, lo + hi, mode='symmetric'), (nwid, nwid))
+    windows = windows[hi:hi + tc.shape[0], hi:hi + tc.shape[1]]
+    tcf = np.empty(tc.shape, dtype=float)
+    for row in range(0, tc.shape[0], chunk):
+        block = windows[row:row + chunk]
+        tcf[row:row + chunk] = _window_median(block.reshape(block.shape[:2] + (-1,)))
+    return tcf
+
+
+def block_medians(tc, nwid):
+    '''
+    Median of each nwid x nwid block of tc, ignoring NaNs.  Returns the
+    (nby,nbx) block medians and the block centers along y and x, in pixels
+    of tc.  Blocks at the top and right edges may be smaller.
+    '''
+    ny, nx = tc.shape
+    nby = -(-ny // nwid)
+    nbx = -(-nx // nwid)
+    padded = np.full((nby * nwid, nbx * nwid), np.nan)
+    padded[:ny, :nx] = tc
+    grid = _window_median(padded.reshape(nby, nwid, nbx, nwid).transpose(0, 2, 1, 3).reshape(nby, nbx, -1))
+    ycen = (np.arange(nby) * nwid + np.minimum(np.arange(1, nby + 1) * nwid, ny) - 1) / 2.
+    xcen = (np.arange(nbx) * nwid + np.minimum(np.arange(1, nbx + 1) * nwid, nx) - 1) / 2.
+    return grid, ycen, xcen
+
+
+def interp_axis(values, centers, n, axis):
+    '''
+    Linearly interpolate values, sampled at increasing positions centers
+    along axis, onto pixels 0..n-1.  Pixels beyond the first and last
+    centers take the end values.
+    '''
+    values = np.moveaxis(values, axis, -1)
+    if len(centers) == 1:
+        return np.moveaxis(np.repeat(values, n, axis=-1), -1, axis)
+    pixels = np.arange(n)
+    i1 = np.clip(np.searchsorted(centers, pixels), 1, len(centers) - 1)
+    i0 = i1 - 1
+    weight = np.clip((pixels - centers[i0]) / (centers[i1] - centers[i0]), 0., 1.)
+    result = values[..., i0] * (1. - weight) + values[..., i1] * weight
+    return np.moveaxis(result, -1, axis)
+
+
+def expand(tcf, shape, factor=binning):
+    '''
+    Expand the rebinned tcf back to shape by linear interpolation between
+    the centers of the rebinned pixels.
+    '''
+    centers = np.arange(tcf.shape[0]) * factor + (factor - 1) / 2.
+    backg = interp_axis(tcf, centers, shape[0], 0)
+    centers = np.arange(tcf.shape[1]) * factor + (factor - 1) / 2.
+    return interp_axis(backg, centers, shape[1], 1)
+
+
+def spline_grid(grid, ycen, xcen, shape):
+    '''
+    Evaluate a bicubic spline through the block medians grid(nby,nbx), at
+    block centers ycen and xcen, on every pixel of shape.  Blocks with no
+    good pixels are given the median of the others first.
+    '''
+    from scipy.interpolate import RectBivariateSpline
+    good = np.isfinite(grid)
+    if not good.any():
+        return np.full(shape, np.nan)
+    grid = np.where(good, grid, np.median(grid[good]))
+    ky = min(3, len(ycen) - 1)
+    kx = min(3, len(xcen) - 1)
+    if ky < 1 or kx < 1:
+        # too few blocks for a spline
+        return interp_axis(interp_axis(grid, ycen, shape[0], 0), xcen, shape[1], 1)
+    spline = RectBivariateSpline(ycen, xcen, grid, ky=ky, kx=kx)
+    return spline(np.arange(shape[0]), np.arange(shape[1]))
+
+
+def fill_bad(backg, box=50):
+    '''
+    Set non-finite values of backg to the median of the box around them
+    (extended by box pixels on each side), or to 10 if that is no good
+    either.  Returns backg and the number of values that were filled in.
+    '''
+    bad = ~np.isfinite(backg)
+    nbad = int(bad.sum())
+    if nbad == 0:
+        return backg, nbad
+    sy, sx = np.nonzero(bad)
+    ny, nx = backg.shape
+    ybot = max(sy.min() - box, 0)
+    ytop = min(sy.max() + box, ny - 1)
+    xbot = max(sx.min() - box, 0)
+    xtop = min(sx.max() + box, nx - 1)
+    mbb = _nanmedian(backg[ybot:ytop + 1, xbot:xtop + 1], axis=None)
+    backg[bad] = mbb if np.isfinite(mbb) else 10.      # moves of desperation
+    return backg, nbad
+
+
+def background(dat, mask, nwid, estimator=None):
+    '''
+    Estimate the background of dat(ny,nx) from the pixels not in mask,
+    using the named estimator (see above).  Both dimensions of dat must be
+    divisible by 4.  Returns the background and the number of pixels where
+    it could not be estimated and was filled in (see fill_bad).
+    '''
+    estimator = default_estimator if estimator is None else estimator
+    if estimator not in estimators:
+        raise ValueError('Unknown background estimator {estimator}, expected one of {estimators}'.format(
+            estimator=estimator, estimators=', '.join(estimators)))
+    nwid = int(nwid)
+    tc = rebin(np.where(mask, np.nan, dat.astype(float)))
+    if estimator == 'median':
+        backg = expand(median_filter(tc, nwid), dat.shape)
+    elif estimator == 'separable':
+        backg = expand(_running_median(_running_median(tc, nwid, 1), nwid, 0), dat.shape)
+    else:
+        grid, ycen, xcen = block_medians(tc, nwid)
+        ycen = ycen * binning + (binning - 1) / 2.
+        xcen = xcen * binning + (binning - 1) / 2.
+        if estimator == 'block':
+            backg = interp_axis(interp_axis(grid, ycen, dat.shape[0], 0), xcen, dat.shape[1], 1)
+        else:
+            backg = spline_grid(grid, ycen, xcen, dat.shape)
+    return fill_bad(backg)
+
+
+def backsub(dat, ovec, owid, nfib, nwid, objects, estimator=None):
+    '''
+    This routine accepts the data array dat(ny,nx), the order centers
+    ovec(nx,nord,nfib), the order width owid, the number of fibers nfib,
+    the median box size nwid and the object names of the fibers.  It
+    estimates the scattered-light background from the pixels lying outside
+    the orders of illuminated fibers.  Returns dat with the background
+    subtracted, and the number of pixels where the background could not be
+    estimated and was filled in (see fill_bad), for the caller to report.
+    Raises RuntimeError if the result is not finite everywhere.
+    ***Note*** The dimensions of dat must both be divisible by 4!
+    '''
+    mask = order_mask(dat.shape, ovec[:, :, :nfib], owid, objects[:nfib])
+    backg, nfilled = background(dat, mask, nwid, estimator)
+    result = dat - backg
+    if not np.isfinite(result).all():
+        raise RuntimeError('Non-finite results in backsub')
+    return result, nfilled
@@ -0,0 +1,130 @@
+'''
+Least-recently-used cache of calibration FITS files (bias, dark, flat,
+trace, ...), shared by everything that runs in one worker process.
+The same few calibration files are used for every frame of a night,
+so after the first frame they no longer need to be read from disk.
+
+Entries are keyed by path, modification time and size, so a calibration
+file that is rewritten in place is read again.  The cache holds at most
+maxbytes of data arrays (NRES_CALIB_CACHE_MB, default 1024 MB); the least
+recently used files are dropped to stay under it.
+
+If shared_dir is set (NRES_CALIB_CACHE_SHARED_DIR, e.g. /dev/shm/nres_calib),
+the decoded data arrays are also written there as .npy files and memory
+mapped read-only.  Other worker processes that want the same file map the
+same pages instead of reading and decoding the FITS file themselves.
+
+The cached data arrays are read-only, because the same array is handed
+to every caller.  Make a copy (e.g. with .astype(float)) before changing it.
+'''
+import glob
+import hashlib
+import os
+import os.path
+from collections import OrderedDict
+import numpy as np
+from astropy.io import fits
+
+maxbytes = int(float(os.getenv('NRES_CALIB_CACHE_MB', 1024)) * 1024 * 1024)
+shared_dir = os.getenv('NRES_CALIB_CACHE_SHARED_DIR', '')
+cache = OrderedDict()
+nbytes = 0
+
+
+def _key(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _shared_filename(key):
+    path, mtime_ns, size = key
+    return os.path.join(shared_dir, '{name}-{mtime}-{size}'.format(name=hashlib.sha1(path.encode()).hexdigest(),
+                                                                   mtime=mtime_ns, size=size))
+
+
+def _read_shared(key):
+    '''
+    Map a copy of the file that another process already decoded, if there is one.
+    '''
+    shared_filename = _shared_filename(key)
+    if not os.path.exists(shared_filename + '.npy') or not os.path.exists(shared_filename + '.hdr'):
+        return None
+    data = np.load(shared_filename + '.npy', mmap_mode='r')
+    with open(shared_filename + '.hdr') as header_file:
+        header = fits.Header.fromstring(header_file.read())
+    return data, header
+
+
+def _write_shared(key, data, header):
+    '''
+    Save a decoded file for other processes and map it, removing copies of
+    older versions of the same file.
+    '''
+    os.makedirs(shared_dir, exist_ok=True)
+    shared_filename = _shared_filename(key)
+    for old_filename in glob.glob(shared_filename.rsplit('-', 2)[0] + '-*'):
+        if not old_filename.startswith(shared_filename):
+            try:
+                os.remove(old_filename)
+            except OSError:
+                pass
+    # Write under temporary names and rename, so other processes never map a partial file
+    temp_filename = '{filename}.{pid}'.format(filename=shared_filename, pid=os.getpid())
+    with open(temp_filename + '.hdr', 'w') as header_file:
+        header_file.write(header.tostring())
+    np.save(temp_filename + '.npy', data)
+    os.replace(temp_filename + '.hdr', shared_filename + '.hdr')
+    os.replace(temp_filename + '.npy', shared_filename + '.npy')
+    return np.load(shared_filename + '.npy', mmap_mode='r'), header
+
+
+def _evict():
+    global nbytes
+    # Always keep the newest entry, even if it is bigger than the ceiling on its own
+    while nbytes > maxbytes and len(cache) > 1:
+        _, (data, header) = cache.popitem(last=False)
+        nbytes -= data.nbytes
+
+
+def getdata(path):
+    '''
+    Return (data, header) of the primary HDU of a FITS file, reading it
+    only if it is not already cached.
+    '''
+    global nbytes
+    key = _key(path)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    entry = _read_shared(key) if shared_dir else None
+    if entry is None:
+        data, header = fits.getdata(path, header=True)
+        if shared_dir:
+            entry = _write_shared(key, data, header)
+        else:
+            data.flags.writeable = False
+            entry = (data, header)
+
+    # Forget older versions of the same file
+    for old_key in [old_key for old_key in cache if old_key[0] == key[0]]:
+        nbytes -= cache.pop(old_key)[0].nbytes
+    cache[key] = entry
+    nbytes += entry[0].nbytes
+    _evict()
+    return entry
+
+
+def preload(paths):
+    '''
+    Read a list of FITS files into the cache ahead of when they are needed.
+    '''
+    for path in paths:
+        getdata(path)
+
+
+def clear():
+    global nbytes
+    cache.clear()
+    nbytes = 0
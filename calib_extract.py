@@ -24,7 +24,79 @@ def calib_extract(flatk='flatk',dble='dble'):
     import get_specdat
     get_specdat.get_specdat()
 
-    print(nr.specdat['nord'])
+    nord=nr.specdat['nord']
+    nx=nr.specdat['nx']
 
-    #get specdat written, need to impliment here
-    #bunch of other .pro's to write for calib_extract
+    #locate suitable bias, dark, flat and trace data.  These come from the
+    #calibration cache, so they are read-only
+    import get_calib
+    get_calib.get_calib('BIAS',nr.cdat,nr.chdr)
+    get_calib.get_calib('DARK',nr.cdat,nr.chdr)
+    if not flatk:
+        get_calib.get_calib('FLAT',nr.cdat,nr.chdr)
+    get_calib.get_calib('TRACE',nr.cdat,nr.chdr)
+    tracprof=np.array(nr.tracedat,dtype=float)
+
+    #if either fiber0 or fiber2 profile data exist and are all zero, fill
+    #values in from the other one.
+    #tracprof is (1+nblock, nfib, nord, ncoef): the IDL array transposed
+    cnfib=tracprof.shape[1]
+    if cnfib == 3:
+        v0=np.abs(tracprof[1:,0]).max()
+        v2=np.abs(tracprof[1:,2]).max()
+        if (v0 == 0.) != (v2 == 0.):
+            if v0 == 0.:
+                tracprof[1:,0]=tracprof[1:,2]
+            else:
+                tracprof[1:,2]=tracprof[1:,0]
+
+    #debias
+    nr.cordat=nr.dat-nr.biasdat.astype(float)
+    #compute variance map (mk_variance)
+    nr.varmap=np.maximum(nr.cordat,0.)+nr.ccd['gain']**2*nr.ccd['rdnois']
+
+    ord_wid=nr.tracehdr['ORDWIDTH']  #width of band to be considered for extraction
+    medboxsz=nr.tracehdr['MEDBOXSZ']
+    npoly=nr.tracehdr['NPOLY']
+    cowid=nr.tracehdr['COWID']
+    nblock=nr.tracehdr['NBLOCK']
+    trace=tracprof[0,:,:,0:npoly]
+    prof=tracprof[1:nblock+1,:,:,0:cowid]
+
+    import extract
+    ord_vectors=extract.order_cen(trace,nx)
+    nr.tracedat={'trace':trace,'npoly':npoly,'ord_vectors':ord_vectors,'ord_wid':ord_wid,
+                 'medboxsz':medboxsz,'tracefile':nr.tracefile,'prof':prof}
+
+    #subtract dark
+    nr.exptime=nr.dathdr['EXPTIME']
+    nr.cordat=nr.cordat-nr.exptime*nr.darkdat
+
+    #trim overscan
+    nxu=nr.cordat.shape[1]
+    if nxu > nx:
+        nr.cordat=nr.cordat[:,0:nx]
+        nr.varmap=nr.varmap[:,0:nx]
+        print('Trimming nx from/to ', nxu, nx)
+
+    #remove background.  The estimator is set by NRES_BACKSUB_ESTIMATOR (see backsub.py)
+    objects=nr.dathdr['OBJECTS'].split('&')
+    import backsub
+    nr.cordat,nfilled=backsub.backsub(nr.cordat,ord_vectors,ord_wid,nr.specdat['nfib'],medboxsz,objects)
+    if nfilled > 0:
+        print('Background not found at ', nfilled, ' pixels, filled in by backsub')
+
+    #extract spectra.  prof goes in as (nblock, cowid, nord, nfib), as in extract.pro
+    echdat=extract.extract(nr.cordat,nr.varmap,ord_vectors,prof.transpose(0,3,2,1),ord_wid,objects,
+                           camera=nr.camera)
+    nr.echdat.update(echdat)
+    nr.echdat['nx']=nx
+    nr.echdat['nord']=nord
+
+    #flatfield.  apply_flat2 is not ported yet, so for now the extracted
+    #spectrum is passed on without flat fielding whether or not flatk is set
+    nr.corspec=echdat['spectrum']
+    nr.rmsspec=echdat['specrms']
+
+    #bunch of other .pro's to write for calib_extract: check_flat, mk_badlamwts,
+    #apply_flat2 and writing the spec, extr and blaz files
@@ -0,0 +1,145 @@
+import os.path
+import bisect
+import numpy as np
+import calib_cache
+import stds_db
+
+
+class CalibrationIndex(object):
+    '''
+    In-memory index of the good (first flag character '0') lines of
+    standards.csv, for choosing calibration files.
+
+    For every (type, site, camera) the julian dates are held in a sorted
+    array, so nearest-in-time and within-window queries are a bisection
+    rather than a scan of the whole table.  The index is loaded once per
+    worker (see get_index) and only reloaded when standards.csv changes.
+
+    Usage:
+    index = get_index(nr.nresroot + 'reduced/csv/standards.csv')
+    filename = index.find_calib('BIAS', nr.site, nr.camera, nr.jdc)
+    '''
+
+    def __init__(self, csv_file):
+        self.store = stds_db.get_store(csv_file)
+        self.version = None
+        self.groups = {}
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Rebuild the index if the standards table has changed.
+        '''
+        self.store.sync()
+        # The version is kept in the store's database, so lines added by other workers are seen too.
+        # Read it before the rows, so a change made in between is picked up next time.
+        version = self.store.version
+        if self.version == version:
+            return
+        groups = {}
+        for type, site, camera, jd, navg, filename in self.store.rows():
+            group = groups.setdefault((type, site, camera), ([], [], []))
+            group[0].append(jd)
+            group[1].append(navg)
+            group[2].append(filename)
+        # The rows come out of the store in time order, so the date arrays are already sorted.
+        # Keep a separate sorted array of the super-calibs (navg > 1) so they can be bisected too.
+        self.groups = {}
+        for key, (jds, navgs, filenames) in groups.items():
+            jds = np.array(jds)
+            navgs = np.array(navgs)
+            super_calibs = np.nonzero(navgs > 1)[0]
+            self.groups[key] = (jds, navgs, filenames, jds[super_calibs], super_calibs)
+        self.version = version
+
+    def _group(self, type, site, camera):
+        return self.groups.get((type.strip().upper(), site.strip().upper(), camera.strip().upper()))
+
+    @staticmethod
+    def _nearest(jds, jd):
+        # Only the neighbours either side of the insertion point can be the closest
+        i = bisect.bisect_left(jds, jd)
+        if i == 0:
+            return 0
+        if i == len(jds):
+            return len(jds) - 1
+        return i if jds[i] - jd < jd - jds[i - 1] else i - 1
+
+    def nearest(self, type, site, camera, jd, super_calib=False):
+        '''
+        Return (filename, jdate, navg) of the line nearest in time to jd, or
+        None if there are none.  If super_calib is True, only lines with
+        navg > 1 are considered.
+        '''
+        self.refresh()
+        group = self._group(type, site, camera)
+        if group is None:
+            return None
+        jds, navgs, filenames, super_jds, super_calibs = group
+        if super_calib:
+            if len(super_jds) == 0:
+                return None
+            i = super_calibs[self._nearest(super_jds, jd)]
+        else:
+            i = self._nearest(jds, jd)
+        return filenames[i], jds[i], navgs[i]
+
+    def window(self, type, site, camera, jd_min, jd_max):
+        '''
+        Return [(filename, jdate, navg), ...] for lines with
+        jd_min <= jdate <= jd_max, in time order.
+        '''
+        self.refresh()
+        group = self._group(type, site, camera)
+        if group is None:
+            return []
+        jds, navgs, filenames = group[:3]
+        start = bisect.bisect_left(jds, jd_min)
+        stop = bisect.bisect_right(jds, jd_max)
+        return [(filenames[i], jds[i], navgs[i]) for i in range(start, stop)]
+
+    def find_calib(self, type, site, camera, jd):
+        '''
+        The selection get_calib makes: find the line closest in time, then
+        prefer the closest line with navg > 1 (a super-calib) that is within
+        max(1.5 * that interval, that interval + 1.5 days).  Returns the
+        filename, relative to reduced/, or None if there are no lines of
+        this type.
+        '''
+        closest = self.nearest(type, site, camera, jd)
+        if closest is None:
+            return None
+        md = abs(closest[1] - jd)
+        dt = max(1.5 * md, md + 1.5)
+        super_calib = self.nearest(type, site, camera, jd, super_calib=True)
+        if super_calib is not None and abs(super_calib[1] - jd) < dt:
+            return super_calib[0]
+        return closest[0]
+
+    def preload(self, nresroot, site, camera, jd, types=('BIAS', 'DARK', 'FLAT', 'TRACE')):
+        '''
+        Choose the calibration files of each type for a frame and read them
+        into the shared calibration cache (see calib_cache).  Returns a
+        dictionary of the chosen paths keyed by type.
+        '''
+        paths = {}
+        for type in types:
+            filename = self.find_calib(type, site, camera, jd)
+            if filename is not None:
+                paths[type] = nresroot + 'reduced/' + filename
+        calib_cache.preload([path for path in paths.values() if os.path.exists(path)])
+        return paths
+
+
+indexes = {}
+
+
+def get_index(csv_file):
+    '''
+    Return the CalibrationIndex for a standards.csv file, loading it once
+    per process.
+    '''
+    key = (os.path.abspath(csv_file), os.getpid())
+    if key not in indexes:
+        indexes[key] = CalibrationIndex(csv_file)
+    return indexes[key]
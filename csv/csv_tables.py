@@ -0,0 +1,109 @@
+'''
+Typed, cached reading of the NRES csv tables (standards.csv, zeros.csv,
+targets.csv, rv.csv).
+
+Each table is described by a list of (field, type) pairs, one per
+column, with type str, int or float.  read_table parses a file into a
+numpy structured array with those fields and keeps it, keyed by path,
+size and modification time, so a table is only parsed again after it
+has been written.  The cached arrays are read-only, because every
+caller gets the same one; copy them before changing them.
+
+Numeric values that cannot be parsed (e.g. an empty field) become nan
+for float columns and 0 for int columns.  Lines with fewer values than
+the table has columns are skipped.
+'''
+import csv
+import os
+import os.path
+import numpy as np
+
+standards_columns = [('type', str), ('fname', str), ('navg', int), ('site', str), ('camera', str),
+                     ('jdate', float), ('flag', str)]
+
+zeros_columns = [('fname', str), ('navg', int), ('site', str), ('camera', str), ('jdate', float),
+                 ('targname', str), ('teff', float), ('logg', float), ('bmv', float), ('jmk', float),
+                 ('flag', str)]
+
+targets_columns = [('name', str), ('ra', float), ('dec', float), ('vmag', float), ('bmag', float),
+                   ('gmag', float), ('rmag', float), ('imag', float), ('jmag', float), ('kmag', float),
+                   ('pmra', float), ('pmdec', float), ('plax', float), ('rv', float), ('teff', float),
+                   ('logg', float), ('zero', str)]
+
+rv_columns = [('targname', str), ('crdate', float), ('bjd', float), ('site', str), ('exptime', float),
+              ('orgname', str), ('speco', str), ('nmatch', int), ('amoerr', float), ('rmsgood', float),
+              ('mgbdisp', float), ('rvkmps', float), ('ampcc', float), ('widcc', float), ('lammid', float),
+              ('baryshift', float), ('rroa', float), ('rrom', float), ('rroe', float)]
+
+tables = {}
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except ValueError:
+        return 0
+
+
+def _column(values, kind):
+    if kind is str:
+        # At least one character wide, so an empty table still has a string dtype
+        width = max([len(value) for value in values] + [1])
+        return np.array(values, dtype='U{width}'.format(width=width))
+    if kind is int:
+        return np.array([_to_int(value) for value in values], dtype=np.int64)
+    return np.array([_to_float(value) for value in values], dtype=np.float64)
+
+
+def parse_table(filename, columns):
+    '''
+    Read a csv table into (header, data), where header is the list of
+    column names on the first line and data is a structured array with
+    one field per entry of columns.
+    '''
+    with open(filename) as csvfile:
+        reader = csv.reader(csvfile, skipinitialspace=True)
+        header = next(reader, [])
+        rows = [row for row in reader if len(row) >= len(columns)]
+    values = [[row[i].strip() for row in rows] for i in range(len(columns))]
+    arrays = [_column(column_values, kind) for column_values, (field, kind) in zip(values, columns)]
+    data = np.empty(len(rows), dtype=[(field, array.dtype) for (field, kind), array in zip(columns, arrays)])
+    for (field, kind), array in zip(columns, arrays):
+        data[field] = array
+    return header, data
+
+
+def read_table(filename, columns):
+    '''
+    As parse_table, but only parse the file again if it has changed since
+    the last call.
+    '''
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (path, tuple(columns))
+    version = (stat.st_size, stat.st_mtime_ns)
+    if key in tables and tables[key][0] == version:
+        return tables[key][1]
+    header, data = parse_table(path, columns)
+    data.flags.writeable = False
+    tables[key] = (version, (header, data))
+    return header, data
+
+
+def read_columns(filename, columns):
+    '''
+    Read a csv table the way the *_rd routines return it: one array per
+    column, followed by the list of column names.  The table is parsed
+    once and cached until the file changes.  Numeric columns come back as
+    numpy float or int arrays, text columns as numpy string arrays; all
+    are read-only.
+    '''
+    header, data = read_table(filename, columns)
+    return tuple(data[field] for field, kind in columns) + (list(header),)
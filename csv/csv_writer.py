@@ -0,0 +1,204 @@
+'''
+Safe writing of the NRES csv tables (standards.csv, zeros.csv,
+targets.csv, rv.csv) by several pipeline processes at once.
+
+Every change to a table is made while holding an exclusive advisory
+lock (flock) on <table>.lock.  The lock is on a separate file because
+whole-table rewrites go to a temporary file that is renamed over the
+table, so a reader never sees a partly written table.
+
+New lines are appended to the end of the table, which serves as a
+journal: appending is cheap however long the table is.  The tables are
+kept sorted on one column (time, or RA for targets.csv).  As long as
+new lines sort after the existing ones the table stays sorted.  Lines
+that do not are left at the end until compact() sorts the table, which
+happens once compact_every of them have built up (NRES_CSV_COMPACT_EVERY,
+default 50), or when an *_addline routine is called with no arguments.
+
+What we know about the end of the table (its size and modification
+time, its last sort key and how many lines are out of order) is kept in
+<table>.journal.  If the table was changed by something else (e.g. the
+IDL pipeline, which does not take the lock), the next append compacts it.
+
+standards.csv is added to through stds_db, which takes the same lock
+but keeps the file sorted itself.
+
+Existing lines are copied through unchanged, so values keep the
+formatting (and quoting) they were written with.
+'''
+import csv
+import fcntl
+import io
+import json
+import os
+import os.path
+from contextlib import contextmanager
+import numpy as np
+
+compact_every = int(os.getenv('NRES_CSV_COMPACT_EVERY', 50))
+
+
+@contextmanager
+def locked(csv_file):
+    '''
+    Hold the exclusive write lock for a csv table.
+    '''
+    with open(csv_file + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def format_row(values):
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerow([str(value) for value in values])
+    return output.getvalue()
+
+
+def parse_line(line):
+    return next(csv.reader([line], skipinitialspace=True), [])
+
+
+def sort_key(line, key_column):
+    '''
+    Numeric sort key of a line.  Lines without a number in key_column sort last.
+    '''
+    values = parse_line(line)
+    try:
+        key = float(values[key_column])
+    except (IndexError, ValueError):
+        return (1, 0.0)
+    if np.isnan(key):
+        return (1, 0.0)
+    return (0, key)
+
+
+def read_lines(csv_file):
+    '''
+    Return the header line and the data lines of a csv table, each with a
+    trailing newline.
+    '''
+    with open(csv_file) as infile:
+        lines = [line if line.endswith('\n') else line + '\n' for line in infile if line.strip()]
+    if not lines:
+        return '', []
+    return lines[0], lines[1:]
+
+
+def write_lines(csv_file, header, lines):
+    '''
+    Replace a csv table with an atomic rename.  The caller must hold the lock.
+    '''
+    temp_file = '{filename}.{pid}.tmp'.format(filename=csv_file, pid=os.getpid())
+    with open(temp_file, 'w') as outfile:
+        outfile.write(header)
+        outfile.writelines(lines)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_file, csv_file)
+
+
+def _stat(csv_file):
+    stat = os.stat(csv_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_journal(csv_file):
+    try:
+        with open(csv_file + '.journal') as journal_file:
+            journal = json.load(journal_file)
+    except (OSError, ValueError):
+        return None
+    # Only trust the journal if nobody else has changed the table since we wrote it
+    if not os.path.exists(csv_file) or journal.get('stat') != _stat(csv_file):
+        return None
+    return journal
+
+
+def _write_journal(csv_file, last_key, unsorted):
+    journal = {'stat': _stat(csv_file), 'last_key': last_key, 'unsorted': unsorted}
+    temp_file = '{filename}.journal.{pid}.tmp'.format(filename=csv_file, pid=os.getpid())
+    with open(temp_file, 'w') as journal_file:
+        json.dump(journal, journal_file)
+    os.replace(temp_file, csv_file + '.journal')
+
+
+def _compact(csv_file, key_column):
+    header, lines = read_lines(csv_file)
+    # A stable sort, so lines with equal keys stay in the order they were added
+    lines.sort(key=lambda line: sort_key(line, key_column))
+    write_lines(csv_file, header, lines)
+    last_key = list(sort_key(lines[-1], key_column)) if lines else None
+    _write_journal(csv_file, last_key, 0)
+
+
+def compact(csv_file, key_column):
+    '''
+    Sort a csv table on the values in column key_column and rewrite it.
+    '''
+    with locked(csv_file):
+        _compact(csv_file, key_column)
+
+
+def append_rows(csv_file, header, rows, key_column):
+    '''
+    Add lines to a csv table, creating it with the given header if it does
+    not exist.  The table is compacted if too many lines are out of order
+    (see compact_every).
+    '''
+    new_lines = [format_row(row) for row in rows]
+    with locked(csv_file):
+        if not os.path.exists(csv_file):
+            write_lines(csv_file, format_row(header), [])
+            _write_journal(csv_file, None, 0)
+        journal = _read_journal(csv_file)
+        with open(csv_file, 'rb') as infile:
+            # Don't run the first new line onto the end of an unterminated last line
+            terminated = infile.seek(0, os.SEEK_END) == 0
+            if not terminated:
+                infile.seek(-1, os.SEEK_END)
+                terminated = infile.read(1) == b'\n'
+        with open(csv_file, 'a') as outfile:
+            if not terminated:
+                outfile.write('\n')
+            outfile.writelines(new_lines)
+        if journal is None:
+            _compact(csv_file, key_column)
+            return
+        last_key = journal['last_key']
+        unsorted = journal['unsorted']
+        for line in new_lines:
+            key = list(sort_key(line, key_column))
+            if unsorted == 0 and (last_key is None or key >= last_key):
+                last_key = key
+            else:
+                unsorted += 1
+        if unsorted >= compact_every:
+            _compact(csv_file, key_column)
+        else:
+            _write_journal(csv_file, last_key, unsorted)
+
+
+def rewrite(csv_file, header, rows):
+    '''
+    Replace the contents of a csv table.
+    '''
+    with locked(csv_file):
+        write_lines(csv_file, format_row(header), [format_row(row) for row in rows])
+        if os.path.exists(csv_file + '.journal'):
+            os.remove(csv_file + '.journal')
+
+
+def remove_rows(csv_file, column, values):
+    '''
+    Delete the lines of a csv table whose value in column is one of values.
+    '''
+    values = set(str(value).strip() for value in values)
+    with locked(csv_file):
+        header, lines = read_lines(csv_file)
+        lines = [line for line in lines if (parse_line(line) + [''] * (column + 1))[column].strip() not in values]
+        write_lines(csv_file, header, lines)
+        if os.path.exists(csv_file + '.journal'):
+            os.remove(csv_file + '.journal')
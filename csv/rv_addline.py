@@ -1,13 +1,13 @@
 import numpy as np
 import os.path
-import csv
-import pandas as pd
+import csv_writer
+
 
 def rv_addline(targnames="",crdates="",bjds="",sites="",exptimes="",orgnames="",specos="",nmatchs="", amoerrs="",rmsgoods="",mgbdisps="",rvkmpss="",ampccs="",widccs="",lammids="",baryshifts="", rroas="",rroms="",rroes=""):
     '''
-    Reads the rv.csv file, appends a line containing the data in the
-    argument list, sorts the resulting list into increasing time order,
-    and writes the result back out to rv.csv.
+    Appends a line containing the data in the argument list to the
+    rv.csv file, keeping it in increasing time order (see csv_writer:
+    out-of-order lines are appended and sorted in later, in batches).
     Calling this routine with no arguments causes the standards.csv file
     to be sorted into time order, without otherwise changing it.
 
@@ -19,18 +19,12 @@ def rv_addline(targnames="",crdates="",bjds="",sites="",exptimes="",orgnames="",
     nresroot=os.getenv("NRESROOT")
     rvfile=nresroot+'reduced/csv/rv.csv'
 
+    #column the file is sorted on, and the header for a new file
+    keycol=1
+    hdrs=['Targname','CrDate','BJD','Site','Exptime','Orgname','Specfile','Nmatch','Amoerr','RMSgood','Mgbdisp','RVkm/s','AmpCC','WidCC','Lammid','Baryshift','Rshiftavg','RshiftMed','RshiftErr']
+
     if len(targnames)>0:
         dat=np.column_stack((targnames,crdates,bjds,sites,exptimes,orgnames,specos,nmatchs, amoerrs,rmsgoods,mgbdisps,rvkmpss,ampccs,widccs,lammids,baryshifts, rroas,rroms,rroes))
-        outfile = open(rvfile,"a")
-
-        # get a csv writer
-        writer = csv.writer( outfile )
-        [ writer.writerow(x) for x in dat ]
-
-        # close file
-        outfile.close()
-
-
-    df = pd.read_csv(rvfile)
-    df = df.sort_values('CrDate')
-    df.to_csv(rvfile,index=False)
\ No newline at end of file
+        csv_writer.append_rows(rvfile,hdrs,dat,keycol)
+    else:
+        csv_writer.compact(rvfile,keycol)
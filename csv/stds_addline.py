@@ -1,35 +1,28 @@
 import numpy as np
 import os.path
-import csv
-import pandas as pd
 import nres_comm as nr
+import stds_db
 
 def stds_addline(types="",fnames="",navgs="",sites="",cameras="",jdates="",flags=""):
 
     '''
-    Reads the standards.csv file, appends a line containing the data in the
-    argument list, sorts the resulting list into increasing time order,
-    and writes the result back out to standards.csv.
+    Appends a line containing the data in the argument list to the
+    standards.csv file, keeping the file in increasing time order.
     Calling this routine with no arguments causes the standards.csv file
     to be sorted into time order, without otherwise changing it.
 
+    The lines are kept in an indexed copy of the table (see stds_db), so
+    adding a line does not reread the whole file.  standards.csv is only
+    rewritten if the new line is earlier than the last line in the file.
+
     '''
 
     nr.nresroot=os.getenv("NRESROOT")
     stdfile=nr.nresroot+'reduced/csv/standards.csv'
+    store = stds_db.get_store(stdfile)
 
     if len(fnames)>0:
         dat=np.column_stack((types,fnames,navgs,sites,cameras,jdates,flags))
-        outfile = open(stdfile,"a")
-
-        # get a csv writer
-        writer = csv.writer( outfile )
-        [ writer.writerow(x) for x in dat ]
-
-        # close file
-        outfile.close()
-
-
-    df = pd.read_csv(stdfile)
-    df = df.sort_values('JDdata')
-    df.to_csv(stdfile,index=False)
\ No newline at end of file
+        store.add(dat)
+    else:
+        store.export_csv()
@@ -0,0 +1,284 @@
+import csv
+import os
+import os.path
+import sqlite3
+import csv_writer
+
+# Column names written by stds_write
+stdhdr = ['Type', 'Filename', 'Navg', 'Site', 'Camera', 'JDdata', 'Flags']
+
+
+def _quote(value):
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def format_row(row):
+    '''
+    Format a (type, filename, navg, site, camera, jdate, flags) line the
+    way IDL write_csv does in stds_write.pro: strings quoted, navg as an
+    integer and jdate with 15 decimals.  Values that are not numbers are
+    written as quoted strings.
+    '''
+    type, fname, navg, site, camera, jdate, flag = row[:7]
+    try:
+        navg = str(int(float(navg))) if float(navg).is_integer() else _quote(navg)
+    except ValueError:
+        navg = _quote(navg)
+    try:
+        jdate = '%.15f' % float(jdate)
+    except ValueError:
+        jdate = _quote(jdate)
+    return ','.join([_quote(type), _quote(fname), navg, _quote(site), _quote(camera), jdate, _quote(flag)]) + '\n'
+
+
+def format_header():
+    return ','.join(_quote(name) for name in stdhdr) + '\n'
+
+
+class StandardsStore(object):
+    '''
+    Indexed copy of the NRES standards.csv file, kept in an SQLite database
+    next to it (standards.sqlite).
+
+    standards.csv stays the file of record, because the IDL pipeline reads
+    and writes it directly.  Whenever the csv file changes behind our back
+    (its size or modification time differ from the last time we synced),
+    the database is rebuilt from it.  Rows added through add() go into the
+    database with an O(log n) indexed insert, and are appended to the csv
+    file if they keep it in time order.  Only an out-of-order row makes us
+    rewrite the csv file, sorted by JDdata, the way stds_addline always did.
+    Lines are written in the format of stds_write.pro (see format_row).
+
+    Lookups use the index on (type, site, camera, flag, jd), so finding the
+    standard nearest in time does not slow down as the table grows.  As in
+    get_calib.pro, type, site and camera are compared after stripping and
+    upper-casing, and only the first character of Flags is used.
+
+    Usage:
+    store = StandardsStore(nr.nresroot + 'reduced/csv/standards.csv')
+    store.add([('BIAS', 'bias/BIAS....fits', 1, 'lsc', 'fa09', 2458200.5, '0000')])
+    row = store.nearest('BIAS', 'lsc', 'fa09', 2458201.0)
+    '''
+
+    def __init__(self, csv_file, db_file=None):
+        self.csv_file = csv_file
+        if db_file is None:
+            db_file = os.path.join(os.path.dirname(csv_file), 'standards.sqlite')
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS standards ('
+                                'type TEXT, filename TEXT, navg TEXT, site TEXT, camera TEXT, jdate TEXT, '
+                                'flags TEXT, type_key TEXT, site_key TEXT, camera_key TEXT, flag_key TEXT, '
+                                'navg_value REAL, jd REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS standards_lookup ON '
+                                'standards (type_key, site_key, camera_key, flag_key, jd)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS standards_jd ON standards (jd)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sync (header TEXT, csv_size INTEGER, '
+                                'csv_mtime_ns INTEGER)')
+        # Change counter, shared by every process using this database (see version)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS generation (counter INTEGER)')
+        if self.connection.execute('SELECT COUNT(*) FROM generation').fetchone()[0] == 0:
+            self.connection.execute('INSERT INTO generation VALUES (0)')
+        self.connection.commit()
+        self.sync()
+
+    def close(self):
+        self.connection.close()
+
+    def _csv_stat(self):
+        if not os.path.exists(self.csv_file):
+            return None, None
+        stat = os.stat(self.csv_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _record_sync(self, header):
+        size, mtime_ns = self._csv_stat()
+        self.connection.execute('DELETE FROM sync')
+        self.connection.execute('INSERT INTO sync VALUES (?, ?, ?)', (header, size, mtime_ns))
+
+    def _bump_version(self):
+        # Part of the same transaction as the change itself
+        self.connection.execute('UPDATE generation SET counter = counter + 1')
+
+    @property
+    def version(self):
+        '''
+        A counter that goes up whenever the table changes, whichever process
+        changed it, so that copies of the table (see calib_index) know to
+        reload.  Call sync() first to pick up changes made to the csv file.
+        '''
+        return self.connection.execute('SELECT counter FROM generation').fetchone()[0]
+
+    def _header(self):
+        row = self.connection.execute('SELECT header FROM sync').fetchone()
+        if row is None or row[0] is None:
+            return format_header().rstrip('\n')
+        return row[0]
+
+    def sync(self):
+        '''
+        Reload the database from standards.csv if the csv file has changed
+        since we last wrote or read it.
+        '''
+        recorded = self.connection.execute('SELECT csv_size, csv_mtime_ns FROM sync').fetchone()
+        if recorded is not None and tuple(recorded) == self._csv_stat():
+            return
+        header = None
+        rows = []
+        if os.path.exists(self.csv_file):
+            with open(self.csv_file) as csvfile:
+                header = csvfile.readline().rstrip('\r\n')
+                rows = [row for row in csv.reader(csvfile) if len(row) >= 7]
+        self.connection.execute('DELETE FROM standards')
+        self.connection.executemany('INSERT INTO standards VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                                    [self._db_row(row) for row in rows])
+        self._record_sync(header)
+        self._bump_version()
+        self.connection.commit()
+
+    @staticmethod
+    def _db_row(row):
+        type, fname, navg, site, camera, jdate, flag = [str(value) for value in row[:7]]
+        try:
+            navg_value = float(navg)
+        except ValueError:
+            navg_value = 0.0
+        try:
+            jd = float(jdate)
+        except ValueError:
+            jd = 0.0
+        return (type, fname, navg, site, camera, jdate, flag, type.strip().upper(), site.strip().upper(),
+                camera.strip().upper(), flag.strip()[:1], navg_value, jd)
+
+    def add(self, rows):
+        '''
+        Add lines to the table, each a sequence of
+        (type, filename, navg, site, camera, jdate, flags).
+        '''
+        db_rows = [self._db_row(row) for row in rows]
+        if not db_rows:
+            return
+        # Hold the csv write lock, so lines added by other processes at the same time are not lost
+        with csv_writer.locked(self.csv_file):
+            self.sync()
+            self._add(db_rows)
+
+    def _add(self, db_rows):
+        latest = self.connection.execute('SELECT MAX(jd) FROM standards').fetchone()[0]
+        self.connection.executemany('INSERT INTO standards VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', db_rows)
+        self._bump_version()
+        new_jds = [db_row[-1] for db_row in db_rows]
+        in_order = all(later >= earlier for earlier, later in zip(new_jds[:-1], new_jds[1:]))
+        if os.path.exists(self.csv_file) and in_order and (latest is None or new_jds[0] >= latest):
+            with open(self.csv_file, 'rb') as infile:
+                # Don't run the first new line onto the end of an unterminated last line
+                terminated = True
+                if infile.seek(0, os.SEEK_END) > 0:
+                    infile.seek(-1, os.SEEK_END)
+                    terminated = infile.read(1) == b'\n'
+            with open(self.csv_file, 'a') as outfile:
+                if not terminated:
+                    outfile.write('\n')
+                outfile.writelines(format_row(db_row) for db_row in db_rows)
+            self._record_sync(self._header())
+            self.connection.commit()
+        else:
+            self.connection.commit()
+            self._export_csv(self.csv_file)
+
+    def export_csv(self, csv_file=None):
+        '''
+        Write the table out in standards.csv format, sorted by JDdata.
+        Defaults to overwriting standards.csv.
+        '''
+        if csv_file is None:
+            csv_file = self.csv_file
+        with csv_writer.locked(csv_file):
+            self.sync()
+            self._export_csv(csv_file)
+
+    def _export_csv(self, csv_file):
+        lines = [format_row(row) for row in
+                 self.connection.execute('SELECT type, filename, navg, site, camera, jdate, flags '
+                                         'FROM standards ORDER BY jd, rowid')]
+        csv_writer.write_lines(csv_file, format_header(), lines)
+        if csv_file == self.csv_file:
+            self._record_sync(format_header().rstrip('\n'))
+            self.connection.commit()
+
+    def rows(self, flag='0'):
+        '''
+        Return (type_key, site_key, camera_key, jd, navg, filename) for every
+        line with the given first flag character, in time order.
+        '''
+        self.sync()
+        return self.connection.execute('SELECT type_key, site_key, camera_key, jd, navg_value, filename '
+                                       'FROM standards WHERE flag_key = ? ORDER BY jd, rowid', [flag]).fetchall()
+
+    def _where(self, type, site, camera, flag):
+        return ('type_key = ? AND site_key = ? AND camera_key = ? AND flag_key = ?',
+                [type.strip().upper(), site.strip().upper(), camera.strip().upper(), flag])
+
+    def nearest(self, type, site, camera, jd, flag='0', min_navg=None):
+        '''
+        Return the (type, filename, navg, site, camera, jdate, flags, jd) line
+        nearest in time to jd, or None if there are none.  If min_navg is
+        given, only lines with navg > min_navg are considered.
+        '''
+        self.sync()
+        where, values = self._where(type, site, camera, flag)
+        if min_navg is not None:
+            where += ' AND navg_value > ?'
+            values.append(min_navg)
+        columns = 'type, filename, navg, site, camera, jdate, flags, jd'
+        before = self.connection.execute('SELECT {columns} FROM standards WHERE {where} AND jd <= ? '
+                                         'ORDER BY jd DESC LIMIT 1'.format(columns=columns, where=where),
+                                         values + [jd]).fetchone()
+        after = self.connection.execute('SELECT {columns} FROM standards WHERE {where} AND jd > ? '
+                                        'ORDER BY jd ASC LIMIT 1'.format(columns=columns, where=where),
+                                        values + [jd]).fetchone()
+        candidates = [row for row in [before, after] if row is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda row: abs(row[-1] - jd))
+
+    def window(self, type, site, camera, jd_min, jd_max, flag='0'):
+        '''
+        Return all lines with jd_min <= JDdata <= jd_max, in time order.
+        '''
+        self.sync()
+        where, values = self._where(type, site, camera, flag)
+        query = ('SELECT type, filename, navg, site, camera, jdate, flags FROM standards '
+                 'WHERE {where} AND jd >= ? AND jd <= ? ORDER BY jd'.format(where=where))
+        return self.connection.execute(query, values + [jd_min, jd_max]).fetchall()
+
+    def find_calib(self, type, site, camera, jd):
+        '''
+        The selection get_calib makes: find the line closest in time, then
+        prefer the closest line with navg > 1 (a super-calib) that is within
+        max(1.5 * that interval, that interval + 1.5 days).  Returns None if
+        there are no lines of this type.
+        '''
+        closest = self.nearest(type, site, camera, jd)
+        if closest is None:
+            return None
+        md = abs(closest[-1] - jd)
+        dt = max(1.5 * md, md + 1.5)
+        super_calib = self.nearest(type, site, camera, jd, min_navg=1)
+        if super_calib is not None and abs(super_calib[-1] - jd) < dt:
+            return super_calib[:7]
+        return closest[:7]
+
+
+stores = {}
+
+
+def get_store(csv_file):
+    '''
+    Return the StandardsStore for a standards.csv file, opening it once per
+    process.
+    '''
+    key = (os.path.abspath(csv_file), os.getpid())
+    if key not in stores:
+        stores[key] = StandardsStore(csv_file)
+    return stores[key]
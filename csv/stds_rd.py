@@ -1,13 +1,5 @@
 import os.path
-import csv
-
-types = []
-fnames = []
-navgs = []
-sites = []
-cameras = []
-jdates = []
-flags = []
+import csv_tables
 
 
 def stds_rd():
@@ -29,29 +21,5 @@ def stds_rd():
     """
     nresroot = os.getenv("NRESROOT")
     stdfile = nresroot + 'reduced/csv/standards.csv'
-    struc = open(stdfile, "rb")
-    stdhdr = csv.reader(struc).next()
-
-    with open(stdfile) as csvfile:
-        readCSV = csv.reader(csvfile, delimiter=',')
-        # Skips Header Row
-        next(readCSV, None)
-
-        for row in readCSV:
-            type = row[0]
-            fname = row[1]
-            navg = row[2]
-            site = row[3]
-            camera = row[4]
-            jdate = row[5]
-            flag = row[6]
-
-            types.append(type)
-            fnames.append(fname)
-            navgs.append(navg)
-            sites.append(site)
-            cameras.append(camera)
-            jdates.append(jdate)
-            flags.append(flag)
-
-        return types, fnames, navgs, sites, cameras, jdates, flags, stdhdr
+
+    return csv_tables.read_columns(stdfile, csv_tables.standards_columns)
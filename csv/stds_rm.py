@@ -1,4 +1,6 @@
 import os.path
+import csv_writer
+
 
 def stds_rm(indx):
 
@@ -13,18 +15,8 @@ def stds_rm(indx):
     os.environ["NRESROOT"] = "/Users/rolfsmei/Documents/research/nres_4/nres_copy4/"
 
     """
-
-    import pandas as pd
-
     nresroot=os.getenv("NRESROOT")
-
     stdsfile = nresroot+'reduced/csv/standards.csv'
 
-    #Read in stdsfilefile
-    df = pd.read_csv(stdsfile)
-
-    #Dropping Filenames matching lines in indx
-    df_out = df[~df['Filename'].isin(indx)]
-
-    #Writing out file
-    df_out.to_csv(stdsfile,index=False)
\ No newline at end of file
+    #Dropping lines whose Filename (column 1) matches indx, holding the write lock
+    csv_writer.remove_rows(stdsfile,1,indx)
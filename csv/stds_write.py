@@ -1,6 +1,6 @@
 import numpy as np
 import os.path
-import csv
+import csv_writer
 
 
 def stds_write(types,fnames,navgs,sites,cameras,jdates,flags):
@@ -24,20 +24,5 @@ def stds_write(types,fnames,navgs,sites,cameras,jdates,flags):
     #set headers
     hdrs=['Type','Filename','Navg','Site','Camera','JDdata','Flags']
 
-    # open output file
-    outfile = open(stdsfile,"wb")
-
-    # get a csv writer
-    writer = csv.writer( outfile )
-
-    # write header
-    writer.writerow(hdrs)
-
-    # write data
-    [ writer.writerow(x) for x in dat ]
-
-    # close file
-    outfile.close()
-
-
-
+    # write header and data to a temporary file and rename it over the old one, holding the write lock
+    csv_writer.rewrite(stdsfile,hdrs,dat)
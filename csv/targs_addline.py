@@ -1,13 +1,13 @@
 import numpy as np
 import os.path
-import csv
-import pandas as pd
+import csv_writer
+
 
 def targs_addline(name="",ra="",dec="",vmag="",bmag="",gmag="",rmag="",imag="",jmag="",kmag="",pmra="",pmdec="",plax="",rv="",teff="",logg="",zero=""):
     '''
-    Reads the targets.csv file, appends a line containing the data in the
-    argument list, sorts the resulting list into increasing RA order,
-    and writes the result back out to targets.csv.
+    Appends a line containing the data in the argument list to the
+    targets.csv file, keeping it in increasing RA order (see csv_writer:
+    out-of-order lines are appended and sorted in later, in batches).
     Calling this routine with no arguments causes the targets.csv file
     to be sorted into RA order, without otherwise changing it.
 
@@ -19,18 +19,12 @@ def targs_addline(name="",ra="",dec="",vmag="",bmag="",gmag="",rmag="",imag="",j
     nresroot=os.getenv("NRESROOT")
     targfile=nresroot+'reduced/csv/targets.csv'
 
+    #column the file is sorted on, and the header for a new file
+    keycol=1
+    hdrs=['Name','RA(deg)','Dec(deg)','Vmag','Bmag','gmag','rmag','imag','Jmag','Kmag','PMRA','PMDE','Plax','RV','Teff','Logg','ZERO']
+
     if len(name)>0:
         dat=np.column_stack((name,ra,dec,vmag,bmag,gmag,rmag,imag,jmag,kmag,pmra,pmdec,plax,rv,teff,logg,zero))
-        outfile = open(targfile,"a")
-
-        # get a csv writer
-        writer = csv.writer( outfile )
-        [ writer.writerow(x) for x in dat ]
-
-        # close file
-        outfile.close()
-
-
-    df = pd.read_csv(targfile)
-    df = df.sort_values('RA')
-    df.to_csv(targfile,index=False)
\ No newline at end of file
+        csv_writer.append_rows(targfile,hdrs,dat,keycol)
+    else:
+        csv_writer.compact(targfile,keycol)
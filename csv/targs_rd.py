@@ -1,24 +1,5 @@
 import os.path
-import csv
-
-
-names = []
-ras = []
-decs = []
-vmags = []
-bmags = []
-gmags = []
-rmags = []
-imags = []
-jmags = []
-kmags = []
-pmras = []
-pmdecs = []
-plaxs = []
-rvs = []
-teffs = []
-loggs = []
-zeros = []
+import csv_tables
 
 
 def targs_rd():
@@ -41,51 +22,5 @@ def targs_rd():
     """
     nresroot = os.getenv("NRESROOT")
     targfile = nresroot + 'reduced/csv/targets.csv'
-    struc = open(targfile, "rb")
-    targhdr = csv.reader(struc).next()
-
-    with open(targfile) as csvfile:
-        readCSV = csv.reader(csvfile, delimiter=',')
-        # Skips Header Row
-        next(readCSV, None)
-
-        for row in readCSV:
-            name = row[0]
-            ra = row[1]
-            dec = row[2]
-            vmag = row[3]
-            bmag = row[4]
-            gmag = row[5]
-            rmag = row[6]
-            imag = row[7]
-            jmag = row[8]
-            kmag = row[9]
-            pmra = row[10]
-            pmdec = row[11]
-            plax = row[12]
-            rv = row[13]
-            teff = row[14]
-            logg = row[15]
-            zero = row[16]
-
-            names.append(name)
-            ras.append(ra)
-            decs.append(dec)
-            vmags.append(vmag)
-            bmags.append(bmag)
-            gmags.append(gmag)
-            rmags.append(rmag)
-            imags.append(imag)
-            jmags.append(jmag)
-            kmags.append(kmag)
-            pmras.append(pmra)
-            pmdecs.append(pmdec)
-            plaxs.append(plax)
-            rvs.append(rv)
-            teffs.append(teff)
-            loggs.append(logg)
-            zeros.append(zero)
-
-        return names, ras, decs, vmags, bmags, gmags, rmags, imags, jmags, kmags, pmras, pmdecs, plaxs, rvs, teffs, loggs, zeros, targhdr
-
 
+    return csv_tables.read_columns(targfile, csv_tables.targets_columns)
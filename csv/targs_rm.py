@@ -1,4 +1,6 @@
 import os.path
+import csv_writer
+
 
 def targs_rm(indx):
 
@@ -12,18 +14,8 @@ def targs_rm(indx):
     os.environ["NRESROOT"] = "/Users/rolfsmei/Documents/research/nres_4/nres_copy4/"
 
     """
-
-    import pandas as pd
-
     nresroot=os.getenv("NRESROOT")
-
     targfile = nresroot+'reduced/csv/targets.csv'
 
-    #Read in targfile
-    df = pd.read_csv(targfile)
-
-    #Dropping Filenames matching lines in indx
-    df_out = df[~df['Targname'].isin(indx)]
-
-    #Writing out file
-    df_out.to_csv(targfile,index=False)
\ No newline at end of file
+    #Dropping lines whose Name (column 0) matches indx, holding the write lock
+    csv_writer.remove_rows(targfile,0,indx)
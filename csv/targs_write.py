@@ -1,6 +1,6 @@
 import numpy as np
 import os.path
-import csv
+import csv_writer
 
 
 def targs_write(names,ras,decs,vmags,bmags,gmags,rmags,imags,jmags,kmags,pmras,pmdecs,plaxs,rvs,teffs,logg,zeros):
@@ -19,25 +19,10 @@ def targs_write(names,ras,decs,vmags,bmags,gmags,rmags,imags,jmags,kmags,pmras,p
     dat=np.column_stack((names,ras,decs,vmags,bmags,gmags,rmags,imags,jmags,kmags,pmras,pmdecs,plaxs,rvs,teffs,logg,zeros))
 
     #set savefile path
-    targfile = nresroot+'reduced/csv/targets.csv'
+    targfile=nresroot+'reduced/csv/targets.csv'
 
     #set headers
     hdrs=['Targname','RA','Dec','Vmag','Bmag','gmag','rmag','imag','Jmag','Kmag','PMRA','PMDE','Plax','RV','Teff','Logg','ZERO']
 
-    # open output file
-    outfile = open(targfile,"wb")
-
-    # get a csv writer
-    writer = csv.writer( outfile )
-
-    # write header
-    writer.writerow(hdrs)
-
-    # write data
-    [ writer.writerow(x) for x in dat ]
-
-    # close file
-    outfile.close()
-
-
-
+    # write header and data to a temporary file and rename it over the old one, holding the write lock
+    csv_writer.rewrite(targfile,hdrs,dat)
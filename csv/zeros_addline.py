@@ -1,14 +1,14 @@
 import numpy as np
 import os.path
-import csv
-import pandas as pd
+import csv_writer
+
 
 def zeros_addline(fnames="",navgs="",sites="",cameras="",jdates="",targnames="",teffs="",loggs="",bmvs="",jmks="",flags=""):
 
     '''
-    Reads the zeros.csv file, appends a line containing the data in the
-    argument list, sorts the resulting list into increasing time order,
-    and writes the result back out to zeros.csv.
+    Appends a line containing the data in the argument list to the
+    zeros.csv file, keeping it in increasing time order (see csv_writer:
+    out-of-order lines are appended and sorted in later, in batches).
     Calling this routine with no arguments causes the zeros.csv file
     to be sorted into time order, without otherwise changing it.
 
@@ -17,22 +17,16 @@ def zeros_addline(fnames="",navgs="",sites="",cameras="",jdates="",targnames="",
 
 
     '''
-    
+
     nresroot=os.getenv("NRESROOT")
     zerofile=nresroot+'reduced/csv/zeros.csv'
-    
-    if len(fnames)>0:
-        dat=np.column_stack((fnames,navgs,sites,cameras,jdates,targnames,teffs,loggs,bmvs,jmks,flags))
-        outfile = open(zerofile,"a")
 
-        # get a csv writer
-        writer = csv.writer( outfile )
-        [ writer.writerow(x) for x in dat ]
+    #column the file is sorted on, and the header for a new file
+    keycol=4
+    hdrs=['Filename','Navg','Site','Camera','Jdate','Targname','Teff','logg','B-V','J-K','Flags']
 
-        # close file
-        outfile.close()
-
-
-    df = pd.read_csv(zerofile)
-    df = df.sort_values('Jdate')
-    df.to_csv(zerofile,index=False)
\ No newline at end of file
+    if len(fnames)>0:
+        dat=np.column_stack((fnames,navgs,sites,cameras,jdates,targnames,teffs,loggs,bmvs,jmks,flags))
+        csv_writer.append_rows(zerofile,hdrs,dat,keycol)
+    else:
+        csv_writer.compact(zerofile,keycol)
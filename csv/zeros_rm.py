@@ -1,4 +1,6 @@
 import os.path
+import csv_writer
+
 
 def zeros_rm(indx):
 
@@ -16,18 +18,8 @@ def zeros_rm(indx):
     indx=['zero/ZERO2015174.5243.fits','zero/ZERO2015176.5243.fits']
 
     """
-
-    import pandas as pd
-
     nresroot=os.getenv("NRESROOT")
-
     zerofile = nresroot+'reduced/csv/zeros.csv'
 
-    #Read in zerofile
-    df = pd.read_csv(zerofile)
-
-    #Dropping Filenames matching lines in indx
-    df_out = df[~df['Filename'].isin(indx)]
-
-    #Writing out file
-    df_out.to_csv(zerofile,index=False)
\ No newline at end of file
+    #Dropping lines whose Filename (column 0) matches indx, holding the write lock
+    csv_writer.remove_rows(zerofile,0,indx)
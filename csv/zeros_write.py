@@ -1,6 +1,6 @@
 import numpy as np
 import os.path
-import csv
+import csv_writer
 
 
 def zeros_write(fnames,navgs,sites,cameras,jdates,targnames,teffs,loggs,bmvs,jmks,flags):
@@ -11,32 +11,17 @@ def zeros_write(fnames,navgs,sites,cameras,jdates,targnames,teffs,loggs,bmvs,jmk
     import os.path
     os.environ["NRESROOT"] = "/Users/rolfsmei/Documents/research/nres_4/nres_copy4/"
     '''
-    
+
     nresroot=os.getenv("NRESROOT")
-    
+
     #Writing vectors into one array
     dat=np.column_stack((fnames,navgs,sites,cameras,jdates,targnames,teffs,loggs,bmvs,jmks,flags))
-    
+
     #set savefile path
     zerofile=nresroot+'reduced/csv/zeros.csv'
-    
+
     #set headers
     hdrs=['Filename','Navg','Site','Camera','Jdate','Targname','Teff','logg','B-V','J-K','Flags']
-    
-    # open output file
-    outfile = open(zerofile,"wb")
-
-    # get a csv writer
-    writer = csv.writer( outfile )
-
-    # write header
-    writer.writerow(hdrs)
-
-    # write data
-    [ writer.writerow(x) for x in dat ]
-
-    # close file
-    outfile.close()
-    
-
 
+    # write header and data to a temporary file and rename it over the old one, holding the write lock
+    csv_writer.rewrite(zerofile,hdrs,dat)
@@ -0,0 +1,327 @@
+'''
+Optimal extraction of NRES spectra, as done by extract.pro, extlstsq.pro,
+order_cen.pro and dymedian.pro.
+
+Rather than looping over orders, fibers and x, every step works on whole
+arrays.  Internally the extraction boxes are held as (cowid,nord,mfib,nx)
+arrays of 4-byte floats, as in IDL, with x along the contiguous axis so
+that gathering boxes out of the image and summing across them read memory
+in order.  The results are returned in the (nx,nord,mfib) layout used for
+corspec and rmsspec in nres_comm.
+'''
+import numpy as np
+from numpy.polynomial import legendre
+
+
+def idl_round(values):
+    '''
+    Round half away from zero, as IDL round() does (numpy rounds half to even).
+    '''
+    return (np.sign(values) * np.floor(np.abs(values) + 0.5)).astype(int)
+
+
+def idl_median(values, axis=None):
+    '''
+    Median as IDL median() computes it: for an even number of values, the
+    larger of the two middle ones rather than their mean.
+    '''
+    values = np.sort(values, axis=axis)
+    axis = -1 if axis is None else axis
+    return np.take(values, values.shape[axis] // 2, axis=axis)
+
+
+def idl_quartile(values):
+    '''
+    Separation of the quartile points of values, as quartile.pro computes
+    it: the medians (see idl_median) of the values below the median and of
+    those at or above it.
+    '''
+    med = idl_median(values)
+    lo = values[values < med]
+    hi = values[values >= med]
+    return (idl_median(hi) if len(hi) else values[-1]) - (idl_median(lo) if len(lo) else values[0])
+
+
+def order_cen(trace, nx):
+    '''
+    This routine computes the trace vector array ord_vectors(nx,nord,3),
+    containing the order center positions vs x, order, fiber, from the
+    Legendre coefficients trace(nfib,nord,nleg) held in a TRACE file.
+    Fibers that are not in trace are left at zero.
+    '''
+    nfib, nord, nleg = trace.shape
+    x = 2. * (np.arange(nx) - nx / 2.) / nx          # x in range [-1,1]
+    # legval evaluates every order and fiber at once, giving (nfib,nord,nx)
+    ord_vectors = np.zeros((nx, nord, 3), dtype=float)
+    ord_vectors[:, :, :nfib] = legendre.legval(x, np.moveaxis(trace, -1, 0)).transpose(2, 1, 0)
+    return ord_vectors
+
+
+def extraction_boxes(cordat, varmap, ordvec, cowid, dymed0):
+    '''
+    Strip the data in the extraction boxes out of cordat(ny,nx) and
+    varmap(ny,nx), for order centers ordvec(nord,mfib,nx) shifted by
+    dymed0(nord).  Returns ebox(cowid,nord,mfib,nx), vbox(cowid,nord,mfib,nx)
+    and the bottom rows of the boxes ordbot(nord,mfib,nx).  Boxes are left
+    at zero for x values where any fiber of the order runs off the detector.
+    '''
+    ny, ncols = cordat.shape
+    nx = ordvec.shape[-1]
+    ordbot = idl_round(ordvec + dymed0[:, np.newaxis, np.newaxis] - cowid / 2.)
+    inside = (ordbot.min(axis=1) >= 0) & (ordbot.max(axis=1) + cowid - 1 <= ny - 1)    # (nord,nx)
+    inside = inside[:, np.newaxis, :]
+    # index of the bottom pixel of each box in the flattened image; row k of the box is k*ncols further on
+    base = np.where(inside, ordbot * ncols + np.arange(nx), 0)
+    cordat = np.ascontiguousarray(cordat, dtype=np.float32).reshape(-1)
+    varmap = np.ascontiguousarray(varmap, dtype=np.float32).reshape(-1)
+    ebox = np.empty((cowid,) + ordbot.shape, dtype=np.float32)
+    vbox = np.empty((cowid,) + ordbot.shape, dtype=np.float32)
+    for k in range(cowid):
+        np.take(cordat, base + k * ncols, out=ebox[k])
+        np.take(varmap, base + k * ncols, out=vbox[k])
+    ebox *= inside
+    vbox *= inside
+    return ebox, vbox, ordbot
+
+
+def moments(ebo):
+    '''
+    Raw intensity mom0, shift mom1 (1st moment) and width mom2 (2nd moment)
+    across the extraction boxes ebo(cowid,...).  mom1 and mom2 are only
+    normalized where mom0 > 0.
+    '''
+    cowid = ebo.shape[0]
+    # yy contains the coords of the pixel centers relative to the box center
+    yy = (np.arange(cowid, dtype=np.float32) - cowid / 2. + 0.5).reshape((cowid,) + (1,) * (ebo.ndim - 1))
+    mom0 = ebo.sum(axis=0)
+    mom1 = (ebo * yy).sum(axis=0)
+    mom2 = (ebo * yy ** 2).sum(axis=0)
+    s0 = mom0 > 0.
+    mom1[s0] = mom1[s0] / mom0[s0]
+    mom2[s0] = np.sqrt(np.maximum(mom2[s0] / mom0[s0], 0.))
+    return mom0, mom1, mom2
+
+
+def dymedian(inten, dely, cowid, skiplo=0.15, skiphi=0.85):
+    '''
+    This function accepts inten(nord,nx) and dely(nord,nx) for one fiber and
+    uses them to estimate the typical cross-dispersion shift in pixels of the
+    intensity distribution, relative to the center of the extraction box.
+    The estimate is a vector of length nord, from a sigma-clipped linear fit
+    vs order index over the apparently good data.  Orders below skiplo or
+    above skiphi (as fractions of nord), points with less than 0.1 of the
+    median intensity of their order, and points displaced by more than
+    cowid/2 are ignored.  If too few good data are found, the function
+    returns a zero vector.
+    '''
+    nord, nx = inten.shape
+    jbot = int(nord * skiplo + 1)
+    jtop = int(nord * skiphi)
+    iord0 = np.arange(nord) - nord / 2.
+
+    good = np.zeros((nord, nx), dtype=bool)
+    good[jbot:jtop] = True
+    good &= inten >= 0.1 * idl_median(inten, axis=1)[:, np.newaxis]
+    good &= np.abs(dely) <= cowid / 2.
+    nsg = good.sum()
+    if nsg <= 5:
+        return np.zeros(nord)
+
+    funs = np.stack([np.ones((nord, nx)), np.broadcast_to(iord0[:, np.newaxis], (nord, nx))], axis=-1)
+    cc = np.linalg.lstsq(funs[good], dely[good], rcond=None)[0]
+    # sigma clip outliers at 5 * pseudo-gaussian sigma
+    resid = dely - funs @ cc
+    good &= np.abs(resid) < 5. * idl_quartile(resid[good]) / 1.35
+    cc = np.linalg.lstsq(funs[good], dely[good], rcond=None)[0]
+    if nsg <= 100:
+        return np.zeros(nord)
+    return cc[0] + cc[1] * iord0
+
+
+def block_profiles(prof, nx, columns=slice(None)):
+    '''
+    Expand the cross-dispersion profiles prof(cowid,nord,mfib,nblock), one
+    per block of x, to every x, interpolating linearly between blocks as IDL
+    rebin does.  Returns rprofile(cowid,nord,mfib,nx), or just the given
+    columns of it.
+    '''
+    nblock = prof.shape[-1]
+    # pad x to make nx divisible by nblock, and then trim the padding off both ends
+    remain = (-nx) % nblock
+    xb = np.arange(nx + remain)[remain // 2:nx + remain // 2][columns] * nblock / float(nx + remain)
+    i0 = np.floor(xb).astype(int)
+    i1 = np.minimum(i0 + 1, nblock - 1)
+    frac = (xb - i0).astype(np.float32)
+    prof = prof.astype(np.float32)
+    return prof[..., i0] * (1. - frac) + prof[..., i1] * frac
+
+
+def shift_profiles(rprofile, orddy):
+    '''
+    Shift and interpolate the profiles rprofile(cowid,nord,mfib,nx) across
+    dispersion by orddy(nord,mfib,nx) pixels, averaging the two quadratic
+    Lagrange interpolations through the 4 points surrounding each target.
+    '''
+    cowid = rprofile.shape[0]
+    iddy = np.floor(orddy).astype(int)
+    sddy = (iddy - orddy).astype(np.float32)                  # in range [-1,0]
+    pddy = sddy + 1.                                          # in range [0,1]
+    # weights of the 4 points surrounding each target, rows k-iddy-2 .. k-iddy+1 of the profile
+    weights = [pddy * (pddy - 1.) / 4.,
+               sddy * (sddy - 1.) / 4. - (pddy + 1.) * (pddy - 1.) / 2.,
+               -(sddy + 1.) * (sddy - 1.) / 2. + pddy * (pddy + 1.) / 4.,
+               sddy * (sddy + 1.) / 4.]
+
+    # Within each group of points that share the same whole-pixel shift, the
+    # 4 points are the same rows of the padded profile, so they can be sliced
+    shifts = np.unique(iddy)
+    pad = max(2, 2 + int(shifts.max()), 1 - int(shifts.min()))
+    ofprofile = np.zeros((cowid + 2 * pad,) + rprofile.shape[1:], dtype=np.float32)
+    ofprofile[pad:pad + cowid] = rprofile
+    if len(shifts) == 1:
+        start = pad - 2 - shifts[0]
+        return sum(weight * ofprofile[start + i:start + i + cowid] for i, weight in enumerate(weights))
+
+    ofprofile = ofprofile.reshape(cowid + 2 * pad, -1)
+    weights = [weight.reshape(-1) for weight in weights]
+    sprofile = np.empty((cowid, ofprofile.shape[1]), dtype=np.float32)
+    for shift in shifts:
+        start = pad - 2 - shift
+        columns = np.flatnonzero(iddy == shift)
+        group = ofprofile[:, columns]
+        sprofile[:, columns] = sum(weight[columns] * group[start + i:start + i + cowid]
+                                   for i, weight in enumerate(weights))
+    return sprofile.reshape(rprofile.shape)
+
+
+def extlstsq(sprofile, dfpdy, d2fpdy2, ebo, vbo, ewts):
+    '''
+    Weighted least-squares fit of the observed counts ebo across each order
+    profile to the profile, its 1st and its 2nd cross-dispersion derivative,
+    for every order, fiber and x at once (extlstsq.pro with nfun=3,
+    ifun=[0,2,3]).  All inputs are (cowid,...).
+    Returns fitc(5,...) = [exintn,excon,exdy,exdy2,exsig], where exdy and
+    exdy2 are normalized by exintn where it is positive, excon is not fitted
+    (zero), and exsig = sqrt(sum over the box of vbo).
+    '''
+    funs = [sprofile, dfpdy, d2fpdy2]
+    weighted = [fun * ewts for fun in funs]
+    a = [[None] * 3 for i in range(3)]
+    for i in range(3):
+        for j in range(i, 3):
+            a[i][j] = a[j][i] = np.einsum('k...,k...->...', weighted[i], funs[j]).astype(float)
+    y = [np.einsum('k...,k...->...', weighted[i], ebo).astype(float) for i in range(3)]
+
+    # solve the 3x3 normal equations by Cramer's rule, as extlstsq.pro does
+    (a00, a01, a02), (a10, a11, a12), (a20, a21, a22) = a
+    y0, y1, y2 = y
+    det = a22 * (a00 * a11 - a01 * a10) - a20 * (a02 * a11 - a01 * a12) + a21 * (a02 * a10 - a00 * a12)
+    d0 = a22 * (y0 * a11 - a10 * y1) - a20 * (y2 * a11 - a12 * y1) + a21 * (y2 * a10 - a12 * y0)
+    d1 = a22 * (a00 * y1 - y0 * a01) - a20 * (a02 * y1 - y2 * a01) + a21 * (a02 * y0 - y2 * a00)
+    d2 = y2 * (a00 * a11 - a10 * a01) - y0 * (a02 * a11 - a12 * a01) + y1 * (a02 * a10 - a12 * a00)
+    sn = det != 0.
+    det = np.where(sn, det, 1.)
+
+    fitc = np.zeros((5,) + det.shape)
+    exintn = np.where(sn, d0 / det, 0.)
+    sg = exintn > 0.
+    fitc[0] = exintn
+    fitc[2] = np.where(sn, d1 / det, 0.)
+    fitc[3] = np.where(sn, d2 / det, 0.)
+    fitc[2:4, sg] /= exintn[sg]
+    fitc[4] = np.sqrt(vbo.sum(axis=0))
+    return fitc
+
+
+def extract(cordat, varmap, ord_vectors, prof, ord_wid, objects, camera='', max_iter=100, chunk=64):
+    '''
+    This routine combines the corrected intensity data cordat(ny,nx), variance
+    map varmap(ny,nx), order traces ord_vectors(nx,nord,3), order profiles
+    prof(nblock,cowid,nord,nfib) and width ord_wid to yield the extracted
+    spectrum data, as extract.pro does.  objects is the list of object names
+    for each fiber (from the OBJECTS keyword); fibers named NONE are not
+    extracted.
+
+    If any extracted fiber is not ThAr and the brightest fiber is bright
+    enough, the brightest fiber is used to estimate an order-dependent
+    cross-dispersion shift of the traces (see dymedian), which is applied
+    to all fibers.  Each fiber
+    is then extracted by an optimal (Horne) weighted fit of the shifted
+    profile and its derivatives (see extlstsq).
+
+    The fits are done for chunk columns at a time.
+
+    Returns a dictionary with spectrum, specrms, specdy, specdy2 and specwid,
+    each (nx,nord,mfib), nelectron(mfib) and tracdy, the median trace shift.
+    '''
+    nx, nord = ord_vectors.shape[:2]
+    cowid = int(np.ceil(ord_wid))
+    objects = [obj.strip().upper() for obj in objects]
+    fib0 = 0 if objects[0] != 'NONE' else 1
+    mfib = len(objects) - objects.count('NONE')
+    if mfib == 3:
+        fibers = [0, 1, 2]
+    elif mfib == 2:
+        fibers = [fib0, fib0 + 1]
+    else:
+        # hack for bifurcated fiber, as in extract.pro
+        fibers = [2]
+    ordvec = ord_vectors[:, :, fibers].transpose(1, 2, 0)
+    profiles = prof[..., [jfib + fib0 for jfib in range(mfib)]].transpose(1, 2, 3, 0)
+    britethrsh = nx * nord * 200.        # threshold for dy shift calculation is 200 ADU per pixel, on avg.
+
+    # convert the image to 4-byte floats once, rather than every time the boxes are made
+    cordat = np.ascontiguousarray(cordat, dtype=np.float32)
+    varmap = np.ascontiguousarray(varmap, dtype=np.float32)
+
+    # The cross-disp shift is estimated from the brightest fiber, if any fiber is not ThAr.  As in
+    # extract.pro, that is the brightest of all the fibers, even if it is a ThAr one, and it is chosen
+    # again each time the boxes are moved.  Iterate until the median correction is small.
+    shiftable = any(objects[jfib + fib0] not in ('THAR', 'NONE') for jfib in range(mfib))
+    dymed0 = np.zeros(nord)
+    dymed = np.zeros((nord, mfib))
+    tracdy = 0.
+    for current_iter in range(max_iter + 2):
+        ebox, vbox, ordbot = extraction_boxes(cordat, varmap, ordvec, cowid, dymed0)
+        ebrite = ebox.sum(axis=(0, 1, 3), dtype=float)
+        if not shiftable or ebrite.max() <= britethrsh:
+            break
+        shift_fiber = int(np.argmax(ebrite))
+        mom0, mom1, mom2 = moments(ebox[:, :, shift_fiber])
+        dymed_shift = dymedian(mom0, mom1, cowid)
+        if abs(idl_median(dymed_shift)) <= 0.1:
+            dymed[:, shift_fiber] = dymed_shift
+            tracdy = idl_median(dymed0)
+            break
+        if current_iter > max_iter:
+            raise RuntimeError('Maximum iteration reached in extract')
+        dymed0 = dymed0 + dymed_shift
+
+    mom0, mom1, mom2 = moments(ebox)
+
+    # expected fractional pixel shift of each profile from its box center, corrected by dymed
+    orddy = ordvec + dymed0[:, np.newaxis, np.newaxis] - ordbot - cowid / 2. + dymed[:, :, np.newaxis]
+    profiles = profiles.astype(np.float32)
+
+    # the rest is done for chunk columns at a time, so the temporary arrays stay in the cache
+    fitc = np.empty((5,) + ordbot.shape)
+    for x0 in range(0, nx, chunk):
+        columns = slice(x0, x0 + chunk)
+        sprofile = shift_profiles(block_profiles(profiles, nx, columns), orddy[..., columns])
+
+        # cross-dispersion derivatives of the profiles (3-point, as IDL deriv)
+        dfpdy = np.gradient(sprofile, axis=0, edge_order=2)
+        d2fpdy2 = np.gradient(dfpdy, axis=0, edge_order=2)
+
+        # optimal extraction weights, a la Horne
+        ewts = sprofile ** 2 / np.maximum(vbox[..., columns], 1.)
+        fitc[..., columns] = extlstsq(sprofile, dfpdy, d2fpdy2, ebox[..., columns], vbox[..., columns], ewts)
+    fitc = fitc.transpose(0, 3, 1, 2)
+
+    spectrum = fitc[0]
+    # censor last point in Sinistro data
+    if camera.strip().startswith('fl'):
+        spectrum[nx - 1] = spectrum[nx - 2]
+
+    return {'spectrum': spectrum, 'specrms': fitc[4], 'specdy': fitc[2], 'specdy2': fitc[3],
+            'specwid': mom2.transpose(2, 0, 1), 'nelectron': spectrum.sum(axis=(0, 1)), 'tracdy': tracdy}
@@ -0,0 +1,34 @@
+pro mk_extract_reference,filename
+; This routine runs extract on the data in the nres common block, set up
+; as calib_extract leaves it just before it calls extract, and writes the
+; inputs and results of the extraction to FITS file filename, for checking
+; the Python port of extract against (see nrespipe/test/test_extract.py,
+; which reads the file named by environment variable NRES_EXTRACT_REFERENCE).
+; Extensions are
+; 0 cordat(nx,ny), with keywords ORDWID, OBJECTS and CAMERA
+; 1 varmap(nx,ny)
+; 2 ord_vectors(nx,nord,3)
+; 3 prof(cowid,nord,nfib,nblock), as held in tracedat
+; 4 spectrum(nx,nord,mfib)
+; 5 specrms(nx,nord,mfib)
+; 6 specdy(nx,nord,mfib)
+; 7 specwid(nx,nord,mfib)
+
+@nres_comm
+
+extract,ierr
+
+mkhdr,hdr,cordat
+sxaddpar,hdr,'ORDWID',tracedat.ord_wid
+sxaddpar,hdr,'OBJECTS',sxpar(dathdr,'OBJECTS')
+sxaddpar,hdr,'CAMERA',camera
+writefits,filename,cordat,hdr
+writefits,filename,varmap,/append
+writefits,filename,tracedat.ord_vectors,/append
+writefits,filename,tracedat.prof,/append
+writefits,filename,echdat.spectrum,/append
+writefits,filename,echdat.specrms,/append
+writefits,filename,echdat.specdy,/append
+writefits,filename,echdat.specwid,/append
+
+end
@@ -96,6 +96,10 @@ muncha.muncha(filin)
     import ingest
     ierr = ingest.ingest(filin)
 
+    # Choose this frame's calibration files and read them into the shared cache up front
+    import calib_index
+    calib_index.get_index(nr.nresroot + 'reduced/csv/standards.csv').preload(nr.nresroot, nr.site, nr.camera, nr.jdc)
+
 
     #Need to build each: bias, dark, target, flat, double
     #Copy is done, run below to run, un comment out when each
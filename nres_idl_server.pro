@@ -0,0 +1,67 @@
+pro nres_idl_server_job, args, status
+; Runs a single run_nres_pipeline job inside the long-lived IDL session.
+; args = ['run_nres_pipeline', filename, do_rv]. On return, status is 0
+; if the pipeline finished normally and 1 if an error was caught.
+  compile_opt HIDDEN
+  status = 0
+  catch, error_status
+  if error_status ne 0 then begin
+    CATCH, /CANCEL
+    Help, /Last_Message, Output=theErrorMessage
+    FOR j=0,N_Elements(theErrorMessage)-1 DO BEGIN
+      Print, theErrorMessage[j]
+    ENDFOR
+    print, !ERROR_STATE.MSG_PREFIX
+    PRINT, !ERROR_STATE.MSG
+    status = 1
+    return
+  endif
+  if n_elements(args) lt 3 then begin
+    print, 'At least two arguments are required to run the NRES pipeline.'
+    print, 'Filename'
+    print, 'Do Radial Velocity calculation (0 or 1)'
+    status = 1
+  endif else begin
+    if long(args[2]) then begin
+      nostar = !NULL
+    endif else begin
+      nostar = 1
+    endelse
+    muncha, args[1], nostar=nostar
+  endelse
+end
+
+pro nres_idl_server
+; Long-lived IDL session driven by nrespipe.idl.IDLSession.
+; The precompiled routines are restored once, and the nres_comm common
+; block stays resident between jobs. Commands are read from stdin, one
+; per line:
+;   PING                                  -> prints @@NRES_PONG
+;   run_nres_pipeline filename do_rv      -> pipeline output, then
+;                                            @@NRES_DONE status
+;   EXIT                                  -> ends the session
+; NRESROOT and NRESINST are fixed for the lifetime of the session, so the
+; caller keeps one session per site and instrument.
+  compile_opt HIDDEN
+  restore, getenv('NRES_IDL_PRECOMPILE')
+  line = ''
+  on_ioerror, done
+  while 1 do begin
+    readf, 0, line
+    args = strsplit(strtrim(line, 2), ' ', /extract)
+    command = strupcase(args[0])
+    if command eq 'EXIT' then goto, done
+    if command eq 'PING' then begin
+      print, '@@NRES_PONG'
+    endif else if command eq 'RUN_NRES_PIPELINE' then begin
+      nres_idl_server_job, args, status
+      print, '@@NRES_DONE ' + strtrim(string(status), 2)
+    endif else begin
+      print, 'Unknown NRES IDL server command: ' + line
+      print, '@@NRES_DONE 1'
+    endelse
+    flush, -1
+  endwhile
+done:
+  exit, status=0
+end
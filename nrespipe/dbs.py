@@ -1,9 +1,10 @@
+import os
 import sqlalchemy.ext.declarative
 from sqlalchemy import Column, Integer, Boolean, CHAR, String
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import pool
 from sqlalchemy.sql.expression import true
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 
 
 Base = sqlalchemy.ext.declarative.declarative_base()
@@ -43,6 +44,40 @@ def create_db(db_address):
     Base.metadata.create_all(engine)
 
 
+# Engines (and their connection pools) keyed by (db_address, process id)
+engines = {}
+session_factories = {}
+
+
+def get_engine(db_address):
+    """
+    Get the connection-pooled engine for a database, creating it on first use in this process
+
+    Parameters
+    ----------
+    db_address : str
+                 SQLAlchemy style url to the database
+
+    Returns
+    -------
+    engine : sqlalchemy.engine.Engine
+
+    Notes
+    -----
+    Engines are keyed on the process id as well as the address. A Celery prefork child therefore builds its own
+    pool instead of reusing connections inherited from the parent. The parent's engine is deliberately left
+    untouched in the child (not disposed) so that the child never closes sockets the parent is still using.
+    """
+    key = (db_address, os.getpid())
+    if key not in engines:
+        # pre_ping replaces connections that the database server has dropped while they sat idle in the pool
+        engines[key] = create_engine(db_address, pool_pre_ping=True)
+        # We don't use autoflush typically. I have run into issues where SQLAlchemy would try to flush
+        # incomplete records causing a crash. None of the queries here are large, so it should be ok.
+        session_factories[key] = sessionmaker(bind=engines[key], autoflush=False, expire_on_commit=False)
+    return engines[key]
+
+
 def get_session(db_address):
     """
     Get a connection to the database.
@@ -50,15 +85,14 @@ def get_session(db_address):
     Returns
     -------
     session: SQLAlchemy Database Session
-    """
-    # Build a new engine for each session. This makes things thread safe.
-    engine = create_engine(db_address, poolclass=pool.NullPool)
-    Base.metadata.bind = engine
 
-    # We don't use autoflush typically. I have run into issues where SQLAlchemy would try to flush
-    # incomplete records causing a crash. None of the queries here are large, so it should be ok.
-    db_session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
-    return db_session()
+    Notes
+    -----
+    Sessions are not thread safe, so each caller gets a new session. Sessions share the pooled engine for this
+    process so we don't pay to set up a new connection every time.
+    """
+    get_engine(db_address)
+    return session_factories[(db_address, os.getpid())]()
 
 
 def get_or_create(db_address, table_model, equivalence_criteria, record_attributes):
@@ -121,6 +155,42 @@ def get_processing_state(filename, checksum, db_address):
     return get_or_create(db_address, ProcessingState, {'filename': filename, 'checksum': checksum}, {})
 
 
+def get_processing_states(filenames, db_address, chunk_size=500):
+    """
+    Get the processing state of many files with a few queries
+
+    Parameters
+    ----------
+    filenames : iterable of str
+                file names of interest
+    db_address : str
+                 SQLAlchemy style url to the database
+    chunk_size : int
+                 Maximum number of file names per query. This keeps the IN clause within database limits.
+
+    Returns
+    -------
+    states : dict
+             nrespipe.dbs.ProcessingState records keyed by file name. Files that are not in the database are
+             not included.
+
+    Notes
+    -----
+    Unlike get_processing_state, this does not create records for files that are missing.
+    """
+    filenames = list(set(filenames))
+    states = {}
+    db_session = get_session(db_address)
+    try:
+        for i in range(0, len(filenames), chunk_size):
+            query = ProcessingState.filename.in_(filenames[i:i + chunk_size])
+            for record in db_session.query(ProcessingState).filter(query):
+                states[record.filename] = record
+    finally:
+        db_session.close()
+    return states
+
+
 def set_file_as_processed(filename, checksum, frameid, db_address):
     """
     Mark a file as processed in the database
@@ -129,16 +199,43 @@ def set_file_as_processed(filename, checksum, frameid, db_address):
     ----------
     filename : str
            File name of interest
-    checksum :
+    checksum : str
+               32 character string representing the MD5 checksum of the file of interest
+    frameid : int
+              Archive frame id of the file. None if the file did not come from the archive.
     db_address : str
                  SQLAlchemy style url to the database
-    """
-    record = get_or_create(db_address, ProcessingState, {'filename': filename}, {'checksum': checksum})
-    record.processed = True
-    record.checksum = checksum
-    record.frameid = frameid
 
-    db_session = get_session(db_address)
-    db_session.add(record)
-    db_session.commit()
-    db_session.close()
+    Notes
+    -----
+    For sqlite, postgres and mysql this is a single upsert statement. Other databases fall back to a select
+    followed by an insert or update in one session.
+    """
+    values = {'filename': filename, 'checksum': checksum, 'processed': True, 'frameid': frameid}
+    updated_values = {'checksum': checksum, 'processed': True, 'frameid': frameid}
+
+    engine = get_engine(db_address)
+    if engine.dialect.name in ['sqlite', 'postgresql']:
+        dialect_module = sqlite if engine.dialect.name == 'sqlite' else postgresql
+        statement = dialect_module.insert(ProcessingState).values(**values)
+        statement = statement.on_conflict_do_update(index_elements=['filename'], set_=updated_values)
+    elif engine.dialect.name == 'mysql':
+        statement = mysql.insert(ProcessingState).values(**values).on_duplicate_key_update(**updated_values)
+    else:
+        statement = None
+
+    if statement is not None:
+        with engine.begin() as connection:
+            connection.execute(statement)
+    else:
+        db_session = get_session(db_address)
+        try:
+            record = db_session.query(ProcessingState).filter(ProcessingState.filename == filename).first()
+            if record is None:
+                record = ProcessingState(filename=filename)
+                db_session.add(record)
+            for key, value in updated_values.items():
+                setattr(record, key, value)
+            db_session.commit()
+        finally:
+            db_session.close()
@@ -0,0 +1,270 @@
+import logging
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('nrespipe')
+
+# Lines written by nres_idl_server.pro to delimit jobs and health checks
+DONE_SENTINEL = '@@NRES_DONE'
+PONG_SENTINEL = '@@NRES_PONG'
+
+# IDL procedures that nres_idl_server.pro knows how to run
+POOLED_PROCEDURES = ['run_nres_pipeline']
+
+
+def idl_environment(data_reduction_root, site, nres_instrument, base_environment=None):
+    """
+    Build the environment for an IDL process reducing data from a given NRES
+
+    Parameters
+    ----------
+    data_reduction_root : str
+                          Top level directory for reduced data
+    site : str
+           Site ID (e.g. elp)
+    nres_instrument : str
+                      NRES instance (e.g. nres01)
+    base_environment : dict
+                       Environment to start from. Defaults to os.environ
+
+    Returns
+    -------
+    environment : dict
+                  Copy of the base environment with NRESROOT and NRESINST set
+
+    Notes
+    -----
+    The IDL code expects both paths to have trailing slashes.
+    """
+    if base_environment is None:
+        base_environment = os.environ
+    environment = dict(base_environment)
+    environment['NRESROOT'] = os.path.join(data_reduction_root, site, '')
+    environment['NRESINST'] = os.path.join(nres_instrument, '')
+    return environment
+
+
+class IDLSession(object):
+    """
+    A long-lived IDL process running nres_idl_server that accepts pipeline jobs over stdin
+
+    Parameters
+    ----------
+    site : str
+           Site ID (e.g. elp)
+    nres_instrument : str
+                      NRES instance (e.g. nres01)
+    data_reduction_root : str
+                          Top level directory for reduced data
+    command : str
+              Command used to start the session. Defaults to the IDL server procedure.
+
+    Notes
+    -----
+    NRESROOT and NRESINST are read by the IDL code through getenv, so they are fixed
+    when the process starts. Sessions are therefore specific to one site and instrument.
+    """
+    def __init__(self, site, nres_instrument, data_reduction_root, command='idl -e nres_idl_server -quiet'):
+        self.site = site
+        self.nres_instrument = nres_instrument
+        self.data_reduction_root = data_reduction_root
+        self.command = command
+        self.n_jobs = 0
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        self._lines = queue.Queue()
+        logger.info('Starting IDL session', extra={'tags': {'site': site, 'instrument': nres_instrument}})
+        self.process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, universal_newlines=True, bufsize=1,
+                                        env=idl_environment(data_reduction_root, site, nres_instrument))
+        # Read both pipes in the background so that a chatty IDL process never blocks on a full pipe
+        for stream_name, stream in [('stdout', self.process.stdout), ('stderr', self.process.stderr)]:
+            reader = threading.Thread(target=self._read_stream, args=(stream_name, stream), daemon=True)
+            reader.start()
+
+    def _read_stream(self, stream_name, stream):
+        for line in iter(stream.readline, ''):
+            self._lines.put((stream_name, line.rstrip('\n')))
+        self._lines.put((stream_name, None))
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def _send(self, line):
+        self.process.stdin.write(line + '\n')
+        self.process.stdin.flush()
+
+    def _wait_for(self, sentinel, timeout):
+        """
+        Collect the output of the session until a sentinel line is printed
+
+        Returns
+        -------
+        status : str or None
+                 Text after the sentinel, or None if the session died or timed out
+        stdout, stderr : list of str
+                         Lines printed by IDL before the sentinel
+        """
+        stdout, stderr = [], []
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, stdout, stderr
+            try:
+                stream_name, line = self._lines.get(timeout=min(remaining, 1.0))
+            except queue.Empty:
+                if not self.is_alive() and self._lines.empty():
+                    return None, stdout, stderr
+                continue
+            if line is None:
+                continue
+            if stream_name == 'stdout' and line.startswith(sentinel):
+                return line[len(sentinel):].strip(), stdout, stderr
+            (stdout if stream_name == 'stdout' else stderr).append(line)
+
+    def ping(self, timeout=30):
+        """
+        Check that the session is still responsive
+
+        Returns
+        -------
+        healthy : bool
+        """
+        if not self.is_alive():
+            return False
+        try:
+            self._send('PING')
+        except (BrokenPipeError, OSError):
+            return False
+        status, _, _ = self._wait_for(PONG_SENTINEL, timeout)
+        return status is not None
+
+    def run(self, idl_procedure, args, timeout=3600):
+        """
+        Run a job in the session
+
+        Parameters
+        ----------
+        idl_procedure : str
+                        Procedure to run, one of POOLED_PROCEDURES
+        args : list of str
+               Arguments that would otherwise be passed with idl -args
+        timeout : float
+                  Maximum number of seconds to wait for the job to finish
+
+        Returns
+        -------
+        returncode : int
+                     0 on success. Positive if IDL caught an error, the session died or timed out.
+        stdout, stderr : list of str
+                         Output printed by IDL during the job
+        """
+        self.n_jobs += 1
+        self.last_used = time.time()
+        try:
+            self._send(' '.join([idl_procedure] + list(args)))
+        except (BrokenPipeError, OSError):
+            return 1, [], ['IDL session is not accepting jobs']
+
+        status, stdout, stderr = self._wait_for(DONE_SENTINEL, timeout)
+        self.last_used = time.time()
+        if status is None:
+            if self.is_alive():
+                stderr.append('IDL session timed out after {timeout} seconds'.format(timeout=timeout))
+                # The session is stuck in the middle of a job, so there is no point asking it to exit
+                self.process.kill()
+                self.process.wait()
+                return 1, stdout, stderr
+            return self.process.returncode or 1, stdout, stderr
+        try:
+            return int(status), stdout, stderr
+        except ValueError:
+            return 1, stdout, stderr
+
+    def close(self, timeout=30):
+        if self.is_alive():
+            try:
+                self._send('EXIT')
+                self.process.wait(timeout=timeout)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        logger.info('Stopped IDL session', extra={'tags': {'site': self.site, 'instrument': self.nres_instrument,
+                                                           'n_jobs': self.n_jobs}})
+
+
+class IDLSessionPool(object):
+    """
+    Warm IDL sessions, one per (site, instrument), reused across frames
+
+    Parameters
+    ----------
+    max_jobs_per_session : int
+                           Recycle a session after it has run this many jobs
+    job_timeout : float
+                  Maximum number of seconds for a single job
+    health_check_interval : float
+                            Ping a session before using it if it has been idle this long (seconds)
+    command : str
+              Command used to start each session
+
+    Notes
+    -----
+    Sessions are started lazily, so a pool created before a Celery worker forks does not
+    share IDL processes between children.
+    """
+    def __init__(self, max_jobs_per_session=50, job_timeout=3600, health_check_interval=300,
+                 command='idl -e nres_idl_server -quiet'):
+        self.max_jobs_per_session = max_jobs_per_session
+        self.job_timeout = job_timeout
+        self.health_check_interval = health_check_interval
+        self.command = command
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, site, nres_instrument, data_reduction_root):
+        key = (data_reduction_root, site, nres_instrument)
+        session = self.sessions.get(key)
+        if session is not None and not self._is_healthy(session):
+            session.close()
+            session = None
+        if session is None:
+            session = IDLSession(site, nres_instrument, data_reduction_root, command=self.command)
+            self.sessions[key] = session
+        return session
+
+    def _is_healthy(self, session):
+        if not session.is_alive():
+            return False
+        if session.n_jobs >= self.max_jobs_per_session:
+            logger.info('Recycling IDL session', extra={'tags': {'site': session.site, 'n_jobs': session.n_jobs}})
+            return False
+        if time.time() - session.last_used > self.health_check_interval:
+            return session.ping()
+        return True
+
+    def run(self, idl_procedure, args, data_reduction_root, site, nres_instrument):
+        """
+        Run a job on the warm session for this site and instrument
+
+        Returns
+        -------
+        returncode : int
+        stdout, stderr : list of str
+        """
+        with self._lock:
+            session = self.get_session(site, nres_instrument, data_reduction_root)
+        # Only one job at a time can be fed to a session, but jobs for other instruments can run alongside
+        with session.lock:
+            return session.run(idl_procedure, args, timeout=self.job_timeout)
+
+    def close(self):
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
@@ -1,27 +1,51 @@
 from kombu.mixins import ConsumerMixin
 from nrespipe import tasks
+from nrespipe import settings
 import logging
 
 logger = logging.getLogger('nrespipe')
 
 
 class NRESListener(ConsumerMixin):
-    def __init__(self, broker_url, data_reduction_root, db_address):
+    def __init__(self, broker_url, data_reduction_root, db_address, batch_size=None):
         self.broker_url = broker_url
         self.db_address = db_address
         self.data_reduction_root = data_reduction_root
+        self.batch_size = settings.listener_batch_size if batch_size is None else batch_size
+        self.pending_messages = []
+        self.received_message = False
 
     def on_connection_error(self, exc, interval):
         logger.error("{0}. Retrying connection in {1} seconds...".format(exc, interval))
         self.connection = self.connection.clone()
         self.connection.ensure_connection(max_retries=None)
 
+    def on_connection_revived(self):
+        # Messages that were not acknowledged before the connection dropped are redelivered by the broker
+        self.pending_messages = []
+
     def get_consumers(self, Consumer, channel):
         consumer = Consumer(queues=[self.queue], callbacks=[self.on_message])
-        # Only fetch one thing off the queue at a time
-        consumer.qos(prefetch_count=1)
+        # Only fetch a few things off the queue at a time, but enough to fill a batch
+        consumer.qos(prefetch_count=max(settings.listener_prefetch_count, self.batch_size))
         return [consumer]
 
     def on_message(self, body, message):
-        tasks.process_nres_file.delay(body, self.data_reduction_root, self.db_address)
-        message.ack()  # acknowledge to the sender we got this message (it can be popped)
+        self.pending_messages.append((body, message))
+        self.received_message = True
+        if len(self.pending_messages) >= self.batch_size:
+            self.send_batch()
+
+    def on_iteration(self):
+        # Called before every wait for messages: if the last wait timed out, the queue is quiet, so don't hold
+        # on to the frames we already have
+        if self.pending_messages and not self.received_message:
+            self.send_batch()
+        self.received_message = False
+
+    def send_batch(self):
+        file_infos = [body for body, message in self.pending_messages]
+        tasks.process_archive_frames.delay(file_infos, self.data_reduction_root, self.db_address)
+        for body, message in self.pending_messages:
+            message.ack()  # acknowledge to the sender we got this message (it can be popped)
+        self.pending_messages = []
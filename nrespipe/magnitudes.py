@@ -0,0 +1,250 @@
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from glob import glob
+
+import numpy as np
+from astroquery.simbad import Simbad
+
+logger = logging.getLogger('nrespipe')
+
+target_name_translations = {'PSIPHE' : 'psi Phe',
+                            'MUCAS' : 'mu Cas',
+                            'KS18C14487' :'TYC 8856-529-1',
+                            'BD093070': 'BD-09 3070'}
+
+# targets.csv uses this for magnitudes that are not known
+missing_magnitude = -99.9
+
+
+def get_search_name(target_name):
+    """
+    Convert a target name from the pipeline output into a name Simbad understands
+    """
+    search_name = target_name.split('_')[0]
+    return target_name_translations.get(search_name, search_name)
+
+
+def normalize_target_name(target_name):
+    # Ignore case, spaces and punctuation so HD_1461, HD 1461 and "HD1461" match
+    return ''.join(character for character in target_name.upper() if character.isalnum())
+
+
+def read_offline_magnitudes(targets_filenames):
+    """
+    Read V magnitudes from NRES targets.csv files
+
+    Parameters
+    ----------
+    targets_filenames : list of str
+                        Full paths to targets.csv files. Later files take precedence.
+
+    Returns
+    -------
+    magnitudes : dict
+                 V magnitude keyed by normalized target name. Unknown magnitudes are left out.
+    """
+    magnitudes = {}
+    for targets_filename in targets_filenames:
+        with open(targets_filename) as targets_file:
+            reader = csv.reader(targets_file)
+            next(reader)
+            for row in reader:
+                if len(row) < 4:
+                    continue
+                try:
+                    magnitude = float(row[3])
+                except ValueError:
+                    continue
+                if magnitude > missing_magnitude + 1.0:
+                    magnitudes[normalize_target_name(row[0])] = magnitude
+    return magnitudes
+
+
+def query_simbad_magnitudes(search_names):
+    """
+    Look up the V magnitudes of several objects with a single Simbad query
+
+    Parameters
+    ----------
+    search_names : list of str
+                   Names that Simbad can resolve
+
+    Returns
+    -------
+    magnitudes : dict
+                 V magnitude keyed by search name. Objects Simbad does not know, or that have no V magnitude, are nan.
+
+    Notes
+    -----
+    Raises if the query itself fails (e.g. the network is down) so that the caller does not cache the failure.
+    """
+    simbad_query = Simbad()
+    simbad_query.add_votable_fields('flux(V)')
+    logger.info('Querying Simbad for {n} targets'.format(n=len(search_names)))
+    result = simbad_query.query_objects(search_names)
+
+    magnitudes = {search_name: np.nan for search_name in search_names}
+    if result is None:
+        return magnitudes
+    # Older versions of astroquery name the columns differently
+    magnitude_column = 'FLUX_V' if 'FLUX_V' in result.colnames else 'V'
+    for i, row in enumerate(result):
+        if 'user_specified_id' in result.colnames:
+            search_name = str(row['user_specified_id'])
+        elif 'SCRIPT_NUMBER_ID' in result.colnames:
+            search_name = search_names[int(row['SCRIPT_NUMBER_ID']) - 1]
+        else:
+            search_name = search_names[i]
+        if search_name in magnitudes and not np.ma.is_masked(row[magnitude_column]):
+            magnitudes[search_name] = float(row[magnitude_column])
+    return magnitudes
+
+
+class MagnitudeResolver(object):
+    """
+    V magnitudes of targets with a persistent cache in front of Simbad
+
+    Parameters
+    ----------
+    cache_filename : str
+                     JSON file to keep the cache in. The cache is only kept in memory if None.
+    ttl : float
+          Seconds to trust a magnitude found by Simbad
+    negative_ttl : float
+                   Seconds to remember that Simbad did not have a magnitude before asking again
+    offline : bool
+              Never query Simbad. Magnitudes come from the cache and the targets.csv files.
+    targets_filenames : list of str
+                        targets.csv files used in offline mode
+
+    Notes
+    -----
+    The cache file is rewritten with an atomic rename, so several workers can share it.
+    If two workers add entries at the same time, one of the additions may be lost, which only
+    costs another query later.
+    """
+    def __init__(self, cache_filename=None, ttl=30 * 86400, negative_ttl=86400, offline=False,
+                 targets_filenames=None):
+        self.cache_filename = cache_filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.offline = offline
+        self.targets_filenames = targets_filenames or []
+        self._offline_magnitudes = None
+        self._lock = threading.Lock()
+        self.cache = self._load_cache()
+
+    def _load_cache(self):
+        if self.cache_filename is None or not os.path.exists(self.cache_filename):
+            return {}
+        try:
+            with open(self.cache_filename) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logger.warning('Could not read the magnitude cache: {exception}'.format(exception=e))
+            return {}
+
+    def _save_cache(self):
+        if self.cache_filename is None:
+            return
+        temp_filename = '{filename}.{pid}.tmp'.format(filename=self.cache_filename, pid=os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_filename)), exist_ok=True)
+            with open(temp_filename, 'w') as cache_file:
+                json.dump(self.cache, cache_file)
+            os.replace(temp_filename, self.cache_filename)
+        except OSError as e:
+            logger.warning('Could not write the magnitude cache: {exception}'.format(exception=e))
+
+    def _cached_magnitude(self, search_name, now):
+        """
+        Returns
+        -------
+        found : bool
+                True if there is an entry that has not expired
+        magnitude : float
+                    nan for a negative entry
+        """
+        entry = self.cache.get(search_name)
+        if entry is None:
+            return False, np.nan
+        magnitude = entry['mag']
+        ttl = self.negative_ttl if magnitude is None else self.ttl
+        if now - entry['time'] > ttl:
+            return False, np.nan
+        return True, np.nan if magnitude is None else magnitude
+
+    def _offline_magnitude(self, target_name):
+        if self._offline_magnitudes is None:
+            self._offline_magnitudes = read_offline_magnitudes(self.targets_filenames)
+        for name in [target_name, target_name.split('_')[0], get_search_name(target_name)]:
+            magnitude = self._offline_magnitudes.get(normalize_target_name(name))
+            if magnitude is not None:
+                return magnitude
+        return np.nan
+
+    def get_magnitudes(self, target_names):
+        """
+        Get the V magnitudes of many targets, querying Simbad at most once
+
+        Parameters
+        ----------
+        target_names : list of str
+                       Target names as they appear in the pipeline output (e.g. HD1461_1)
+
+        Returns
+        -------
+        magnitudes : dict
+                     V magnitude keyed by target name. nan if it is not known.
+        """
+        now = time.time()
+        magnitudes = {}
+        names_to_resolve = {}
+        with self._lock:
+            for target_name in target_names:
+                search_name = get_search_name(target_name)
+                found, magnitude = self._cached_magnitude(search_name, now)
+                if found:
+                    magnitudes[target_name] = magnitude
+                else:
+                    names_to_resolve.setdefault(search_name, []).append(target_name)
+
+        if not names_to_resolve:
+            return magnitudes
+
+        if self.offline:
+            for target_names_for_search in names_to_resolve.values():
+                for target_name in target_names_for_search:
+                    magnitudes[target_name] = self._offline_magnitude(target_name)
+            return magnitudes
+
+        try:
+            resolved = query_simbad_magnitudes(list(names_to_resolve.keys()))
+        except Exception as e:
+            # Don't cache failures of the query itself, only objects that Simbad answered for
+            logger.error('Simbad query failed for {targets}: {exception}'.format(targets=', '.join(names_to_resolve),
+                                                                                 exception=e))
+            for target_names_for_search in names_to_resolve.values():
+                for target_name in target_names_for_search:
+                    magnitudes[target_name] = np.nan
+            return magnitudes
+
+        with self._lock:
+            for search_name, target_names_for_search in names_to_resolve.items():
+                magnitude = resolved.get(search_name, np.nan)
+                self.cache[search_name] = {'mag': None if np.isnan(magnitude) else magnitude, 'time': now}
+                for target_name in target_names_for_search:
+                    magnitudes[target_name] = magnitude
+            self._save_cache()
+        return magnitudes
+
+    def get_magnitude(self, target_name):
+        return self.get_magnitudes([target_name])[target_name]
+
+
+def get_default_targets_filenames(data_reduction_root):
+    return sorted(glob(os.path.join(data_reduction_root, '*', 'nres*', 'reduced', 'csv', 'targets.csv')))
@@ -39,7 +39,7 @@ def run_celery_worker():
     wait_for_task_rabbitmq(settings.rabbitmq_host, settings.broker_username, settings.broker_password)
     logger.info('Starting celery worker')
     worker = celery.bin.worker.worker(app=tasks.app)
-    worker.run(concurrency=1, hostname='worker')
+    worker.run(concurrency=settings.worker_concurrency, hostname='worker')
 
 
 def stack_nres_calibrations():
@@ -35,10 +35,47 @@ ARCHIVE_AUTH_TOKEN = {'Authorization': f'Token {os.getenv("AUTH_TOKEN")}'}
 
 DO_INGEST = os.getenv('DO_INGEST', False)
 
+# Number of archive frames to download ahead of the one being reduced when processing a batch of frames
+archive_prefetch_count = int(os.getenv('ARCHIVE_PREFETCH_COUNT', 2))
+
 db_address = os.getenv('DB_URL', 'sqlite:///test.db')
 data_reduction_root = os.getenv('NRES_DATA_ROOT', './')
 do_radial_velocity = os.getenv('NRES_DO_RV', 1)
 
+# Keep warm IDL sessions (nres_idl_server.pro) for run_nres_pipeline instead of starting IDL for every frame
+use_idl_session_pool = os.getenv('NRES_IDL_SESSION_POOL', False)
+idl_session_max_jobs = int(os.getenv('NRES_IDL_SESSION_MAX_JOBS', 50))
+idl_session_job_timeout = int(os.getenv('NRES_IDL_SESSION_JOB_TIMEOUT', 3600))
+idl_session_health_check_interval = int(os.getenv('NRES_IDL_SESSION_HEALTH_CHECK_INTERVAL', 300))
+
+# Number of frames the main Celery worker processes in parallel. Frames from the same instrument still run
+# one at a time because they share the reduced/csv tables.
+worker_concurrency = int(os.getenv('NRES_WORKER_CONCURRENCY', 1))
+# Number of unacknowledged messages the listener takes off the fits exchange at once
+listener_prefetch_count = int(os.getenv('NRES_LISTENER_PREFETCH_COUNT', 1))
+# Maximum number of frames the listener sends to one process_archive_frames task, so the frames after the one
+# being reduced can be downloaded in the meantime. A batch is sent early as soon as the queue goes quiet.
+listener_batch_size = int(os.getenv('NRES_LISTENER_BATCH_SIZE', 10))
+# Frames take minutes each, so don't let one worker process reserve tasks that an idle process could run
+worker_prefetch_multiplier = 1
+
+# Number of processes used to read the summary pdfs out of reduced tarballs
+tarball_scan_processes = int(os.getenv('NRES_TARBALL_SCAN_PROCESSES', 4))
+# Cache of the member offsets of reduced tarballs, so later reads can seek straight to the summary pdf
+tarball_index_directory = os.getenv('NRES_TARBALL_INDEX_DIR', os.path.join(data_reduction_root, 'tarball_index'))
+
+# Cache of Simbad V magnitudes for the S/N reports. Magnitudes are kept for NRES_SIMBAD_CACHE_TTL seconds and
+# targets Simbad has no magnitude for are retried after NRES_SIMBAD_NEGATIVE_CACHE_TTL seconds.
+simbad_cache_filename = os.getenv('NRES_SIMBAD_CACHE', os.path.join(data_reduction_root, 'simbad_magnitudes.json'))
+simbad_cache_ttl = float(os.getenv('NRES_SIMBAD_CACHE_TTL', 30 * 86400))
+simbad_negative_cache_ttl = float(os.getenv('NRES_SIMBAD_NEGATIVE_CACHE_TTL', 86400))
+# Take magnitudes from targets.csv instead of querying Simbad. Defaults to the targets.csv files of every site.
+simbad_offline = os.getenv('NRES_SIMBAD_OFFLINE', False)
+simbad_offline_targets = os.getenv('NRES_SIMBAD_OFFLINE_TARGETS', '')
+
+# Initial offset grid used when refining trace0: 'full' (every pixel) or 'coarse_to_fine'
+trace_grid_search = os.getenv('NRES_TRACE_GRID_SEARCH', 'full')
+
 calibration_stack_delay_from_site_restart = int(os.getenv('CAL_STACK_DELAY', 4))
 
 blacklisted_filenames = ['g00', 'x00']
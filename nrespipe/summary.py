@@ -0,0 +1,183 @@
+import io
+import json
+import logging
+import os
+import tarfile
+from glob import glob
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+
+from nrespipe.utils import parse_signal_to_noise, read_pdfs_from_tarballs
+
+logger = logging.getLogger('nrespipe')
+
+
+def summary_directory(data_reduction_root, site, nres_instrument, dayobs):
+    """
+    Directory that holds the end of night summary pieces for one night
+
+    Parameters
+    ----------
+    data_reduction_root : str
+                          Top level directory for reduced data
+    site : str
+           Site ID (e.g. elp)
+    nres_instrument : str
+                      NRES instance (e.g. nres01)
+    dayobs : str
+             DAY-OBS of the frames (YYYYMMDD)
+
+    Returns
+    -------
+    directory : str
+    """
+    return os.path.join(data_reduction_root, site, nres_instrument, 'reduced', 'summary', dayobs)
+
+
+def _write_atomically(output_filename, data, mode='wb'):
+    # Write next to the final file and rename so the nightly job never sees a partial piece
+    temp_filename = output_filename + '.tmp'
+    with open(temp_filename, mode) as output_file:
+        output_file.write(data)
+    os.replace(temp_filename, output_filename)
+
+
+def add_frame_to_summary(tar_filename, data_reduction_root, site, nres_instrument, dayobs):
+    """
+    Save the summary plots and the S/N of a reduced frame as soon as its tarball is made
+
+    Parameters
+    ----------
+    tar_filename : str
+                   Full path to the tarball written by the IDL pipeline
+    data_reduction_root : str
+                          Top level directory for reduced data
+    site : str
+           Site ID (e.g. elp)
+    nres_instrument : str
+                      NRES instance (e.g. nres01)
+    dayobs : str
+             DAY-OBS of the frame (YYYYMMDD)
+
+    Returns
+    -------
+    added : bool
+            False if the tarball does not contain a summary pdf (e.g. stacked calibrations)
+
+    Notes
+    -----
+    The pdf from the tarball is saved as <basename>.pdf and the S/N row as <basename>.json in
+    summary_directory(). Adding the same frame again replaces its pieces. A tarball without a pdf leaves an
+    empty <basename>.nopdf marker so the end of night summary does not go back to it.
+    """
+    basename = os.path.basename(tar_filename).replace('.tar.gz', '')
+    pdf_member = '{basename}/{basename}.pdf'.format(basename=basename)
+    output_directory = summary_directory(data_reduction_root, site, nres_instrument, dayobs)
+    os.makedirs(output_directory, exist_ok=True)
+    try:
+        with tarfile.open(tar_filename) as open_tar_file:
+            pdf_data = open_tar_file.extractfile(pdf_member).read()
+    except KeyError:
+        logger.debug('No summary pdf in tarball', extra={'tags': {'filename': os.path.basename(tar_filename)}})
+        _write_atomically(os.path.join(output_directory, basename + '.nopdf'), b'')
+        return False
+
+    _write_atomically(os.path.join(output_directory, basename + '.pdf'), pdf_data)
+
+    signal_to_noise_row = parse_signal_to_noise(PdfFileReader(io.BytesIO(pdf_data)), site, dayobs)
+    if signal_to_noise_row is not None:
+        _write_atomically(os.path.join(output_directory, basename + '.json'), json.dumps(signal_to_noise_row), mode='w')
+    return True
+
+
+def has_summary(directory):
+    return len(glob(os.path.join(directory, '*.pdf'))) > 0
+
+
+def _frame_name(filename):
+    return os.path.basename(filename).split('.')[0]
+
+
+def tarballs_missing_from_summary(directory, specproc_directory):
+    """
+    Find the reduced tarballs of a night that have no pieces in the summary store
+
+    Parameters
+    ----------
+    directory : str
+                Summary directory for the night (see summary_directory())
+    specproc_directory : str
+                         Directory with the night's reduced .tar.gz files
+
+    Returns
+    -------
+    tar_files : list of str
+                Full paths to the tarballs, sorted by name
+
+    Notes
+    -----
+    Frames end up missing from the store when DO_INGEST is off (beammeup.txt is not claimed), when saving
+    the pieces failed, or when they were reduced before the store existed.
+    """
+    stored = {_frame_name(filename) for filename in glob(os.path.join(directory, '*.pdf'))}
+    stored |= {_frame_name(filename) for filename in glob(os.path.join(directory, '*.nopdf'))}
+    return [tar_filename for tar_filename in sorted(glob(os.path.join(specproc_directory, '*.tar.gz')))
+            if _frame_name(tar_filename) not in stored]
+
+
+def get_signal_to_noise_rows(directory, specproc_directory=None, site=None, dayobs=None):
+    """
+    Read the S/N rows saved for one night
+
+    Parameters
+    ----------
+    directory : str
+                Summary directory for the night (see summary_directory())
+    specproc_directory : str
+                         If given, the S/N of reduced tarballs that are missing from the store is read from
+                         their pdfs, labeled with site and dayobs. Their mag is nan, to be looked up by the caller.
+
+    Returns
+    -------
+    rows : list of dict
+           One row per frame with target, mag, sn, exptime, site and dayobs, sorted by frame name
+    """
+    rows = []
+    for row_filename in glob(os.path.join(directory, '*.json')):
+        with open(row_filename) as row_file:
+            rows.append((_frame_name(row_filename), json.load(row_file)))
+    if specproc_directory is not None:
+        tar_files = tarballs_missing_from_summary(directory, specproc_directory)
+        for tar_filename, pdf_data in read_pdfs_from_tarballs(tar_files):
+            row = parse_signal_to_noise(PdfFileReader(io.BytesIO(pdf_data)), site, dayobs, lookup_magnitude=False)
+            if row is not None:
+                rows.append((_frame_name(tar_filename), row))
+    return [row for frame_name, row in sorted(rows, key=lambda name_and_row: name_and_row[0])]
+
+
+def make_summary_pdf_from_store(directory, output_pdf_filename, specproc_directory=None):
+    """
+    Concatenate the pdfs saved for one night into the end of night summary
+
+    Parameters
+    ----------
+    directory : str
+                Summary directory for the night (see summary_directory())
+    output_pdf_filename : str
+                          Full path of the combined pdf
+    specproc_directory : str
+                         If given, the pdfs of reduced tarballs that are missing from the store are read from the
+                         tarballs and merged in
+    """
+    pdf_readers = [(_frame_name(pdf_filename), PdfFileReader(pdf_filename))
+                   for pdf_filename in glob(os.path.join(directory, '*.pdf'))]
+    if specproc_directory is not None:
+        tar_files = tarballs_missing_from_summary(directory, specproc_directory)
+        pdf_readers += [(_frame_name(tar_filename), PdfFileReader(io.BytesIO(pdf_data)))
+                        for tar_filename, pdf_data in read_pdfs_from_tarballs(tar_files)]
+
+    pdf_writer = PdfFileWriter()
+    for frame_name, pdf_reader in sorted(pdf_readers, key=lambda name_and_reader: name_and_reader[0]):
+        pdf_writer.appendPagesFromReader(pdf_reader)
+    with open(output_pdf_filename, 'wb') as output_stream:
+        pdf_writer.write(output_stream)
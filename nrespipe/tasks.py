@@ -16,10 +16,14 @@ import pkg_resources
 from nrespipe import dbs
 from nrespipe.utils import need_to_process, is_raw_nres_file, which_nres, date_range_to_idl, funpack, get_md5, get_files_from_night
 from nrespipe.utils import filename_is_blacklisted, measure_sources_from_raw
-from nrespipe.utils import warp_coordinates, send_email, make_summary_pdf, get_missing_files, make_signal_to_noise_pdf
-from nrespipe.utils import get_calibration_files_taken, download_from_s3, ingest_file
+from nrespipe.utils import warp_coordinates, send_email, get_missing_files, make_signal_to_noise_pdf
+from nrespipe.utils import get_calibration_files_taken, download_from_s3, ingest_file, instrument_lock
+from nrespipe.utils import prefetch_frames
 from nrespipe.traces import get_pixel_scale_ratio_and_rotation, fit_warping_polynomial, find_best_offset
 from nrespipe import settings
+from nrespipe.idl import IDLSessionPool, POOLED_PROCEDURES, idl_environment
+from nrespipe.summary import add_frame_to_summary, summary_directory, get_signal_to_noise_rows
+from nrespipe.summary import make_summary_pdf_from_store
 
 import numpy as np
 
@@ -31,40 +35,72 @@ app.config_from_object('nrespipe.settings')
 logger = logging.getLogger('nrespipe')
 idl_logger = logging.getLogger('idl')
 
+# IDL sessions are only started on first use, so each forked worker process gets its own
+idl_session_pool = IDLSessionPool(max_jobs_per_session=settings.idl_session_max_jobs,
+                                  job_timeout=settings.idl_session_job_timeout,
+                                  health_check_interval=settings.idl_session_health_check_interval)
+
 
 def run_idl(idl_procedure, args, data_reduction_root, site, nres_instrument):
-    os.environ['NRESROOT'] = os.path.join(data_reduction_root, site, '')
-    os.environ['NRESINST'] = os.path.join(nres_instrument, '')
-    cmd = 'idl -e {command} -quiet -args {args}'.format(command=idl_procedure, args=" ".join(args))
-    logger.info('Running the following idl command: {cmd}'.format(cmd=cmd))
-    cmd = shlex.split(cmd)
-    console_output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Jobs for the same instrument share the reduced/csv tables, so only one can run at a time
+    with instrument_lock(data_reduction_root, site, nres_instrument):
+        if settings.use_idl_session_pool and idl_procedure in POOLED_PROCEDURES:
+            logger.info('Running {procedure} in a warm IDL session with args: {args}'.format(procedure=idl_procedure,
+                                                                                             args=" ".join(args)))
+            returncode, stdout, stderr = idl_session_pool.run(idl_procedure, args, data_reduction_root, site,
+                                                              nres_instrument)
+        else:
+            cmd = 'idl -e {command} -quiet -args {args}'.format(command=idl_procedure, args=" ".join(args))
+            logger.info('Running the following idl command: {cmd}'.format(cmd=cmd))
+            cmd = shlex.split(cmd)
+            # Pass the environment to the child rather than setting os.environ so concurrent jobs don't interfere
+            console_output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            env=idl_environment(data_reduction_root, site, nres_instrument))
+            returncode = console_output.returncode
+            stdout = [message.decode() for message in console_output.stdout.splitlines()]
+            stderr = [message.decode() for message in console_output.stderr.splitlines()]
+
+        # Claim the upload list written by this job before the next job for this instrument can append to it
+        file_upload_list = os.path.join(data_reduction_root, site, nres_instrument, 'reduced', 'tar', 'beammeup.txt')
+        lines_to_upload = []
+        if settings.DO_INGEST and os.path.exists(file_upload_list):
+            with open(file_upload_list) as f:
+                lines_to_upload = f.read().splitlines()
+            os.remove(file_upload_list)
+
     logger.info('IDL NRES pipeline output:')
-    for message in console_output.stdout.splitlines():
-        idl_logger.info(message.decode())
-    if console_output.stderr:
+    for message in stdout:
+        idl_logger.info(message)
+    if stderr:
         logger.warning('IDL STDERR Output:')
-        for message in console_output.stderr.splitlines():
-            idl_logger.warning(message.decode())
-    if console_output.returncode > 0:
-        logger.error('IDL NRES pipeline returned with a non-zero exit status: {c}'.format(c=console_output.returncode))
-
-    file_upload_list = os.path.join(data_reduction_root, site, nres_instrument, 'reduced', 'tar', 'beammeup.txt')
-
-    if settings.DO_INGEST and os.path.exists(file_upload_list):
-        with open(file_upload_list) as f:
-            lines_to_upload = f.read().splitlines()
-            for line_to_upload in lines_to_upload:
-                file_to_upload, dayobs = line_to_upload.split()
-                ingest_file(file_path=file_to_upload)
-        os.remove(file_upload_list)
-    return console_output.returncode
-
-
-@app.task(max_retries=3, default_retry_delay=3 * 60)
-@metric_timer('nrespipe', async=False)
-def process_nres_file(file_info, data_reduction_root_path, db_address):
+        for message in stderr:
+            idl_logger.warning(message)
+    if returncode > 0:
+        logger.error('IDL NRES pipeline returned with a non-zero exit status: {c}'.format(c=returncode))
+
+    for line_to_upload in lines_to_upload:
+        file_to_upload, dayobs = line_to_upload.split()
+        # Save the pieces of the end of night summary now rather than reopening every tarball at the end of the night
+        if file_to_upload.endswith('.tar.gz'):
+            try:
+                add_frame_to_summary(file_to_upload, data_reduction_root, site, nres_instrument, dayobs)
+            except Exception as e:
+                logger.error('Could not add frame to the nightly summary: {exception}'.format(exception=e),
+                             extra={'tags': {'filename': os.path.basename(file_to_upload)}})
+        ingest_file(file_path=file_to_upload)
+    return returncode
+
+
+def get_file_to_process(file_info, db_address):
+    """
+    Decide whether a file delivered to the pipeline needs to be reduced
 
+    Returns
+    -------
+    file_to_process : tuple or None
+                      (filename, checksum, path) where path is None if the frame needs to be downloaded
+                      from the archive. None if the file should be skipped.
+    """
     # If the file_info is just a string, assume it is a full path to a file
     path = file_info.get('path')
     if path is not None:
@@ -90,23 +126,86 @@ def process_nres_file(file_info, data_reduction_root_path, db_address):
         logger.debug('NRES File already processed. Skipping...', extra={'tags': {'filename': filename}})
         return
 
+    return filename, checksum, path
+
+
+def reduce_nres_file(path, filename, checksum, frameid, temp_directory, data_reduction_root_path, db_address):
+    # For downloaded files, the checksum was calculated during the download, so this does not reread the file
+    if get_md5(path) != checksum:
+        logger.error('File does not match the expected checksum. Skipping...', extra={'tags': {'filename': filename}})
+        return
+
+    path = funpack(path, temp_directory)
+
+    header = fits.getheader(path)
+    if not is_raw_nres_file(header):
+        logger.debug('Not raw NRES file. Skipping...', extra={'tags': {'filename': filename}})
+        dbs.set_file_as_processed(filename, checksum, frameid=frameid, db_address=db_address)
+    else:
+        logger.info('Processing NRES file', extra={'tags': {'filename': filename}})
+        nres_site, nres_instrument = which_nres(path)
+        return_code = run_idl('run_nres_pipeline', [path, str(settings.do_radial_velocity)],
+                              data_reduction_root_path, nres_site, nres_instrument)
+        if return_code == 0:
+            dbs.set_file_as_processed(filename, checksum, frameid=frameid, db_address=db_address)
+
+
+@app.task(max_retries=3, default_retry_delay=3 * 60)
+@metric_timer('nrespipe', async=False)
+def process_nres_file(file_info, data_reduction_root_path, db_address):
+    file_to_process = get_file_to_process(file_info, db_address)
+    if file_to_process is None:
+        return
+    filename, checksum, path = file_to_process
+
     with tempfile.TemporaryDirectory() as temp_directory:
         if path is None:
             path = download_from_s3(file_info.get('frameid'), temp_directory)
+        reduce_nres_file(path, filename, checksum, file_info.get('frameid'), temp_directory,
+                         data_reduction_root_path, db_address)
 
-        path = funpack(path, temp_directory)
 
-        header = fits.getheader(path)
-        if not is_raw_nres_file(header):
-            logger.debug('Not raw NRES file. Skipping...', extra={'tags': {'filename': filename}})
-            dbs.set_file_as_processed(filename, checksum, frameid=file_info.get('frameid'), db_address=db_address)
+@app.task
+def process_archive_frames(file_infos, data_reduction_root_path, db_address):
+    """
+    Reduce a batch of frames from the archive, downloading the next few frames while the current one is in IDL
+
+    Notes
+    -----
+    The listener sends the frames it has queued up here in batches (see settings.listener_batch_size).
+    """
+    frames_to_process = {}
+    for file_info in file_infos:
+        try:
+            file_to_process = get_file_to_process(file_info, db_address)
+        except FileNotFoundError:
+            # Already logged. Don't let one missing file stop the rest of the batch.
+            continue
+        if file_to_process is None:
+            continue
+        filename, checksum, path = file_to_process
+        if path is not None:
+            # Files already on disk are reduced in place, not downloaded
+            with tempfile.TemporaryDirectory() as temp_directory:
+                reduce_nres_file(path, filename, checksum, file_info.get('frameid'), temp_directory,
+                                 data_reduction_root_path, db_address)
         else:
-            logger.info('Processing NRES file', extra={'tags': {'filename': filename}})
-            nres_site, nres_instrument = which_nres(path)
-            return_code = run_idl('run_nres_pipeline', [path, str(settings.do_radial_velocity)],
-                                  data_reduction_root_path, nres_site, nres_instrument)
-            if return_code == 0:
-                dbs.set_file_as_processed(filename, checksum, frameid=file_info.get('frameid'), db_address=db_address)
+            frames_to_process[file_info.get('frameid')] = file_to_process
+
+    with tempfile.TemporaryDirectory() as download_directory:
+        for frameid, download in prefetch_frames(frames_to_process.keys(), download_directory,
+                                                 n_ahead=settings.archive_prefetch_count):
+            filename, checksum, _ = frames_to_process[frameid]
+            try:
+                path = download.result()
+            except requests.RequestException as exception:
+                logger.error('Failed to download frame: {exception}'.format(exception=exception),
+                             extra={'tags': {'filename': filename}})
+                continue
+            with tempfile.TemporaryDirectory() as temp_directory:
+                reduce_nres_file(path, filename, checksum, frameid, temp_directory, data_reduction_root_path,
+                                 db_address)
+            os.remove(path)
 
 
 @app.task(max_retries=3, default_retry_delay=3 * 60)
@@ -227,13 +326,16 @@ def refine_trace0(site, camera, nres_instrument, raw_data_root, arc_file=None):
     reference_catalog = ascii.read(reference_catalog_filename, format='fast_basic')
 
     # Calculate the scale between the two images and hope the distortion is small
-    scale_guess = get_pixel_scale_ratio_and_rotation(sources, reference_catalog)
-    logger.info('Initial guess for scale = {scale}'.format(scale=scale_guess))
+    scale_and_rotation = get_pixel_scale_ratio_and_rotation(sources, reference_catalog)
+    scale_guess = scale_and_rotation['scale']
+    logger.info('Initial guess for scale = {scale}, rotation = {rotation}, significance = {significance}'.format(
+        **scale_and_rotation))
 
     offset_guess = find_best_offset(sources, reference_catalog, scale_guess)
     logger.info('Initial guess for offset = ({x}, {y})'.format(x=offset_guess['x'], y=offset_guess['y']))
 
-    best_fit_coeffs = fit_warping_polynomial(sources, reference_catalog, scale_guess, offset_guess, polynomial_order=3)
+    best_fit_coeffs = fit_warping_polynomial(sources, reference_catalog, scale_guess, offset_guess, polynomial_order=3,
+                                             grid_search=settings.trace_grid_search)
 
     # Use the best fit transformation to transform the input positions measured by hand to make a trace0 file for the IDL pipeline
     # Read in the original trace0 text file
@@ -305,7 +407,10 @@ def send_end_of_night_summary_plots(sites, instruments, sender_email, sender_pas
         specproc_directory = '{raw_data_root}/{site}/{instrument}/{dayobs}/specproc'
         specproc_directory = specproc_directory.format(raw_data_root=raw_data_root, site=site, instrument=instrument, dayobs=dayobs)
 
-        make_summary_pdf(specproc_directory, pdf_filename)
+        # Frames reduced by this pipeline saved their summary pages as they finished. Any other frames
+        # in specproc are read from their tarballs and merged in.
+        night_summary_directory = summary_directory(settings.data_reduction_root, site, instrument, dayobs)
+        make_summary_pdf_from_store(night_summary_directory, pdf_filename, specproc_directory=specproc_directory)
         if os.path.exists(pdf_filename):
             attachments.append(pdf_filename)
 
@@ -336,7 +441,13 @@ def send_end_of_night_summary_plots(sites, instruments, sender_email, sender_pas
                              for site, instrument in zip(sites, instruments)]
 
     output_pdf_filename = '{raw_data_root}/nres/plots/nres_sn_{dayobs}.pdf'.format(raw_data_root=raw_data_root, dayobs=dayobs)
-    make_signal_to_noise_pdf(input_directories, sites, [dayobs] * len(sites), output_text_filenames, output_pdf_filename)
+    signal_to_noise_rows = []
+    for site, instrument, input_directory in zip(sites, instruments, input_directories):
+        night_summary_directory = summary_directory(settings.data_reduction_root, site, instrument, dayobs)
+        signal_to_noise_rows.append(get_signal_to_noise_rows(night_summary_directory, specproc_directory=input_directory,
+                                                             site=site, dayobs=dayobs))
+    make_signal_to_noise_pdf(input_directories, sites, [dayobs] * len(sites), output_text_filenames, output_pdf_filename,
+                             signal_to_noise_rows=signal_to_noise_rows)
     attachments.insert(0, output_pdf_filename)
     # Send an email with the end of night plots
     send_email('NRES Nightly Summary {dayobs}'.format(dayobs=dayobs), recipient_emails, sender_email, sender_password,
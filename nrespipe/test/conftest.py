@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The Python ports of the IDL pipeline are plain modules at the top of the repository and in csv/, imported
+# by module name as the pipeline does
+repository_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+for path in [os.path.join(repository_root, 'csv'), repository_root]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
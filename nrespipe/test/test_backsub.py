@@ -0,0 +1,162 @@
+import time
+import numpy as np
+import pytest
+import backsub
+
+
+def literal_order_mask(shape, ovec, owid, objects):
+    # The order and fiber loop of backsub.pro
+    ny, nx = shape
+    cowid = int(np.ceil(owid))
+    mask = np.zeros(shape, dtype=bool)
+    for i in range(ovec.shape[1]):
+        for j in range(ovec.shape[2]):
+            if objects[j].strip().upper() in ('NONE', 'NULL'):
+                continue
+            # each order is done for all x at once, as in IDL
+            rows = np.trunc(ovec[:, i, j] - owid / 2.).astype(int)[:, np.newaxis] + np.arange(cowid)
+            columns = np.broadcast_to(np.arange(nx)[:, np.newaxis], rows.shape)
+            legal = (rows >= 0) & (rows < ny)
+            mask[rows[legal], columns[legal]] = True
+    return mask
+
+
+def synthetic_frame(ny, nx, nord, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:ny, 0:nx]
+    backg = 50. + 10. * np.sin(x / (nx / 2.)) + 5. * y / float(ny)
+    ovec = np.zeros((nx, nord, 3))
+    xx = np.arange(nx)
+    for i in range(nord):
+        for j in range(3):
+            ovec[:, i, j] = 20. + i * (ny - 40.) / nord + j * 14. + 10. * ((xx - nx / 2.) / (nx / 2.)) ** 2
+    dat = backg + rng.normal(0., 1., (ny, nx))
+    mask = backsub.order_mask(dat.shape, ovec, 10.5, ['thar', 'star', 'thar'])
+    dat[mask] += 1000.
+    return dat, backg, ovec, mask
+
+
+def test_order_mask_non_square():
+    ny, nx = 160, 96
+    xx = np.arange(nx)
+    ovec = np.zeros((nx, 3, 3))
+    for i in range(3):
+        for j in range(3):
+            # the first order runs off the bottom of the detector, and the last off the top
+            ovec[:, i, j] = -3. + i * 70. + j * 12. + 0.05 * xx
+    objects = ['thar', 'none', 'HD1']
+    mask = backsub.order_mask((ny, nx), ovec, 10.5, objects)
+    assert mask.shape == (ny, nx)
+    np.testing.assert_array_equal(mask, literal_order_mask((ny, nx), ovec, 10.5, objects))
+    assert mask[0].any() and mask[-1].any()
+    assert not backsub.order_mask((ny, nx), ovec, 10.5, ['none', 'null', 'none']).any()
+
+
+@pytest.mark.parametrize('estimator', backsub.estimators)
+def test_background_estimators(estimator):
+    # Not square, and orders masked over much of the frame
+    dat, backg, ovec, mask = synthetic_frame(256, 512, 3)
+    estimate, nfilled = backsub.background(dat, mask, 17, estimator=estimator)
+    assert estimate.shape == dat.shape
+    assert nfilled == 0
+    # Well inside the frame every estimator follows the smooth background
+    inner = (slice(32, -32), slice(32, -32))
+    assert np.abs(estimate - backg)[inner].mean() < 0.5
+    assert np.abs(estimate - backg)[inner].max() < 1.
+
+
+def test_background_rejects_unknown_estimator():
+    with pytest.raises(ValueError):
+        backsub.background(np.zeros((8, 8)), np.zeros((8, 8), dtype=bool), 3, estimator='mean')
+
+
+def test_backsub():
+    dat, backg, ovec, mask = synthetic_frame(256, 512, 3)
+    result, nfilled = backsub.backsub(dat, ovec, 10.5, 3, 17, ['thar', 'star', 'thar'])
+    assert nfilled == 0
+    assert np.abs(np.median(result[32:-32, 32:-32][~mask[32:-32, 32:-32]])) < 0.2
+
+
+def test_backsub_raises_on_non_finite_results():
+    dat, backg, ovec, mask = synthetic_frame(64, 64, 2)
+    dat[10, 10] = np.inf
+    with pytest.raises(RuntimeError):
+        backsub.backsub(dat, ovec, 10.5, 3, 5, ['thar', 'star', 'thar'])
+
+
+def test_fill_bad():
+    backg = np.arange(200 * 300, dtype=float).reshape(200, 300)
+    filled, nbad = backsub.fill_bad(backg.copy())
+    assert nbad == 0
+    np.testing.assert_array_equal(filled, backg)
+
+    filled = backg.copy()
+    filled[100:110, 150:160] = np.nan
+    filled, nbad = backsub.fill_bad(filled, box=50)
+    assert nbad == 100
+    # The median of the box around the bad values, extended by 50 on each side
+    box = backg[50:160, 100:210].copy()
+    box[50:60, 50:60] = np.nan
+    np.testing.assert_allclose(filled[100:110, 150:160], np.nanmedian(box))
+    np.testing.assert_array_equal(np.delete(filled, np.s_[100:110], axis=0), np.delete(backg, np.s_[100:110], axis=0))
+
+    # With nothing good to take the median of, the value is 10
+    filled, nbad = backsub.fill_bad(np.full((20, 20), np.nan))
+    assert nbad == 400
+    assert (filled == 10.).all()
+
+
+def literal_backsub(dat, ovec, owid, nfib, nwid, objects):
+    # backsub.pro step by step: mask, rebin by 4, embed in an array padded with copies of the edge strips,
+    # nwid x nwid median ignoring NaNs, expand with IDL rebin, fill non-finite values.
+    ny, nx = dat.shape
+    t = np.where(literal_order_mask(dat.shape, ovec[:, :, :nfib], owid, objects[:nfib]), np.nan, dat)
+    tc = t.reshape(ny // 4, 4, nx // 4, 4).mean(axis=(1, 3))
+    ny, nx = tc.shape
+    nxtra = max(int(np.ceil(owid)), nwid) + 1
+    tco = np.zeros((ny + 2 * nxtra, nx + 2 * nxtra))
+    tco[nxtra:ny + nxtra, nxtra:nx + nxtra] = tc
+    tco[nxtra:ny + nxtra, :nxtra] = tc[:, :nxtra]
+    tco[nxtra:ny + nxtra, nx + nxtra:] = tc[:, nx - nxtra:]
+    tco[:nxtra, nxtra:nx + nxtra] = tc[:nxtra]
+    tco[ny + nxtra - 1:, nxtra:nx + nxtra] = tc[ny - nxtra - 1:]
+    tco[:nxtra, :nxtra] = tc[:nxtra, :nxtra]
+    tco[:nxtra, nx + nxtra:] = tc[:nxtra, nx - nxtra:]
+    tco[ny + nxtra - 1:, :nxtra] = tc[ny - nxtra - 1:, :nxtra]
+    tco[ny + nxtra - 1:, nx + nxtra:] = tc[ny - nxtra - 1:, nx - nxtra:]
+    half = nwid // 2
+    tcf = np.empty((ny, nx))
+    with np.errstate(all='ignore'):
+        for row in range(ny):
+            windows = np.lib.stride_tricks.sliding_window_view(
+                tco[nxtra + row - half:nxtra + row - half + nwid], (nwid, nwid))[0, nxtra - half:nxtra - half + nx]
+            tcf[row] = backsub._nanmedian(windows.reshape(nx, -1), axis=1)
+    # IDL rebin to 4 times the size interpolates linearly from the corner of each rebinned pixel
+    rows = np.array([np.interp(np.arange(4 * nx) / 4., np.arange(nx), line) for line in tcf])
+    backg = np.array([np.interp(np.arange(4 * ny) / 4., np.arange(ny), column) for column in rows.T]).T
+    backg, nbad = backsub.fill_bad(backg)
+    return dat - backg
+
+
+@pytest.mark.slow
+def test_benchmark_against_backsub_pro():
+    # A full size NRES frame
+    dat, backg, ovec, mask = synthetic_frame(4096, 4096, 67)
+    objects = ['thar', 'star', 'thar']
+    start = time.perf_counter()
+    expected = literal_backsub(dat, ovec, 10.5, 3, 17, objects)
+    literal_time = time.perf_counter() - start
+    inner = (slice(256, -256), slice(256, -256))
+    print('\nbacksub.pro step by step: {time:.2f} s'.format(time=literal_time))
+    for estimator in backsub.estimators:
+        start = time.perf_counter()
+        result, nfilled = backsub.backsub(dat, ovec, 10.5, 3, 17, objects, estimator=estimator)
+        elapsed = time.perf_counter() - start
+        difference = np.abs(result - expected)[inner][~mask[inner]]
+        print('{estimator:>10}: {time:.2f} s, mean difference {difference:.3f}'.format(
+            estimator=estimator, time=elapsed, difference=difference.mean()))
+        # The rebinned pixel centers differ by 1.5 pixels from IDL rebin, which hardly matters for a smooth
+        # background
+        assert difference.mean() < 1.
+        if estimator == 'median':
+            assert elapsed < literal_time
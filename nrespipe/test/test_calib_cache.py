@@ -0,0 +1,139 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+import calib_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(calib_cache, 'shared_dir', '')
+    calib_cache.clear()
+    yield
+    calib_cache.clear()
+
+
+def write_calib(path, data):
+    fits.PrimaryHDU(data).writeto(path, overwrite=True)
+    return path
+
+
+def cached_paths():
+    return [os.path.basename(key[0]) for key in calib_cache.cache]
+
+
+def test_getdata_caches_read_only(tmpdir):
+    path = write_calib(str(tmpdir.join('bias.fits')), np.arange(12.).reshape(3, 4))
+    data, header = calib_cache.getdata(path)
+    np.testing.assert_array_equal(data, np.arange(12.).reshape(3, 4))
+    assert not data.flags.writeable
+    # The second read comes from the cache
+    assert calib_cache.getdata(path)[0] is data
+    assert calib_cache.nbytes == data.nbytes
+
+
+def test_lru_eviction_at_size_limit(tmpdir, monkeypatch):
+    # Room for two 100x100 float images, but not three
+    monkeypatch.setattr(calib_cache, 'maxbytes', int(2.5 * 100 * 100 * 8))
+    paths = [write_calib(str(tmpdir.join(name)), np.full((100, 100), i, dtype=float))
+             for i, name in enumerate(['bias.fits', 'dark.fits', 'flat.fits'])]
+    calib_cache.getdata(paths[0])
+    calib_cache.getdata(paths[1])
+    # Use the bias again, so the dark is now the least recently used
+    calib_cache.getdata(paths[0])
+    calib_cache.getdata(paths[2])
+    assert cached_paths() == ['bias.fits', 'flat.fits']
+    assert calib_cache.nbytes == 2 * 100 * 100 * 8
+
+    # A single file over the limit is still kept
+    monkeypatch.setattr(calib_cache, 'maxbytes', 1000)
+    calib_cache.getdata(paths[1])
+    assert cached_paths() == ['dark.fits']
+    assert calib_cache.nbytes == 100 * 100 * 8
+
+
+def test_invalidated_by_mtime_change(tmpdir):
+    path = write_calib(str(tmpdir.join('bias.fits')), np.zeros((10, 10)))
+    calib_cache.getdata(path)
+    # Same size, new contents and modification time
+    write_calib(path, np.ones((10, 10)))
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    data, header = calib_cache.getdata(path)
+    np.testing.assert_array_equal(data, np.ones((10, 10)))
+    # The old version is dropped, not just superseded
+    assert len(calib_cache.cache) == 1
+    assert calib_cache.nbytes == data.nbytes
+
+
+def test_invalidated_by_size_change(tmpdir):
+    path = write_calib(str(tmpdir.join('bias.fits')), np.zeros((10, 10)))
+    mtime_ns = os.stat(path).st_mtime_ns
+    calib_cache.getdata(path)
+    # New size, with the modification time put back
+    write_calib(path, np.ones((100, 100)))
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    data, header = calib_cache.getdata(path)
+    assert data.shape == (100, 100)
+    assert len(calib_cache.cache) == 1
+    assert calib_cache.nbytes == data.nbytes
+
+
+def shared_files(shared_dir):
+    return sorted(os.listdir(shared_dir))
+
+
+def test_shared_write_and_reread(tmpdir, monkeypatch):
+    shared_dir = str(tmpdir.join('shm'))
+    monkeypatch.setattr(calib_cache, 'shared_dir', shared_dir)
+    # Unsigned 16 bit data is stored as signed integers with BZERO = 32768
+    expected = np.arange(12, dtype=np.uint16).reshape(3, 4) + 60000
+    path = write_calib(str(tmpdir.join('bias.fits')), expected)
+    expected_header = fits.getheader(path)
+    assert expected_header['BZERO'] == 32768
+
+    data, header = calib_cache.getdata(path)
+    assert isinstance(data, np.memmap) and not data.flags.writeable
+    assert data.dtype == np.uint16
+    np.testing.assert_array_equal(data, expected)
+    # Only the .npy and .hdr files are left, not the temporary ones they were written as
+    names = shared_files(shared_dir)
+    assert [os.path.splitext(name)[1] for name in names] == ['.hdr', '.npy']
+    assert len(set(os.path.splitext(name)[0] for name in names)) == 1
+
+    # Another process maps the saved copy instead of reading the FITS file
+    calib_cache.clear()
+    monkeypatch.setattr(fits, 'getdata', None)
+    data, header = calib_cache.getdata(path)
+    assert isinstance(data, np.memmap) and not data.flags.writeable
+    assert data.dtype == np.uint16
+    np.testing.assert_array_equal(data, expected)
+    assert header['BZERO'] == 32768 and header['BSCALE'] == 1
+    assert header.tostring() == expected_header.tostring()
+    assert shared_files(shared_dir) == names
+
+
+def test_shared_old_versions_removed(tmpdir, monkeypatch):
+    shared_dir = str(tmpdir.join('shm'))
+    monkeypatch.setattr(calib_cache, 'shared_dir', shared_dir)
+    path = write_calib(str(tmpdir.join('bias.fits')), np.zeros((10, 10)))
+    other_path = write_calib(str(tmpdir.join('dark.fits')), np.zeros((10, 10)))
+    calib_cache.getdata(path)
+    calib_cache.getdata(other_path)
+    old_names = shared_files(shared_dir)
+    assert len(old_names) == 4
+
+    # Same size, new contents and modification time
+    write_calib(path, np.ones((10, 10)))
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    data, header = calib_cache.getdata(path)
+    np.testing.assert_array_equal(data, np.ones((10, 10)))
+    names = shared_files(shared_dir)
+    # The old copy of the bias is gone and the dark is untouched
+    assert len(names) == 4
+    assert len(set(names) & set(old_names)) == 2
+    shared_filename = os.path.basename(calib_cache._shared_filename(calib_cache._key(path)))
+    assert sorted(set(names) - set(old_names)) == [shared_filename + '.hdr', shared_filename + '.npy']
+
+    # A new process reads the new version
+    calib_cache.clear()
+    np.testing.assert_array_equal(calib_cache.getdata(path)[0], np.ones((10, 10)))
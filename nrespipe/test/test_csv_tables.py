@@ -0,0 +1,85 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import csv_tables
+
+csv_directory = os.path.join(os.path.dirname(__file__), '..', '..', 'csv')
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(csv_tables, 'tables', {})
+
+
+def test_read_standards():
+    header, data = csv_tables.read_table(os.path.join(csv_directory, 'standards.csv'), csv_tables.standards_columns)
+    assert data.dtype.names == ('type', 'fname', 'navg', 'site', 'camera', 'jdate', 'flag')
+    assert len(data) == 1
+    assert data['type'][0] == 'xxxx' and data['site'][0] == 'xxx'
+    assert data['navg'].dtype == np.int64 and data['navg'][0] == 1
+    assert data['jdate'].dtype == np.float64 and data['jdate'][0] == 0.
+
+
+def test_read_zeros():
+    header, data = csv_tables.read_table(os.path.join(csv_directory, 'zeros.csv'), csv_tables.zeros_columns)
+    assert header[:2] == ['Filename', 'Navg']
+    assert len(data) == 1
+    assert data['fname'][0] == 'xxxx/xxxxxxxxxxxxxxxxxxxx.fits'
+    assert data['targname'][0] == 'xxxxxxx' and data['flag'][0] == 'xxxx'
+    assert data['navg'][0] == 0 and data['teff'][0] == 0.
+
+
+def test_read_targets():
+    header, data = csv_tables.read_table(os.path.join(csv_directory, 'targets.csv'), csv_tables.targets_columns)
+    assert header[0] == 'Name' and header[-1] == 'ZERO'
+    assert len(data) == 248
+    assert data['name'][0] == 'HD1461'
+    np.testing.assert_allclose([data['ra'][0], data['dec'][0], data['vmag'][0], data['teff'][0]],
+                               [4.67445, -8.05300, 6.460, 5657.])
+    assert data['gmag'][0] == -99.9
+    assert data['zero'][0] == 'NULL'
+    assert data['ra'].dtype == np.float64
+
+
+def test_read_rv():
+    header, data = csv_tables.read_table(os.path.join(csv_directory, 'rv.csv'), csv_tables.rv_columns)
+    assert len(data) == 1
+    assert data['targname'][0] == 'xxxxxxxxxx'
+    assert data['nmatch'].dtype == np.int64 and data['nmatch'][0] == 0
+    assert data['rroe'][0] == 0.
+
+
+def test_unparseable_values_and_short_lines(tmpdir):
+    csv_file = str(tmpdir.join('standards.csv'))
+    with open(csv_file, 'w') as outfile:
+        outfile.write('Type,Filename,Navg,Site,Camera,JDdata,Flags\n')
+        outfile.write('BIAS,bias/a.fits,,lsc,fa09,,0000\n')
+        outfile.write('BIAS,bias/b.fits,1\n')
+    header, data = csv_tables.read_table(csv_file, csv_tables.standards_columns)
+    assert len(data) == 1
+    assert data['navg'][0] == 0
+    assert np.isnan(data['jdate'][0])
+
+
+def test_read_columns():
+    values = csv_tables.read_columns(os.path.join(csv_directory, 'standards.csv'), csv_tables.standards_columns)
+    assert len(values) == len(csv_tables.standards_columns) + 1
+    assert values[0][0] == 'xxxx'
+    assert values[-1][0] == 'Type'
+
+
+def test_cache_invalidation(tmpdir):
+    csv_file = str(tmpdir.join('targets.csv'))
+    shutil.copy(os.path.join(csv_directory, 'targets.csv'), csv_file)
+    header, data = csv_tables.read_table(csv_file, csv_tables.targets_columns)
+    assert not data.flags.writeable
+    # Unchanged, so the same array comes back
+    assert csv_tables.read_table(csv_file, csv_tables.targets_columns)[1] is data
+
+    with open(csv_file, 'a') as outfile:
+        outfile.write('"HD999",1.0,2.0,3.0,4.0,-99.9,-99.9,-99.9,5.0,6.0,0.0,0.0,0.0,0.0,5000,4.5,"NULL"\n')
+    header, new_data = csv_tables.read_table(csv_file, csv_tables.targets_columns)
+    assert new_data is not data
+    assert len(new_data) == len(data) + 1
+    assert new_data['name'][-1] == 'HD999'
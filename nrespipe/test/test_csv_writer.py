@@ -0,0 +1,88 @@
+import json
+import multiprocessing
+import os
+import csv_writer
+
+header = ['Name', 'Time', 'Flags']
+
+
+def read_table(csv_file):
+    with open(csv_file) as infile:
+        return infile.read().splitlines()
+
+
+def add_lines(csv_file, worker, nlines):
+    for i in range(nlines):
+        csv_writer.append_rows(csv_file, header, [('w{worker}-{i}'.format(worker=worker, i=i), 1000 * worker + i,
+                                                   '0000')], 1)
+
+
+def test_concurrent_appends_under_the_lock(tmpdir):
+    csv_file = str(tmpdir.join('table.csv'))
+    workers = [multiprocessing.Process(target=add_lines, args=(csv_file, worker, 25)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    lines = read_table(csv_file)
+    assert lines[0] == 'Name,Time,Flags'
+    # Every line made it, whole, exactly once
+    names = [csv_writer.parse_line(line)[0] for line in lines[1:]]
+    assert sorted(names) == sorted('w{worker}-{i}'.format(worker=worker, i=i) for worker in range(4) for i in range(25))
+    assert all(len(csv_writer.parse_line(line)) == 3 for line in lines[1:])
+
+
+def test_in_order_appends_are_not_compacted(tmpdir, monkeypatch):
+    monkeypatch.setattr(csv_writer, 'compact_every', 3)
+    csv_file = str(tmpdir.join('table.csv'))
+    csv_writer.append_rows(csv_file, header, [('a', 1.0, '0'), ('b', 2.0, '0')], 1)
+    csv_writer.append_rows(csv_file, header, [('c', 3.0, '0')], 1)
+    with open(csv_file + '.journal') as journal_file:
+        journal = json.load(journal_file)
+    assert journal['last_key'] == [0, 3.0] and journal['unsorted'] == 0
+    assert read_table(csv_file)[1:] == ['a,1.0,0', 'b,2.0,0', 'c,3.0,0']
+
+
+def test_journal_compaction(tmpdir, monkeypatch):
+    monkeypatch.setattr(csv_writer, 'compact_every', 3)
+    csv_file = str(tmpdir.join('table.csv'))
+    csv_writer.append_rows(csv_file, header, [('c', 3.0, '0')], 1)
+    # Out of order lines are left at the end until there are compact_every of them
+    csv_writer.append_rows(csv_file, header, [('a', 1.0, '0'), ('b', 2.0, '0')], 1)
+    assert read_table(csv_file)[1:] == ['c,3.0,0', 'a,1.0,0', 'b,2.0,0']
+    csv_writer.append_rows(csv_file, header, [('d', 4.0, '0')], 1)
+    assert read_table(csv_file)[1:] == ['a,1.0,0', 'b,2.0,0', 'c,3.0,0', 'd,4.0,0']
+    with open(csv_file + '.journal') as journal_file:
+        assert json.load(journal_file)['unsorted'] == 0
+
+
+def test_outside_changes_force_compaction(tmpdir):
+    csv_file = str(tmpdir.join('table.csv'))
+    csv_writer.append_rows(csv_file, header, [('b', 2.0, '0')], 1)
+    # e.g. the IDL pipeline appends without the lock, and without a final newline
+    with open(csv_file, 'a') as outfile:
+        outfile.write('c,3.0,0')
+    csv_writer.append_rows(csv_file, header, [('a', 1.0, '0')], 1)
+    assert read_table(csv_file)[1:] == ['a,1.0,0', 'b,2.0,0', 'c,3.0,0']
+
+
+def test_atomic_rewrite_preserves_content(tmpdir):
+    csv_file = str(tmpdir.join('table.csv'))
+    csv_writer.append_rows(csv_file, header, [('a', 1.0, '0')], 1)
+    with open(csv_file) as reader:
+        rows = [('"quoted"', 2.0, '0001'), ('comma, in name', 3.0, '0000')]
+        csv_writer.rewrite(csv_file, header, rows)
+        # A reader that opened the table before the rename still sees the whole old table
+        assert reader.read().splitlines() == ['Name,Time,Flags', 'a,1.0,0']
+    lines = read_table(csv_file)
+    assert [csv_writer.parse_line(line) for line in lines[1:]] == [[str(value) for value in row] for row in rows]
+    # Nothing is left behind but the table and its lock
+    assert sorted(os.listdir(str(tmpdir))) == ['table.csv', 'table.csv.lock']
+
+
+def test_remove_rows(tmpdir):
+    csv_file = str(tmpdir.join('table.csv'))
+    csv_writer.append_rows(csv_file, header, [('a', 1.0, '0'), ('b', 2.0, '0'), ('c', 3.0, '0')], 1)
+    csv_writer.remove_rows(csv_file, 0, [' b '])
+    assert read_table(csv_file) == ['Name,Time,Flags', 'a,1.0,0', 'c,3.0,0']
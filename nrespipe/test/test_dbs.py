@@ -0,0 +1,40 @@
+import os
+from nrespipe import dbs
+
+
+def make_db(tmpdir):
+    db_address = 'sqlite:///' + os.path.join(str(tmpdir), 'test.db')
+    dbs.create_db(db_address)
+    return db_address
+
+
+def test_engine_is_reused(tmpdir):
+    db_address = make_db(tmpdir)
+    assert dbs.get_engine(db_address) is dbs.get_engine(db_address)
+
+
+def test_set_file_as_processed_inserts_and_updates(tmpdir):
+    db_address = make_db(tmpdir)
+    dbs.set_file_as_processed('lscnrs01-fl09-20180101-0001-e00.fits.fz', 'a' * 32, 1234, db_address)
+    record = dbs.get_processing_state('lscnrs01-fl09-20180101-0001-e00.fits.fz', 'a' * 32, db_address)
+    assert record.processed
+    assert record.frameid == 1234
+
+    dbs.set_file_as_processed('lscnrs01-fl09-20180101-0001-e00.fits.fz', 'b' * 32, None, db_address)
+    states = dbs.get_processing_states(['lscnrs01-fl09-20180101-0001-e00.fits.fz'], db_address)
+    assert len(states) == 1
+    record = states['lscnrs01-fl09-20180101-0001-e00.fits.fz']
+    assert record.checksum == 'b' * 32
+    assert record.processed
+    assert record.frameid is None
+
+
+def test_get_processing_states_in_chunks(tmpdir):
+    db_address = make_db(tmpdir)
+    filenames = ['lscnrs01-fl09-20180101-{i:04d}-e00.fits.fz'.format(i=i) for i in range(25)]
+    for filename in filenames[::2]:
+        dbs.set_file_as_processed(filename, '0' * 32, None, db_address)
+
+    states = dbs.get_processing_states(filenames, db_address, chunk_size=4)
+    assert sorted(states.keys()) == sorted(filenames[::2])
+    assert all(state.processed for state in states.values())
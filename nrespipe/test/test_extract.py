@@ -0,0 +1,363 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+import extract
+
+
+def literal_shift_profiles(rprofile, orddy):
+    # The per order, fiber, x and y loop of extract.pro
+    cowid, nord, mfib, nx = rprofile.shape
+    ofprofile = np.zeros((cowid + 4, nord, mfib, nx))
+    ofprofile[2:cowid + 2] = rprofile
+
+    def value(row, i, j, x):
+        return ofprofile[row, i, j, x] if 0 <= row < cowid + 4 else 0.
+
+    sprofile = np.zeros(rprofile.shape, dtype=np.float32)
+    for i in range(nord):
+        for j in range(mfib):
+            for x in range(nx):
+                iddy = int(np.floor(orddy[i, j, x]))
+                sddy = iddy - orddy[i, j, x]
+                pddy = sddy + 1.
+                for k in range(cowid):
+                    sy = k + 1 - iddy
+                    summ = (value(sy, i, j, x) * sddy * (sddy - 1.) / 2. -
+                            value(sy + 1, i, j, x) * (sddy + 1.) * (sddy - 1.) +
+                            value(sy + 2, i, j, x) * sddy * (sddy + 1.) / 2.)
+                    sump = (value(sy - 1, i, j, x) * pddy * (pddy - 1.) / 2. -
+                            value(sy, i, j, x) * (pddy + 1.) * (pddy - 1.) +
+                            value(sy + 1, i, j, x) * pddy * (pddy + 1.) / 2.)
+                    sprofile[k, i, j, x] = (summ + sump) / 2.
+    return sprofile
+
+
+def test_shift_profiles_matches_literal_loop():
+    rng = np.random.default_rng(1)
+    rprofile = rng.random((11, 4, 2, 50)).astype(np.float32)
+    orddy = rng.uniform(-1.5, 1.5, (4, 2, 50))
+    expected = literal_shift_profiles(rprofile, orddy)
+    assert np.abs(extract.shift_profiles(rprofile, orddy) - expected).max() < 2e-7
+    # The single whole-pixel shift shortcut
+    orddy = np.full((4, 2, 50), 0.3) + rng.uniform(0., 0.5, (4, 2, 50))
+    assert np.abs(extract.shift_profiles(rprofile, orddy) - literal_shift_profiles(rprofile, orddy)).max() < 2e-7
+
+
+def test_extlstsq_matches_linalg_solve():
+    rng = np.random.default_rng(2)
+    sprofile, dfpdy, d2fpdy2, ebo, vbo = [rng.random((11, 4, 2, 50)).astype(np.float32) for i in range(5)]
+    ewts = sprofile ** 2 / np.maximum(vbo, 1.)
+    fitc = extract.extlstsq(sprofile, dfpdy, d2fpdy2, ebo, vbo, ewts)
+
+    funs = np.stack([sprofile, dfpdy, d2fpdy2], axis=-1).astype(float)
+    alpha = np.einsum('k...i,k...j,k...->...ij', funs, funs, ewts)
+    beta = np.einsum('k...i,k...,k...->...i', funs, ebo, ewts)
+    cc = np.linalg.solve(alpha, beta[..., np.newaxis])[..., 0]
+    positive = cc[..., 0] > 0.
+    np.testing.assert_allclose(fitc[0], cc[..., 0], rtol=1e-4, atol=1e-4 * np.abs(cc[..., 0]).max())
+    np.testing.assert_allclose(fitc[2], np.where(positive, cc[..., 1] / np.where(positive, cc[..., 0], 1.), cc[..., 1]),
+                               rtol=1e-3, atol=1e-4)
+    np.testing.assert_allclose(fitc[4], np.sqrt(vbo.sum(axis=0)), rtol=1e-6)
+    assert (fitc[1] == 0.).all()
+
+
+def test_order_cen_matches_legendre_per_order():
+    rng = np.random.default_rng(3)
+    trace = rng.normal(size=(2, 5, 4))
+    ord_vectors = extract.order_cen(trace, 256)
+    x = 2. * (np.arange(256) - 128.) / 256.
+    for j in range(2):
+        for i in range(5):
+            np.testing.assert_allclose(ord_vectors[:, i, j], np.polynomial.legendre.legval(x, trace[j, i]))
+    assert (ord_vectors[:, :, 2] == 0.).all()
+
+
+def synthetic_frame(shift=0., nx=512, ny=512, nord=5, sigma=1.5, cowid=11, nblock=4, brightness=(1., 1., 1.)):
+    # Three fibers of gaussian orders, all with the same spectrum scaled by brightness
+    trace = np.zeros((3, nord, 5))
+    trace[:, :, 0] = 60. + np.arange(nord)[np.newaxis, :] * 80. + np.arange(3)[:, np.newaxis] * 20. + 0.3
+    trace[:, :, 2] = 4.
+    ord_vectors = extract.order_cen(trace, nx)
+    flux = 1000. + 500. * np.sin(np.arange(nx) / 50.)
+    y = np.arange(ny)[:, np.newaxis]
+    image = np.zeros((ny, nx))
+    for j in range(3):
+        for i in range(nord):
+            image += brightness[j] * flux * np.exp(-0.5 * ((y - ord_vectors[:, i, j] - shift) / sigma) ** 2) / np.sqrt(2. * np.pi) / sigma
+    k = np.arange(cowid) - cowid / 2. + 0.5
+    profile = np.exp(-0.5 * (k / sigma) ** 2)
+    prof = np.broadcast_to((profile / profile.sum())[np.newaxis, :, np.newaxis, np.newaxis],
+                           (nblock, cowid, nord, 3)).copy()
+    return image, image + 25., ord_vectors, prof, flux
+
+
+def test_extract_recovers_flux():
+    image, varmap, ord_vectors, prof, flux = synthetic_frame()
+    result = extract.extract(image, varmap, ord_vectors, prof, 10.5, ['thar', 'HD1', 'thar'])
+    assert result['spectrum'].shape == (512, 5, 3)
+    np.testing.assert_allclose(result['spectrum'], np.broadcast_to(flux[:, np.newaxis, np.newaxis], (512, 5, 3)),
+                               rtol=0.02)
+    # The rms width is about the box center, which can be up to half a pixel from the order center, and the box
+    # cuts off the wings
+    assert ((result['specwid'] > 1.45) & (result['specwid'] < np.sqrt(1.5 ** 2 + 0.5 ** 2))).all()
+    np.testing.assert_allclose(result['nelectron'], result['spectrum'].sum(axis=(0, 1)))
+
+    # Move the orders across dispersion: the star fiber finds the shift and the flux is still recovered
+    shifted = extract.extract(*synthetic_frame(shift=0.7)[:4], 10.5, ['thar', 'HD1', 'thar'])
+    assert abs(shifted['tracdy'] - result['tracdy'] - 0.7) < 0.05
+    np.testing.assert_allclose(shifted['spectrum'], result['spectrum'], rtol=0.01)
+
+
+def test_extract_chunks_do_not_change_results():
+    image, varmap, ord_vectors, prof, flux = synthetic_frame(shift=0.7)
+    result = extract.extract(image, varmap, ord_vectors, prof, 10.5, ['thar', 'HD1', 'thar'])
+    # a chunk that does not divide nx, and a single chunk
+    for chunk in [100, 512]:
+        chunked = extract.extract(image, varmap, ord_vectors, prof, 10.5, ['thar', 'HD1', 'thar'], chunk=chunk)
+        for name in ['spectrum', 'specrms', 'specdy', 'specdy2', 'specwid']:
+            np.testing.assert_array_equal(chunked[name], result[name], err_msg=name)
+
+
+def test_extract_skips_unlit_fibers():
+    image, varmap, ord_vectors, prof, flux = synthetic_frame()
+    result = extract.extract(image, varmap, ord_vectors, prof, 10.5, ['none', 'HD1', 'thar'])
+    assert result['spectrum'].shape == (512, 5, 2)
+    np.testing.assert_allclose(result['spectrum'], np.broadcast_to(flux[:, np.newaxis, np.newaxis], (512, 5, 2)),
+                               rtol=0.02)
+
+
+
+def literal_median(values):
+    # IDL median(): the larger of the two middle values for an even number of values
+    ordered = np.sort(np.ravel(values))
+    return ordered[len(ordered) // 2]
+
+
+def literal_quartile(f):
+    # quartile.pro, returning dq
+    med = literal_median(f)
+    slo = f[f < med]
+    shi = f[f >= med]
+    q0 = literal_median(slo) if len(slo) > 0 else f[0]
+    q1 = literal_median(shi) if len(shi) > 0 else f[-1]
+    return q1 - q0
+
+
+def literal_dymedian(inten, dely, cowid):
+    # dymedian.pro for the one fiber passed in, with inten(nx,nord) and dely(nx,nord)
+    nx, nord = inten.shape
+    jbot = int(nord * 0.15 + 1)
+    jtop = int(nord * 0.85)
+    igood = np.ones((nx, nord))
+    igood[:, :jbot] = 0
+    igood[:, jtop:] = 0
+    for j in range(jbot, jtop + 1):
+        di = inten[:, j]
+        dy = dely[:, j]
+        igood[di < 0.1 * literal_median(di), j] = 0
+        igood[np.abs(dy) > cowid / 2., j] = 0
+
+    iord0 = np.arange(nord) - nord / 2.
+    delygr = dely.reshape(-1, order='F')
+    funs = np.stack([np.ones(nx * nord), np.repeat(iord0, nx)], axis=1)
+
+    def lstsqr(wts):
+        funw = funs * wts[:, np.newaxis]
+        cc = np.linalg.solve(funw.T.dot(funw), funw.T.dot(delygr * wts))
+        return cc, delygr - funs.dot(cc)
+
+    wts = igood.reshape(-1, order='F')
+    cc0, resid0 = lstsqr(wts)
+    sg = wts > 0.
+    nsg = sg.sum()
+    if nsg <= 5:
+        return np.zeros(nord)
+    sig = literal_quartile(resid0[sg]) / 1.35
+    wts[(wts == 0.) | (np.abs(resid0) >= 5. * sig)] = 0.
+    cc = lstsqr(wts)[0]
+    if nsg <= 100:
+        return np.zeros(nord)
+    return cc[0] + cc[1] * iord0
+
+
+def literal_deriv(y):
+    # IDL deriv() for evenly spaced points
+    d = np.empty(len(y), dtype=y.dtype)
+    d[1:-1] = (y[2:] - y[:-2]) / 2.
+    d[0] = (-3. * y[0] + 4. * y[1] - y[2]) / 2.
+    d[-1] = (3. * y[-1] - 4. * y[-2] + y[-3]) / 2.
+    return d
+
+
+def literal_extlstsq(sprofile, dfpdy, d2fpdy2, ebo, vbo, ewts):
+    # extlstsq.pro with nfun=3, ifun=[0,2,3], one x and order at a time; all inputs are (nx,cowid,nord)
+    nx, cowid, nord = sprofile.shape
+    fitc = np.zeros((nx, nord, 5), dtype=np.float32)
+    for x in range(nx):
+        for i in range(nord):
+            f = [sprofile[x, :, i], dfpdy[x, :, i], d2fpdy2[x, :, i]]
+            w = ewts[x, :, i]
+            e = ebo[x, :, i]
+            (a00, a01, a02), (a10, a11, a12), (a20, a21, a22) = [[np.sum(f[m] * f[n] * w) for n in range(3)]
+                                                                  for m in range(3)]
+            y0, y1, y2 = [np.sum(f[m] * e * w) for m in range(3)]
+            det = a22 * (a00 * a11 - a01 * a10) - a20 * (a02 * a11 - a01 * a12) + a21 * (a02 * a10 - a00 * a12)
+            d0 = a22 * (y0 * a11 - a10 * y1) - a20 * (y2 * a11 - a12 * y1) + a21 * (y2 * a10 - a12 * y0)
+            d1 = a22 * (a00 * y1 - y0 * a01) - a20 * (a02 * y1 - y2 * a01) + a21 * (a02 * y0 - y2 * a00)
+            d2 = y2 * (a00 * a11 - a10 * a01) - y0 * (a02 * a11 - a12 * a01) + y1 * (a02 * a10 - a12 * a00)
+            if det != 0.:
+                fitc[x, i, 0] = d0 / det
+                fitc[x, i, 2] = d1 / det
+                fitc[x, i, 3] = d2 / det
+            if fitc[x, i, 0] > 0.:
+                fitc[x, i, 2] /= fitc[x, i, 0]
+                fitc[x, i, 3] /= fitc[x, i, 0]
+            fitc[x, i, 4] = np.sqrt(np.sum(vbo[x, :, i]))
+    return fitc
+
+
+def literal_extract(cordat, varmap, ord_vectors, tprof, ord_wid, objects, camera='', max_iter=100):
+    # extract.pro, step by step, on arrays in the IDL layout: boxes are (nx,cowid,nord,mfib), and
+    # tprof(nblock,cowid,nord,nfib) is tracedat.prof after its transpose.  The cosmic ray search is left
+    # out, as it does not change the outputs.
+    ny = cordat.shape[0]
+    nx, nord = ord_vectors.shape[:2]
+    nblock = tprof.shape[0]
+    cowid = int(np.ceil(ord_wid))
+    objs = [obj.strip().upper() for obj in objects]
+    fib0 = 0 if objs[0] != 'NONE' else 1
+    mfib = len(objs) - objs.count('NONE')
+    ordvec = ord_vectors[:, :, {3: [0, 1, 2], 2: [fib0, fib0 + 1], 1: [2]}[mfib]]
+    britethrsh = nx * nord * 200.
+    dymed0 = np.zeros(nord, dtype=np.float32)
+    current_iter = 0
+
+    while True:                                     # traceloop
+        dymed0xyz = np.broadcast_to(dymed0[np.newaxis, :, np.newaxis], (nx, nord, mfib))
+        ordbot = extract.idl_round(ordvec + dymed0xyz - cowid / 2.)
+        ordtop = ordbot + cowid - 1
+        ebox = np.zeros((nx, cowid, nord, mfib), dtype=np.float32)
+        vbox = np.zeros((nx, cowid, nord, mfib), dtype=np.float32)
+        for i in range(nord):
+            s = np.flatnonzero((ordbot[:, i, 0] >= 0) & (ordtop[:, i, mfib - 1] <= ny - 1))
+            for j in range(mfib):
+                for k in range(cowid):
+                    ebox[s, k, i, j] = cordat[ordbot[s, i, j] + k, s]
+                    vbox[s, k, i, j] = varmap[ordbot[s, i, j] + k, s]
+
+        sobjg = [n - fib0 for n, obj in enumerate(objs) if obj != 'NONE']
+        nsbr = len([obj for obj in objs if obj not in ('THAR', 'NONE')])
+        ebrite = ebox.sum(axis=(0, 1, 2), dtype=float)
+        shiftme = False
+        if nsbr > 0:
+            ixe = int(np.argmax(ebrite))
+            if ebrite[ixe] > britethrsh:
+                shiftme = True
+                sobjg = sobjg[ixe:] + sobjg[:ixe]
+
+        spectrum, specrms, specdy, specdy2, specwid = [np.zeros((nx, nord, mfib), dtype=np.float32)
+                                                       for n in range(5)]
+        tracdy = 0.
+        restart = False
+        for ifib in range(mfib):
+            jfib = sobjg[ifib]
+            ebo = ebox[..., jfib]
+            vbo = vbox[..., jfib]
+            yy = (np.arange(cowid) - cowid / 2. + 0.5).astype(np.float32)[np.newaxis, :, np.newaxis]
+            mom0 = ebo.sum(axis=1)
+            mom1 = (ebo * yy).sum(axis=1)
+            mom2 = (ebo * yy ** 2).sum(axis=1)
+            s0 = mom0 > 0.
+            mom1[s0] = mom1[s0] / mom0[s0]
+            mom2[s0] = np.sqrt(np.maximum(mom2[s0] / mom0[s0], 0.))
+
+            if shiftme and ifib == 0:
+                dymed = literal_dymedian(mom0, mom1, cowid)
+                if abs(literal_median(dymed)) > 0.1:
+                    dymed0 = dymed0 + dymed
+                    if current_iter > max_iter:
+                        raise RuntimeError('Maximum iteration reached')
+                    current_iter += 1
+                    restart = True
+                    break
+                tracdy = literal_median(dymed0)
+            else:
+                dymed = np.zeros(nord)
+
+            orddy = ordvec[:, :, jfib] + dymed0xyz[:, :, jfib] - ordbot[:, :, jfib] - cowid / 2. + dymed[np.newaxis, :]
+
+            # block profiles expanded to every x by IDL rebin, padded to a multiple of nblock
+            remain = nx % nblock
+            if remain != 0:
+                remain = nblock - remain
+            tp = tprof[..., jfib + fib0].astype(np.float32)
+            rprofile = np.zeros((nx + remain, cowid, nord), dtype=np.float32)
+            for m in range(nx + remain):
+                xb = m * nblock / float(nx + remain)
+                i0 = int(np.floor(xb))
+                i1 = min(i0 + 1, nblock - 1)
+                rprofile[m] = tp[i0] * (1. - (xb - i0)) + tp[i1] * (xb - i0)
+            rprofile = rprofile[remain // 2:nx + remain // 2]
+
+            sprofile = literal_shift_profiles(rprofile.transpose(1, 2, 0)[:, :, np.newaxis, :],
+                                              orddy.T[:, np.newaxis, :])[:, :, 0, :].transpose(2, 0, 1)
+
+            dfpdy = np.zeros((nx, cowid, nord), dtype=np.float32)
+            d2fpdy2 = np.zeros((nx, cowid, nord), dtype=np.float32)
+            for x in range(nx):
+                for i in range(nord):
+                    dfpdy[x, :, i] = literal_deriv(sprofile[x, :, i])
+                    d2fpdy2[x, :, i] = literal_deriv(dfpdy[x, :, i])
+
+            ewts = sprofile ** 2 / np.maximum(vbo, 1.)
+            fitc = literal_extlstsq(sprofile, dfpdy, d2fpdy2, ebo, vbo, ewts)
+            spectrum[:, :, jfib] = fitc[:, :, 0]
+            specrms[:, :, jfib] = fitc[:, :, 4]
+            specdy[:, :, jfib] = fitc[:, :, 2]
+            specdy2[:, :, jfib] = fitc[:, :, 3]
+            specwid[:, :, jfib] = mom2
+        if not restart:
+            break
+
+    if camera.find('fl') == 0:
+        spectrum[nx - 1] = spectrum[nx - 2]
+    return {'spectrum': spectrum, 'specrms': specrms, 'specdy': specdy, 'specdy2': specdy2, 'specwid': specwid,
+            'nelectron': spectrum.sum(axis=(0, 1)), 'tracdy': tracdy}
+
+
+@pytest.mark.parametrize('shift, brightness, objects, camera', [
+    # the brightest fiber is ThAr, and extract.pro estimates the trace shift from it anyway
+    (0.7, (1., 1., 1.), ['thar', 'HD1', 'thar'], 'fa09'),
+    (-0.4, (0.5, 1., 2.), ['none', 'HD1', 'thar'], 'fl09'),
+    # too faint to estimate a shift
+    (0.7, (0.05, 0.05, 0.05), ['thar', 'HD1', 'thar'], 'fa09'),
+    # all ThAr, so no shift
+    (0.3, (1., 1., 1.), ['thar', 'thar', 'thar'], 'fa09'),
+])
+def test_extract_matches_literal_extract_pro(shift, brightness, objects, camera):
+    image, varmap, ord_vectors, prof, flux = synthetic_frame(shift=shift, brightness=brightness)
+    expected = literal_extract(image, varmap, ord_vectors, prof, 10.5, objects, camera=camera)
+    result = extract.extract(image, varmap, ord_vectors, prof, 10.5, objects, camera=camera)
+    assert result['tracdy'] == pytest.approx(expected['tracdy'], abs=1e-5)
+    for name in ['spectrum', 'specrms', 'specwid']:
+        np.testing.assert_allclose(result[name], expected[name], rtol=1e-4, atol=1e-4 * np.abs(expected[name]).max(),
+                                   err_msg=name)
+    for name in ['specdy', 'specdy2']:
+        np.testing.assert_allclose(result[name], expected[name], rtol=0., atol=1e-3, err_msg=name)
+    np.testing.assert_allclose(result['nelectron'], expected['nelectron'], rtol=1e-5)
+
+@pytest.mark.skipif('NRES_EXTRACT_REFERENCE' not in os.environ,
+                    reason='Set NRES_EXTRACT_REFERENCE to a file written by mk_extract_reference.pro')
+def test_extract_matches_extract_pro():
+    with fits.open(os.environ['NRES_EXTRACT_REFERENCE']) as hdulist:
+        header = hdulist[0].header
+        cordat, varmap, ord_vectors, prof, spectrum, specrms, specdy, specwid = [hdu.data.astype(float)
+                                                                                for hdu in hdulist[:8]]
+    objects = header['OBJECTS'].split('&')
+    # FITS reverses the IDL axes; prof is held as (cowid,nord,nfib,nblock) in IDL
+    result = extract.extract(cordat, varmap, ord_vectors.transpose(2, 1, 0), prof.transpose(0, 3, 2, 1),
+                             header['ORDWID'], objects, camera=header['CAMERA'])
+    for name, expected in [('spectrum', spectrum), ('specrms', specrms), ('specdy', specdy), ('specwid', specwid)]:
+        expected = expected.transpose(2, 1, 0)
+        np.testing.assert_allclose(result[name], expected, rtol=1e-4, atol=1e-4 * np.abs(expected).max(), err_msg=name)
@@ -0,0 +1,93 @@
+import os
+import sys
+import pytest
+from nrespipe.idl import IDLSession, IDLSessionPool, idl_environment
+
+# Stand-in for nres_idl_server.pro that speaks the same line protocol
+fake_idl_server = """
+import os
+import sys
+import time
+for line in sys.stdin:
+    args = line.split()
+    if args[0] == 'EXIT':
+        break
+    elif args[0] == 'PING':
+        print('@@NRES_PONG', flush=True)
+    elif args[1] == 'crash':
+        sys.exit(3)
+    else:
+        if args[1] == 'hang':
+            time.sleep(60)
+        print('pid', os.getpid(), os.environ['NRESROOT'], os.environ['NRESINST'], flush=True)
+        print('stderr line', file=sys.stderr, flush=True)
+        print('@@NRES_DONE', 1 if args[1] == 'bad' else 0, flush=True)
+"""
+
+
+@pytest.fixture
+def server_command(tmpdir):
+    script = os.path.join(str(tmpdir), 'fake_idl_server.py')
+    with open(script, 'w') as f:
+        f.write(fake_idl_server)
+    return '{python} -u {script}'.format(python=sys.executable, script=script)
+
+
+def test_idl_environment_does_not_modify_base():
+    base = {'PATH': '/bin'}
+    environment = idl_environment('/archive/engineering', 'lsc', 'nres01', base_environment=base)
+    assert environment['NRESROOT'] == '/archive/engineering/lsc/'
+    assert environment['NRESINST'] == 'nres01/'
+    assert 'NRESROOT' not in base
+
+
+def test_session_runs_jobs(server_command):
+    session = IDLSession('lsc', 'nres01', '/archive/engineering', command=server_command)
+    returncode, stdout, stderr = session.run('run_nres_pipeline', ['frame.fits', '1'], timeout=10)
+    assert returncode == 0
+    assert stdout[0].split()[2:] == ['/archive/engineering/lsc/', 'nres01/']
+    assert session.ping(timeout=10)
+    returncode, stdout, stderr = session.run('run_nres_pipeline', ['bad', '1'], timeout=10)
+    assert returncode == 1
+    session.close()
+    assert not session.is_alive()
+
+
+def test_session_reports_crash(server_command):
+    session = IDLSession('lsc', 'nres01', '/archive/engineering', command=server_command)
+    returncode, stdout, stderr = session.run('run_nres_pipeline', ['crash', '1'], timeout=10)
+    assert returncode == 3
+    assert not session.ping(timeout=1)
+
+
+def test_session_timeout_kills_process(server_command):
+    session = IDLSession('lsc', 'nres01', '/archive/engineering', command=server_command)
+    returncode, stdout, stderr = session.run('run_nres_pipeline', ['hang', '1'], timeout=1)
+    assert returncode == 1
+    assert not session.is_alive()
+
+
+def test_pool_reuses_and_recycles_sessions(server_command):
+    pool = IDLSessionPool(max_jobs_per_session=2, command=server_command)
+    pids = []
+    for _ in range(3):
+        returncode, stdout, stderr = pool.run('run_nres_pipeline', ['frame.fits', '1'], '/archive/engineering',
+                                              'lsc', 'nres01')
+        assert returncode == 0
+        pids.append(stdout[0].split()[1])
+    assert pids[0] == pids[1]
+    assert pids[2] != pids[1]
+
+    pool.run('run_nres_pipeline', ['frame.fits', '1'], '/archive/engineering', 'elp', 'nres02')
+    assert len(pool.sessions) == 2
+    pool.close()
+    assert pool.sessions == {}
+
+
+def test_pool_replaces_dead_session(server_command):
+    pool = IDLSessionPool(command=server_command)
+    returncode, _, _ = pool.run('run_nres_pipeline', ['crash', '1'], '/archive/engineering', 'lsc', 'nres01')
+    assert returncode == 3
+    returncode, _, _ = pool.run('run_nres_pipeline', ['frame.fits', '1'], '/archive/engineering', 'lsc', 'nres01')
+    assert returncode == 0
+    pool.close()
@@ -0,0 +1,62 @@
+import importlib
+import sys
+import types
+import pytest
+
+
+class RecordingTask(object):
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+
+
+class Message(object):
+    def __init__(self):
+        self.acknowledged = False
+
+    def ack(self):
+        self.acknowledged = True
+
+
+@pytest.fixture
+def listener_module(monkeypatch):
+    # Stand in for the celery tasks so the listener can be tested without a broker
+    tasks = types.ModuleType('nrespipe.tasks')
+    tasks.process_archive_frames = RecordingTask()
+    monkeypatch.setitem(sys.modules, 'nrespipe.tasks', tasks)
+    monkeypatch.delitem(sys.modules, 'nrespipe.listener', raising=False)
+    module = importlib.import_module('nrespipe.listener')
+    yield module
+    sys.modules.pop('nrespipe.listener', None)
+
+
+def test_full_batches_are_sent(listener_module):
+    listener = listener_module.NRESListener('memory://', '/reduced', 'sqlite:///test.db', batch_size=2)
+    messages = [Message() for _ in range(5)]
+    for i, message in enumerate(messages):
+        listener.on_message({'frameid': i}, message)
+
+    calls = listener_module.tasks.process_archive_frames.calls
+    assert calls == [([{'frameid': 0}, {'frameid': 1}], '/reduced', 'sqlite:///test.db'),
+                     ([{'frameid': 2}, {'frameid': 3}], '/reduced', 'sqlite:///test.db')]
+    assert [message.acknowledged for message in messages] == [True, True, True, True, False]
+
+
+def test_partial_batch_is_sent_when_the_queue_is_quiet(listener_module):
+    listener = listener_module.NRESListener('memory://', '/reduced', 'sqlite:///test.db', batch_size=10)
+    calls = listener_module.tasks.process_archive_frames.calls
+    message = Message()
+
+    listener.on_iteration()
+    listener.on_message({'frameid': 1}, message)
+    # a message arrived since the last wait, so more may be on the way
+    listener.on_iteration()
+    assert calls == [] and not message.acknowledged
+    # the next wait timed out
+    listener.on_iteration()
+    assert calls == [([{'frameid': 1}], '/reduced', 'sqlite:///test.db')]
+    assert message.acknowledged
+    listener.on_iteration()
+    assert len(calls) == 1
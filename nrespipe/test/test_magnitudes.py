@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pytest
+from nrespipe import magnitudes
+from nrespipe.magnitudes import MagnitudeResolver
+
+
+class FakeSimbad(object):
+    def __init__(self, known_magnitudes):
+        self.known_magnitudes = known_magnitudes
+        self.queries = []
+        self.fail = False
+
+    def __call__(self, search_names):
+        self.queries.append(list(search_names))
+        if self.fail:
+            raise ConnectionError('Simbad is down')
+        return {search_name: self.known_magnitudes.get(search_name, np.nan) for search_name in search_names}
+
+
+@pytest.fixture
+def fake_simbad(monkeypatch):
+    simbad = FakeSimbad({'HD1461': 6.46, 'psi Phe': 4.41})
+    monkeypatch.setattr(magnitudes, 'query_simbad_magnitudes', simbad)
+    return simbad
+
+
+def test_batch_query_and_cache(tmpdir, fake_simbad):
+    cache_filename = os.path.join(str(tmpdir), 'cache.json')
+    resolver = MagnitudeResolver(cache_filename=cache_filename)
+    result = resolver.get_magnitudes(['HD1461_1', 'HD1461_2', 'PSIPHE', 'NOTASTAR'])
+    assert result['HD1461_1'] == result['HD1461_2'] == 6.46
+    assert result['PSIPHE'] == 4.41
+    assert np.isnan(result['NOTASTAR'])
+    # One query for all of the uncached names, with each name only asked for once
+    assert fake_simbad.queries == [['HD1461', 'psi Phe', 'NOTASTAR']]
+
+    # Everything is cached now, including the target Simbad did not know
+    assert resolver.get_magnitude('HD1461') == 6.46
+    assert np.isnan(resolver.get_magnitude('NOTASTAR'))
+    assert len(fake_simbad.queries) == 1
+
+    # The cache persists on disk
+    assert MagnitudeResolver(cache_filename=cache_filename).get_magnitude('PSIPHE') == 4.41
+    assert len(fake_simbad.queries) == 1
+
+
+def test_cache_expiry(tmpdir, fake_simbad, monkeypatch):
+    now = 1e9
+    monkeypatch.setattr(magnitudes.time, 'time', lambda: now)
+    resolver = MagnitudeResolver(cache_filename=os.path.join(str(tmpdir), 'cache.json'), ttl=1000, negative_ttl=10)
+    resolver.get_magnitudes(['HD1461', 'NOTASTAR'])
+
+    now += 100
+    resolver.get_magnitudes(['HD1461', 'NOTASTAR'])
+    # Only the negative entry has expired
+    assert fake_simbad.queries[-1] == ['NOTASTAR']
+
+    now += 2000
+    resolver.get_magnitudes(['HD1461'])
+    assert fake_simbad.queries[-1] == ['HD1461']
+    assert len(fake_simbad.queries) == 3
+
+
+def test_failed_queries_are_not_cached(tmpdir, fake_simbad):
+    resolver = MagnitudeResolver(cache_filename=os.path.join(str(tmpdir), 'cache.json'))
+    fake_simbad.fail = True
+    assert np.isnan(resolver.get_magnitude('HD1461'))
+    fake_simbad.fail = False
+    assert resolver.get_magnitude('HD1461') == 6.46
+    assert len(fake_simbad.queries) == 2
+
+
+def test_offline_mode(tmpdir, fake_simbad):
+    targets_filename = os.path.join(str(tmpdir), 'targets.csv')
+    with open(targets_filename, 'w') as targets_file:
+        targets_file.write('Name,RA(deg),Dec(deg),Vmag,Bmag\n')
+        targets_file.write('"HD1461",4.67445,-8.05300,6.460,7.140\n')
+        targets_file.write('"psi Phe",28.41,-46.30,4.410,5.990\n')
+        targets_file.write('"HR98",6.43779,-77.25425,-99.9,3.410\n')
+    resolver = MagnitudeResolver(offline=True, targets_filenames=[targets_filename])
+    result = resolver.get_magnitudes(['HD_1461', 'PSIPHE', 'HR98', 'NOTASTAR'])
+    assert result['HD_1461'] == 6.46
+    assert result['PSIPHE'] == 4.41
+    assert np.isnan(result['HR98'])
+    assert np.isnan(result['NOTASTAR'])
+    assert fake_simbad.queries == []
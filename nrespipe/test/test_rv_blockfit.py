@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import rv_blockfit
+
+nx, nord, nblock = 1024, 6, 4
+injected_rr = 1.e-5
+
+
+def absorption_spectrum(lam):
+    # A flat continuum with many narrow lines of varying depth
+    spectrum = np.full(lam.shape, 1.e4)
+    for center in np.arange(495., 565., 0.07):
+        spectrum -= 4.e3 * np.exp(-0.5 * ((lam - center) / 0.01) ** 2) * (0.5 + 0.5 * np.sin(center * 13.1)) ** 2
+    return spectrum
+
+
+@pytest.fixture(scope='module')
+def spectra():
+    rng = np.random.default_rng(3)
+    lam = np.linspace(500., 560., nord)[np.newaxis, :] * (1. + (np.arange(nx)[:, np.newaxis] - nx // 2) * 2.e-6)
+    zdat = absorption_spectrum(lam)
+    sdat = 1.1 * absorption_spectrum(lam * (1. + injected_rr)) + rng.normal(0., 10., lam.shape)
+    return lam, zdat, sdat
+
+
+@pytest.fixture(scope='module')
+def fit(spectra):
+    return rv_blockfit.fit_blocks(*spectra, nblock)
+
+
+def literal_interpol(y, x, u):
+    # IDL interpol(y,x,u,/quadratic) for one block
+    s = np.clip(np.searchsorted(x, u, side='right') - 1, 0, len(x) - 3)
+    x0, x1, x2 = x[s], x[s + 1], x[s + 2]
+    y0, y1, y2 = y[s], y[s + 1], y[s + 2]
+    return (y0 * (u - x1) * (u - x2) / ((x0 - x1) * (x0 - x2)) + y1 * (u - x0) * (u - x2) / ((x1 - x0) * (x1 - x2)) +
+            y2 * (u - x0) * (u - x1) / ((x2 - x0) * (x2 - x1)))
+
+
+def literal_lsqblkfit(lamblock, zblock, dblock, wts):
+    # lsqblkfit2.pro, one block at a time
+    uu0 = zblock - np.sum(zblock * wts) / np.sum(wts)
+    aa0 = np.sum(dblock * wts) / np.sum(wts)
+    bb0 = np.sum((dblock - aa0) * uu0 * wts) / np.sum(uu0 ** 2 * wts)
+    rr0 = 0.
+    for iteration in range(rv_blockfit.itermax):
+        lamt = lamblock * (1. + rr0)
+        dlamdx = np.gradient(lamt, edge_order=2)
+        zbt = literal_interpol(zblock, lamblock, lamt)
+        model = (zbt - aa0) * bb0 + aa0
+        dzdx = np.gradient(model, edge_order=2)
+        funs = np.stack([np.ones(len(zbt)), zbt - aa0, dzdx], axis=1) * wts[:, np.newaxis]
+        cc = np.linalg.solve(funs.T.dot(funs), funs.T.dot((dblock - model) * wts))
+        aa0 += cc[0]
+        bb0 += cc[1]
+        delrr = cc[2] * np.mean(dlamdx / lamt)
+        rr0 += delrr
+        modelo = (zbt - aa0) * bb0 + aa0 + cc[2] * dzdx
+        if abs(delrr) <= rv_blockfit.delmin or abs(rr0) >= rv_blockfit.rr0max:
+            break
+    return rr0, aa0, bb0, modelo
+
+
+def test_matches_per_block_loop(spectra, fit):
+    lam, zdat, sdat = spectra
+    blen = nx // nblock
+    bbot = (np.arange(nblock) * (nx / float(nblock))).astype(int)
+    for i in range(nord):
+        for k in range(nblock):
+            columns = slice(bbot[k], bbot[k] + blen)
+            wts = rv_blockfit.block_weights(sdat[columns, i][np.newaxis])[0][0]
+            rr, aa, bb, modelo = literal_lsqblkfit(lam[columns, i], zdat[columns, i], sdat[columns, i], wts)
+            assert abs(fit['rr'][i, k] - rr) < 1.e-13
+            assert abs(fit['aa'][i, k] - aa) < 1.e-13 * abs(aa)
+            assert abs(fit['bb'][i, k] - bb) < 1.e-12 * abs(bb)
+            np.testing.assert_allclose(fit['modelo'][i, k], modelo, rtol=1.e-12, atol=1.e-12 * abs(aa))
+            np.testing.assert_allclose(fit['resido'][i, k], sdat[columns, i] - fit['modelo'][i, k])
+
+
+def test_recovers_injected_redshift(fit):
+    assert fit['converged'].all()
+    assert (fit['niter'] < rv_blockfit.itermax).all()
+    np.testing.assert_allclose(fit['bb'], 1.1, rtol=1.e-2)
+    rr, median, err = rv_blockfit.robust_average(fit['rr'], fit['err'])
+    assert 0. < err < 1.e-8
+    assert abs(rr - injected_rr) < 1.e-8
+    assert abs(median - injected_rr) < 1.e-7
+
+
+def test_flat_zero_block_fails(spectra):
+    lam, zdat, sdat = spectra
+    lamblock = lam[:256, :2].T
+    dblock = sdat[:256, :2].T
+    wts = rv_blockfit.block_weights(dblock)[0]
+    # the first ZERO block is flat, so bb has no first guess and the normal equations are singular
+    zblock = np.stack([np.full(256, 1.e4), zdat[:256, 1]])
+    with np.errstate(all='raise'):
+        fit = rv_blockfit.lsqblkfit(lamblock, zblock, dblock, wts)
+    np.testing.assert_array_equal(fit['failed'], [True, False])
+    np.testing.assert_array_equal(fit['converged'], [False, True])
+    assert fit['niter'][0] == 1
+    assert np.isfinite(fit['bb']).all()
+    assert fit['rr'][0] == 0.
+    np.testing.assert_array_equal(fit['cov'][0], 0.)
+
+
+def test_no_overlap_fails(spectra):
+    lam, zdat, sdat = spectra
+    lamblock = lam[:256, :1].T
+    dblock = sdat[:256, :1].T
+    fit = rv_blockfit.lsqblkfit(lamblock, np.zeros((1, 256)), dblock, rv_blockfit.block_weights(dblock)[0])
+    assert fit['failed'][0] and not fit['converged'][0]
+    assert fit['rr'][0] == 0.
+
+
+def test_failed_blocks_are_left_out(spectra):
+    lam, zdat, sdat = spectra
+    zdat = zdat.copy()
+    zdat[:nx // nblock, 0] = 1.e4
+    fit = rv_blockfit.fit_blocks(lam, zdat, sdat, nblock)
+    assert fit['failed'][0, 0] and not fit['converged'][0, 0]
+    assert fit['failed'].sum() == 1
+    assert fit['err'][0, 0] == 0.
+    rr, median, err = rv_blockfit.robust_average(fit['rr'], fit['err'])
+    assert abs(rr - injected_rr) < 1.e-8
@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pytest
+import spectrographs
+
+spectrographs_csv = os.path.join(os.path.dirname(__file__), '..', '..', 'csv', 'spectrographs.csv')
+
+
+@pytest.fixture
+def registry():
+    return spectrographs.SpectrographRegistry(spectrographs_csv)
+
+
+def test_lines_are_typed(registry):
+    specdat = registry.get('lsc', 57824.4)
+    assert specdat.site == 'lsc'
+    assert specdat.ord0 == 52 and isinstance(specdat.ord0, int)
+    assert specdat.nx == 4096 and specdat.nord == 67 and specdat.nfib == 3
+    assert specdat.gltype.strip() == 'PBM2'
+    assert specdat.coefs.shape == (15,) and specdat.fibcoefs.shape == (2, 10)
+    assert not specdat.coefs.flags.writeable
+    np.testing.assert_allclose(specdat.sinalp, np.sin(np.radians(specdat.grinc)))
+
+
+@pytest.mark.parametrize('mjd', [57000., 57807.852951389272, 57824.4, 57850., 58190., 70000.])
+def test_get_selects_the_newest_line(registry, mjd):
+    # get_specdat.pro takes min(mjd - mjds), which is the newest line for the site whatever the date
+    assert registry.get('lsc', mjd).mjd == 58190.
+
+
+def test_ties_go_to_the_earlier_line(tmpdir):
+    csv_file = str(tmpdir.join('spectrographs.csv'))
+    with open(spectrographs_csv) as infile:
+        lines = infile.readlines()
+    with open(csv_file, 'w') as outfile:
+        outfile.writelines([lines[0], lines[2], lines[2].replace('57824.4,52,', '57824.4,53,')])
+    assert spectrographs.SpectrographRegistry(csv_file).get('lsc', 58000.).ord0 == 52
+
+
+def test_get_many_matches_get(registry):
+    mjds = [57000., 57807.852951389272, 57810., 57824.4, 57850., 58000., 70000.]
+    assert registry.get_many(' LSC ', mjds) == [registry.get('lsc', mjd) for mjd in mjds]
+    assert registry.get_many('xyz', mjds) == [None] * len(mjds)
+    # Each site only sees its own lines
+    assert registry.get('elp', 58000.01).site == 'elp'
+    assert registry.get('elp', 58000.).mjd == 58000.01
+
+
+def test_reloaded_when_file_changes(tmpdir):
+    csv_file = str(tmpdir.join('spectrographs.csv'))
+    with open(spectrographs_csv) as infile:
+        lines = infile.readlines()
+    with open(csv_file, 'w') as outfile:
+        outfile.writelines(lines[:2])
+    registry = spectrographs.SpectrographRegistry(csv_file)
+    assert registry.get('lsc', 58000.) is None
+    with open(csv_file, 'a') as outfile:
+        outfile.write(lines[2])
+    assert registry.get('lsc', 58000.).mjd == 57824.4
@@ -0,0 +1,114 @@
+import csv
+import os
+import pytest
+import stds_db
+
+header = '"Type","Filename","Navg","Site","Camera","JDdata","Flags"\n'
+
+
+def make_standards(tmpdir, lines):
+    csv_file = str(tmpdir.join('standards.csv'))
+    with open(csv_file, 'w') as outfile:
+        outfile.write(header)
+        outfile.writelines(lines)
+    return csv_file
+
+
+def test_format_row_matches_stds_write():
+    assert stds_db.format_header() == header
+    assert stds_db.format_row(('BIAS', 'bias/a.fits', '1', 'lsc', 'fa09', '2458200.5', '0000')) == \
+        '"BIAS","bias/a.fits",1,"lsc","fa09",2458200.500000000000000,"0000"\n'
+    # Strings that look like numbers are still quoted, and quotes are doubled
+    assert stds_db.format_row(('FLAT', 'a"b', 5.0, '001', 'fa09', 2458200, '1')) == \
+        '"FLAT","a""b",5,"001","fa09",2458200.000000000000000,"1"\n'
+
+
+def test_sync_reads_csv(tmpdir):
+    csv_file = make_standards(tmpdir, ['"BIAS","bias/a.fits",1,"lsc","fa09",2458200.500000000000000,"0000"\n',
+                                       'DARK,dark/a.fits,5, LSC ,fa09,2458201.5,1000\n'])
+    store = stds_db.StandardsStore(csv_file)
+    assert store.rows() == [('BIAS', 'LSC', 'FA09', 2458200.5, 1.0, 'bias/a.fits')]
+    assert store.rows(flag='1') == [('DARK', 'LSC', 'FA09', 2458201.5, 5.0, 'dark/a.fits')]
+
+    # A change made to the csv file behind the store's back is picked up on the next query
+    with open(csv_file, 'a') as outfile:
+        outfile.write('"BIAS","bias/b.fits",1,"lsc","fa09",2458202.500000000000000,"0000"\n')
+    assert [row[-1] for row in store.rows()] == ['bias/a.fits', 'bias/b.fits']
+    store.close()
+
+
+def test_add_appends_in_stds_write_format(tmpdir):
+    csv_file = make_standards(tmpdir, ['"BIAS","bias/a.fits",1,"lsc","fa09",2458200.500000000000000,"0000"\n'])
+    store = stds_db.StandardsStore(csv_file)
+    store.add([('BIAS', 'bias/b.fits', 1, 'lsc', 'fa09', 2458201.25, '0000')])
+    with open(csv_file) as infile:
+        lines = infile.readlines()
+    assert lines == [header, '"BIAS","bias/a.fits",1,"lsc","fa09",2458200.500000000000000,"0000"\n',
+                     '"BIAS","bias/b.fits",1,"lsc","fa09",2458201.250000000000000,"0000"\n']
+    store.close()
+
+
+def test_add_out_of_order_rewrites_sorted(tmpdir):
+    csv_file = make_standards(tmpdir, ['BIAS,bias/b.fits,1,lsc,fa09,2458202.5,0000\n'])
+    store = stds_db.StandardsStore(csv_file)
+    store.add([('BIAS', 'bias/a.fits', 1, 'lsc', 'fa09', 2458200.5, '0000')])
+    with open(csv_file) as infile:
+        lines = infile.readlines()
+    # The whole file is rewritten in the stds_write format, header included
+    assert lines == [header, '"BIAS","bias/a.fits",1,"lsc","fa09",2458200.500000000000000,"0000"\n',
+                     '"BIAS","bias/b.fits",1,"lsc","fa09",2458202.500000000000000,"0000"\n']
+    # ... and reads back as the same table
+    with open(csv_file) as infile:
+        rows = list(csv.reader(infile))
+    assert rows[2] == ['BIAS', 'bias/b.fits', '1', 'lsc', 'fa09', '2458202.500000000000000', '0000']
+    store.close()
+
+
+def test_export_csv(tmpdir):
+    csv_file = make_standards(tmpdir, ['TRACE,trace/b.fits,1,lsc,fa09,2458202.5,0000\n',
+                                       'TRACE,trace/a.fits,1,lsc,fa09,2458201.5,0000\n'])
+    store = stds_db.StandardsStore(csv_file)
+    export_file = str(tmpdir.join('exported.csv'))
+    store.export_csv(export_file)
+    with open(export_file) as infile:
+        assert infile.readlines() == [header, '"TRACE","trace/a.fits",1,"lsc","fa09",2458201.500000000000000,"0000"\n',
+                                      '"TRACE","trace/b.fits",1,"lsc","fa09",2458202.500000000000000,"0000"\n']
+    # Exporting somewhere else leaves standards.csv alone
+    with open(csv_file) as infile:
+        assert infile.readline() == header
+        assert infile.readline().startswith('TRACE,trace/b.fits')
+    store.close()
+
+
+@pytest.mark.parametrize('jd, expected', [(2458200.0, 'bias/a.fits'),
+                                          # The nearest line is a single frame, but a super-bias is close enough
+                                          (2458204.9, 'bias/super.fits'),
+                                          # Too far from the super-bias, so the nearest single frame wins
+                                          (2458212.0, 'bias/c.fits')])
+def test_find_calib(tmpdir, jd, expected):
+    csv_file = make_standards(tmpdir, ['BIAS,bias/a.fits,1,lsc,fa09,2458200.5,0000\n',
+                                       'BIAS,bias/super.fits,20,lsc,fa09,2458203.5,0000\n',
+                                       'BIAS,bias/b.fits,1,lsc,fa09,2458205.0,0000\n',
+                                       'BIAS,bias/c.fits,1,lsc,fa09,2458212.5,0000\n',
+                                       'BIAS,bias/bad.fits,50,lsc,fa09,2458212.0,1000\n',
+                                       'BIAS,bias/elp.fits,1,elp,fa17,2458212.0,0000\n'])
+    store = stds_db.StandardsStore(csv_file)
+    assert store.find_calib('bias', 'lsc', 'fa09', jd)[1] == expected
+    assert store.find_calib('DARK', 'lsc', 'fa09', jd) is None
+    store.close()
+
+
+def test_calibration_index_sees_lines_added_by_other_stores(tmpdir, monkeypatch):
+    import calib_index
+    monkeypatch.setattr(stds_db, 'stores', {})
+    monkeypatch.setattr(calib_index, 'indexes', {})
+    csv_file = make_standards(tmpdir, ['BIAS,bias/a.fits,1,lsc,fa09,2458200.5,0000\n'])
+    index = calib_index.get_index(csv_file)
+    assert index.find_calib('BIAS', 'lsc', 'fa09', 2458210.) == 'bias/a.fits'
+
+    # Another worker adds a line through its own store
+    other_store = stds_db.StandardsStore(csv_file)
+    other_store.add([('BIAS', 'bias/b.fits', 1, 'lsc', 'fa09', 2458209.5, '0000')])
+    other_store.close()
+    assert index.find_calib('BIAS', 'lsc', 'fa09', 2458210.) == 'bias/b.fits'
+    index.store.close()
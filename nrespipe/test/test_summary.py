@@ -0,0 +1,122 @@
+import io
+import os
+import tarfile
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot
+import numpy as np
+import pytest
+from PyPDF2 import PdfFileReader
+from nrespipe import settings, utils
+from nrespipe.summary import add_frame_to_summary, summary_directory, has_summary, get_signal_to_noise_rows
+from nrespipe.summary import make_summary_pdf_from_store, tarballs_missing_from_summary
+
+
+@pytest.fixture(autouse=True)
+def tarball_index_directory(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'tarball_index_directory', str(tmpdir.join('tarball_index')))
+
+
+def make_reduced_tarball(output_directory, basename, text):
+    pdf_stream = io.BytesIO()
+    figure = pyplot.figure()
+    figure.text(0.1, 0.5, text)
+    with matplotlib.rc_context({'pdf.fonttype': 42}):
+        figure.savefig(pdf_stream, format='pdf')
+    pyplot.close(figure)
+    pdf_data = pdf_stream.getvalue()
+
+    tar_filename = os.path.join(output_directory, basename + '.tar.gz')
+    with tarfile.open(tar_filename, 'w:gz') as tar_file:
+        member = tarfile.TarInfo('{basename}/{basename}.pdf'.format(basename=basename))
+        member.size = len(pdf_data)
+        tar_file.addfile(member, io.BytesIO(pdf_data))
+    return tar_filename
+
+
+def test_summary_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(utils, 'get_mag_from_simbad', lambda target_name: 8.5)
+    data_reduction_root = str(tmpdir.mkdir('reduced'))
+    tar_directory = str(tmpdir.mkdir('tar'))
+    frames = [('lscnrs01-fa09-20180315-0012-e91', 'HD12345, lsc expt = 600 s, S/N= 45.3, blah'),
+              ('lscnrs01-fa09-20180315-0011-e91', 'HD_6789, lsc expt = 300 s, S/N= 12.0, blah')]
+    for basename, text in frames:
+        tar_filename = make_reduced_tarball(tar_directory, basename, text)
+        assert add_frame_to_summary(tar_filename, data_reduction_root, 'lsc', 'nres01', '20180315')
+
+    directory = summary_directory(data_reduction_root, 'lsc', 'nres01', '20180315')
+    assert has_summary(directory)
+    assert not has_summary(summary_directory(data_reduction_root, 'lsc', 'nres01', '20180316'))
+    rows = get_signal_to_noise_rows(directory)
+    assert [row['target'] for row in rows] == ['HD_6789', 'HD12345']
+    assert rows[1] == {'target': 'HD12345', 'mag': 8.5, 'sn': 45.3, 'exptime': 600.0, 'site': 'lsc',
+                       'dayobs': '20180315'}
+
+    output_pdf_filename = os.path.join(str(tmpdir), 'summary.pdf')
+    make_summary_pdf_from_store(directory, output_pdf_filename)
+    pdf_reader = PdfFileReader(output_pdf_filename)
+    assert pdf_reader.getNumPages() == 2
+    assert pdf_reader.getPage(0).extractText().startswith('HD_6789')
+
+
+def test_summary_store_skips_tarballs_without_pdfs(tmpdir):
+    tar_filename = os.path.join(str(tmpdir), 'lscnrs01-fa09-20180315-bias-bin1x1.tar.gz')
+    with tarfile.open(tar_filename, 'w:gz') as tar_file:
+        member = tarfile.TarInfo('bias.fits.fz')
+        tar_file.addfile(member, io.BytesIO(b''))
+    assert not add_frame_to_summary(tar_filename, str(tmpdir), 'lsc', 'nres01', '20180315')
+    directory = summary_directory(str(tmpdir), 'lsc', 'nres01', '20180315')
+    assert not has_summary(directory)
+    # The marker keeps the end of night summary from reopening the tarball
+    assert tarballs_missing_from_summary(directory, str(tmpdir)) == []
+
+
+def test_summary_store_merges_frames_missing_from_it(tmpdir, monkeypatch):
+    monkeypatch.setattr(utils, 'get_mag_from_simbad', lambda target_name: 8.5)
+    data_reduction_root = str(tmpdir.mkdir('reduced'))
+    specproc_directory = str(tmpdir.mkdir('specproc'))
+    frames = [('lscnrs01-fa09-20180315-0011-e91', 'HD_6789, lsc expt = 300 s, S/N= 12.0, blah'),
+              ('lscnrs01-fa09-20180315-0012-e91', 'HD12345, lsc expt = 600 s, S/N= 45.3, blah'),
+              ('lscnrs01-fa09-20180315-0013-e91', 'HD999, lsc expt = 900 s, S/N= 80.1, blah')]
+    tar_filenames = [make_reduced_tarball(specproc_directory, basename, text) for basename, text in frames]
+    # Only the middle frame made it into the store as it was reduced
+    assert add_frame_to_summary(tar_filenames[1], data_reduction_root, 'lsc', 'nres01', '20180315')
+
+    directory = summary_directory(data_reduction_root, 'lsc', 'nres01', '20180315')
+    assert tarballs_missing_from_summary(directory, specproc_directory) == [tar_filenames[0], tar_filenames[2]]
+
+    rows = get_signal_to_noise_rows(directory, specproc_directory=specproc_directory, site='lsc', dayobs='20180315')
+    assert [row['target'] for row in rows] == ['HD_6789', 'HD12345', 'HD999']
+    assert rows[1]['mag'] == 8.5
+    # The rows read from the tarballs leave the magnitude to be looked up with the others
+    assert np.isnan(rows[0]['mag']) and np.isnan(rows[2]['mag'])
+    assert rows[2]['sn'] == 80.1 and rows[2]['site'] == 'lsc' and rows[2]['dayobs'] == '20180315'
+
+    output_pdf_filename = os.path.join(str(tmpdir), 'summary.pdf')
+    make_summary_pdf_from_store(directory, output_pdf_filename, specproc_directory=specproc_directory)
+    pdf_reader = PdfFileReader(output_pdf_filename)
+    assert [pdf_reader.getPage(i).extractText().split(',')[0] for i in range(3)] == ['HD_6789', 'HD12345', 'HD999']
+
+
+def test_summary_store_falls_back_to_tarballs(tmpdir):
+    specproc_directory = str(tmpdir.mkdir('specproc'))
+    make_reduced_tarball(specproc_directory, 'lscnrs01-fa09-20180315-0011-e91', 'HD_6789, lsc expt = 300 s, S/N= 12.0, blah')
+    directory = summary_directory(str(tmpdir), 'lsc', 'nres01', '20180315')
+    rows = get_signal_to_noise_rows(directory, specproc_directory=specproc_directory, site='lsc', dayobs='20180315')
+    assert [row['target'] for row in rows] == ['HD_6789']
+    output_pdf_filename = os.path.join(str(tmpdir), 'summary.pdf')
+    make_summary_pdf_from_store(directory, output_pdf_filename, specproc_directory=specproc_directory)
+    assert PdfFileReader(output_pdf_filename).getNumPages() == 1
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+def test_extract_from_pdfs(tmpdir, n_processes):
+    texts = ['HD{i}, lsc expt = 600 s, S/N= 4{i}.0, blah'.format(i=i) for i in range(5)]
+    for i, text in enumerate(texts):
+        make_reduced_tarball(str(tmpdir), 'lscnrs01-fa09-20180315-000{i}-e91'.format(i=i), text)
+    extracted_text = []
+    utils.extract_from_pdfs(str(tmpdir), lambda pdf_reader: extracted_text.append(pdf_reader.getPage(0).extractText()),
+                            n_processes=n_processes)
+    assert extracted_text == texts
+    assert os.path.exists(utils.tarball_index_filename(os.path.join(str(tmpdir),
+                                                                    'lscnrs01-fa09-20180315-0000-e91.tar.gz')))
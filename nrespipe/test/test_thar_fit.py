@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import pytest
+import spectrographs
+import thar_fit
+import thar_lines
+
+config_directory = os.path.join(os.path.dirname(__file__), '..', '..', 'config')
+spectrographs_csv = os.path.join(os.path.dirname(__file__), '..', '..', 'csv', 'spectrographs.csv')
+
+
+@pytest.fixture(scope='module')
+def specdat():
+    return spectrographs.SpectrographRegistry(spectrographs_csv).get('lsc', 58000.)
+
+
+@pytest.fixture(scope='module')
+def index():
+    return thar_lines.get_index(os.path.join(config_directory, 'arc_ThAr_Redman.txt'),
+                                os.path.join(config_directory, 'badlams.txt'))
+
+
+def make_problem(specdat, index, fibno, parms, rng):
+    # The x-positions where the perturbed model puts every list line, with a little noise
+    x = np.arange(specdat.nx, dtype=float)[:, np.newaxis]
+    lam = thar_fit.lambda3ofx(x, np.arange(specdat.nord)[np.newaxis, :], fibno, specdat, *parms,
+                              specdat.coefs)[0]
+    iord, xpos = [], []
+    for i in range(specdat.nord):
+        lines = index.linelam[(index.linelam > lam[:, i].min()) & (index.linelam < lam[:, i].max())]
+        xpos.append(np.interp(lines, lam[:, i], x[:, 0]))
+        iord.append(np.full(len(lines), i))
+    iord = np.concatenate(iord)
+    xpos = np.concatenate(xpos) + rng.normal(0., 0.02, len(iord))
+    return thar_fit.ThArLines(fibno, iord, xpos, rng.uniform(1.e3, 1.e5, len(iord)), np.full(len(iord), 4.))
+
+
+def test_recovers_perturbed_parameters(specdat, index):
+    rng = np.random.default_rng(2)
+    problems, truths = [], []
+    for fibno in (1, 0, 2):
+        dfl = rng.normal(0., 0.02)
+        parms = (specdat.sinalp + rng.normal(0., 2.e-5), specdat.fl + dfl, specdat.y0 + rng.normal(0., 0.02),
+                 specdat.z0 + dfl * thar_fit.tied_z0)
+        problems.append(make_problem(specdat, index, fibno, parms, rng))
+        truths.append(parms)
+    truths = np.array(truths)
+
+    result = thar_fit.fit_all(problems, specdat, index, nprocesses=1)
+    assert result['converged'].all()
+    assert not result['diverged'].any()
+    np.testing.assert_array_equal(result['fibno'], [1, 0, 2])
+    np.testing.assert_allclose(result['sinalp'], truths[:, 0], rtol=0., atol=1.e-7)
+    np.testing.assert_allclose(result['fl'], truths[:, 1], rtol=0., atol=1.e-3)
+    np.testing.assert_allclose(result['y0'], truths[:, 2], rtol=0., atol=1.e-3)
+    assert (result['nmatch'] > 0.9 * np.array([len(problem.xpos) for problem in problems])).all()
+    assert result['lam'].shape == (3, specdat.nx, specdat.nord)
+
+
+class RunawayModel(object):
+    # Every step away from the starting parameters makes the fit worse
+    xpos = np.zeros((2, 5))
+    clip = np.ones((2, 5))
+    xperr = np.ones((2, 5))
+
+    def lam(self, parms):
+        return np.repeat(parms[..., :1], 5, axis=-1) + np.arange(5.)
+
+    def residuals(self, lam):
+        resid = 1. + 10. * np.abs(lam - np.arange(5.))
+        return resid, lam, np.ones(lam.shape, dtype=bool), np.zeros(lam.shape, dtype=int)
+
+
+def test_runaway_damping_is_not_converged():
+    parms, converged, diverged, niter = thar_fit.fit_parms(RunawayModel(), np.array([1., 0., 0.]))[:4]
+    assert not converged.any()
+    assert diverged.all()
+    np.testing.assert_array_equal(parms, 0.)
+    assert (niter < 50).all()
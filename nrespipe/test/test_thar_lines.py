@@ -0,0 +1,117 @@
+import os
+import numpy as np
+import pytest
+import thar_lines
+
+config_directory = os.path.join(os.path.dirname(__file__), '..', '..', 'config')
+linelist_file = os.path.join(config_directory, 'arc_ThAr_Redman.txt')
+badlams_file = os.path.join(config_directory, 'badlams.txt')
+
+
+@pytest.fixture(scope='module')
+def index():
+    return thar_lines.LineIndex(linelist_file, badlams_file)
+
+
+def test_read_badlams():
+    entries = thar_lines.read_badlams(badlams_file)
+    assert len(entries) == 26
+    assert entries[0] == thar_lines.BadLam('x', 772.61, 12., 3)
+    wentries = [entry for entry in entries if entry.etype == 'w']
+    assert wentries == [thar_lines.BadLam('w', 764.5, 5., 0), thar_lines.BadLam('w', 692.45, 3.55, 0),
+                        thar_lines.BadLam('w', 689.5, 2.8, 0), thar_lines.BadLam('w', 596.915, 0.01, 0)]
+    assert all(isinstance(entry.ehht, int) for entry in entries)
+
+
+def test_read_badlams_short_lines(tmpdir):
+    filename = str(tmpdir.join('badlams.txt'))
+    with open(filename, 'w') as outfile:
+        outfile.write('Bad wavelengths\ntype lam_cen halfwidth halfheight\nw 500.0 1.5\n\nx 600.0 10 2.0\n')
+    assert thar_lines.read_badlams(filename) == [thar_lines.BadLam('w', 500., 1.5, 0),
+                                                 thar_lines.BadLam('x', 600., 10., 2)]
+    with open(filename, 'a') as outfile:
+        outfile.write('w 700.0\n')
+    with pytest.raises(ValueError):
+        thar_lines.read_badlams(filename)
+
+
+def test_w_ranges_are_left_out_for_star_fibers(index):
+    wentries = [entry for entry in thar_lines.read_badlams(badlams_file) if entry.etype == 'w']
+    inrange = np.zeros(len(index.linelam), dtype=bool)
+    for entry in wentries:
+        inrange |= np.abs(index.linelam - entry.elam) <= entry.ehwid
+    assert inrange.sum() == 49
+    np.testing.assert_array_equal(index.bad[0], inrange)
+    np.testing.assert_array_equal(index.bad[2], inrange)
+    assert not index.bad[1].any()
+    np.testing.assert_array_equal(index.keptlam[1], index.linelam)
+    np.testing.assert_array_equal(index.keptlam[0], index.linelam[~inrange])
+
+    # a list line in a 'w' range matches itself for fiber 1, but not for fibers 0 and 2
+    k = np.flatnonzero(inrange)[0]
+    nearest, diff, matched = index.match([index.linelam[k]] * 3, np.array([0, 1, 2]), 1.e-4)
+    assert nearest[1] == k and diff[1] == 0. and matched[1]
+    assert nearest[0] != k and nearest[2] != k
+
+
+def brute_force_match(linelam, kept, lam, tol):
+    dist = np.abs(lam[:, np.newaxis] - linelam[kept][np.newaxis, :])
+    nearest = kept[np.argmin(dist, axis=1)]
+    return nearest, lam - linelam[nearest], dist.min(axis=1) <= tol
+
+
+@pytest.mark.parametrize('fibno', [0, 1, 2])
+def test_match_nearest_line(index, fibno):
+    rng = np.random.default_rng(fibno)
+    lam = rng.uniform(360., 880., 5000)
+    tol = 0.005
+    nearest, diff, matched = index.match(lam, fibno, tol)
+    expected = brute_force_match(index.linelam, index.kept[fibno], lam, tol)
+    # the list has a few duplicated wavelengths, so compare the lines rather than their indexes
+    np.testing.assert_array_equal(index.linelam[nearest], index.linelam[expected[0]])
+    assert np.isin(nearest, index.kept[fibno]).all()
+    np.testing.assert_allclose(diff, expected[1], rtol=0., atol=1.e-12)
+    np.testing.assert_array_equal(matched, expected[2])
+    assert 0 < matched.sum() < len(lam)
+
+
+def test_match_tol_window(index):
+    linelam = index.linelam
+    # an isolated line, so its neighbours do not fall in the window
+    gaps = np.diff(linelam)
+    k = np.flatnonzero((gaps[:-1] > 0.1) & (gaps[1:] > 0.1))[0] + 1
+    lam = linelam[k] + np.array([-0.0101, -0.0099, 0., 0.0099, 0.0101])
+    nearest, diff, matched = index.match(lam, 1, 0.01)
+    np.testing.assert_array_equal(nearest, k)
+    np.testing.assert_allclose(diff, lam - linelam[k])
+    np.testing.assert_array_equal(matched, [False, True, True, True, False])
+    lo, hi = index.window(lam, 1, 0.01)
+    np.testing.assert_array_equal(hi - lo, [0, 1, 1, 1, 0])
+
+
+def test_match_list_edges(index):
+    linelam = index.linelam
+    lam = np.array([300., linelam[0], linelam[-1], 900.])
+    nearest, diff, matched = index.match(lam, 1, 0.01)
+    np.testing.assert_array_equal(nearest, [0, 0, len(linelam) - 1, len(linelam) - 1])
+    np.testing.assert_allclose(diff, [300. - linelam[0], 0., 0., 900. - linelam[-1]])
+    np.testing.assert_array_equal(matched, [False, True, True, False])
+
+
+def test_xbad(tmpdir):
+    filename = str(tmpdir.join('badlams.txt'))
+    with open(filename, 'w') as outfile:
+        outfile.write('Bad wavelengths\ntype lam_cen halfwidth halfheight\n')
+        outfile.write('x 525.0 3 1\n')      # x = 50 in order 2
+        outfile.write('x 500.02 4 2\n')     # x = 0 in order 0, so the box is clipped
+        outfile.write('w 530.0 1.0 0\n')    # not a box
+    index = thar_lines.LineIndex(linelist_file, filename)
+    nx, nord = 100, 5
+    lam1 = 500. + 10. * np.arange(nord)[np.newaxis, :] + 0.1 * np.arange(nx)[:, np.newaxis]
+
+    iord = np.array([2, 2, 2, 2, 1, 3, 0, 4, 0, 0, 2, 2, 3])
+    xpos = np.array([50., 47., 53., 53.5, 48., 52., 50., 50., 4., 4.5, 0., 30., 99.])
+    expected = [True, True, True, False, True, True, False, False, True, False, True, False, False]
+    np.testing.assert_array_equal(index.xbad(lam1, iord, xpos), expected)
+    # scalar iord broadcasts against xpos
+    np.testing.assert_array_equal(index.xbad(lam1, 2, np.array([46., 50., 54.])), [False, True, False])
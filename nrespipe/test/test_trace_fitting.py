@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import numpy as np
 from nrespipe.traces import get_log_distances, get_pixel_scale_ratio_and_rotation, fit_warping_polynomial, find_best_offset
+from nrespipe.traces import linear_grid_metrics, grid_search_offset, pairwise_geometry
+from scipy.spatial import cKDTree
 from nrespipe.utils import warp_coordinates
 from astropy.table import Table
 import pytest
@@ -33,16 +35,62 @@ def test_log_distances_rectangle():
     np.testing.assert_allclose(actual, expected, atol=1e-5)
 
 
-@pytest.mark.skip(reason='Needs to be vetted')
+def test_pairwise_geometry_rectangle():
+    x = np.array([-3.0, 2.0, 2.0, -3.0])
+    y = np.array([-1.0, -1.0, 6.0, 6.0])
+    diagonal_angle = np.arctan2(7.0, 5.0)
+    expected = [0.0, diagonal_angle, np.pi / 2.0, np.pi / 2.0, np.pi - diagonal_angle, 0.0]
+    _, actual = pairwise_geometry(x, y)
+    np.testing.assert_allclose(actual, expected, atol=1e-10)
+
+
+def test_pairwise_geometry_chunked():
+    x = np.random.uniform(0.0, 4096.0, size=101)
+    y = np.random.uniform(0.0, 4096.0, size=101)
+    expected_log_distances, expected_angles = pairwise_geometry(x, y)
+    rows, columns = np.triu_indices(len(x), 1)
+    np.testing.assert_allclose(expected_log_distances, np.log(np.hypot(x[columns] - x[rows], y[columns] - y[rows])))
+    for chunk_size in [1, 7, 100, 1000]:
+        log_distances, angles = pairwise_geometry(x, y, chunk_size=chunk_size)
+        np.testing.assert_allclose(log_distances, expected_log_distances)
+        np.testing.assert_allclose(angles, expected_angles)
+
+
 def test_scale_offset():
     x = np.random.uniform(-100.0, 100.0, size=30)
     y = np.random.uniform(-100.0, 100.0, size=30)
     reference_catalog = Table({'x':x, 'y': y})
-    for scale in [0.1, 0.5, 1.0, 2.0, 3.0, 10.0]:
+    for scale in [0.5, 1.0, 1.05, 2.0, 3.0]:
         expected = scale
         input_catalog = Table({'x': scale * x, 'y': scale * y})
-        actual = get_pixel_scale_ratio(input_catalog, reference_catalog)
-        np.testing.assert_allclose(actual, expected, atol=1e-3)
+        actual = get_pixel_scale_ratio_and_rotation(input_catalog, reference_catalog)
+        np.testing.assert_allclose(actual['scale'], expected, rtol=1e-3)
+        np.testing.assert_allclose(actual['rotation'], 0.0, atol=5e-3)
+
+
+@pytest.mark.parametrize('mode', ['coarse', 'coarse_to_fine'])
+def test_scale_and_rotation(mode):
+    x = np.random.uniform(0.0, 4096.0, size=200)
+    y = np.random.uniform(0.0, 4096.0, size=200)
+    reference_catalog = Table({'x': x, 'y': y})
+    scale = 1.03
+    rotation = -0.2
+    input_x = scale * (np.cos(rotation) * x - np.sin(rotation) * y) + 12.0 + np.random.normal(0.0, 0.2, size=200)
+    input_y = scale * (np.sin(rotation) * x + np.cos(rotation) * y) - 7.0 + np.random.normal(0.0, 0.2, size=200)
+    # Lose some of the sources and add some spurious ones
+    kept = np.random.uniform(size=200) > 0.2
+    input_catalog = Table({'x': np.hstack([input_x[kept], np.random.uniform(0.0, 4096.0, size=30)]),
+                           'y': np.hstack([input_y[kept], np.random.uniform(0.0, 4096.0, size=30)])})
+
+    actual = get_pixel_scale_ratio_and_rotation(input_catalog, reference_catalog, mode=mode)
+    tolerance = 0.005 if mode == 'coarse' else 5e-4
+    np.testing.assert_allclose(actual['scale'], scale, rtol=tolerance)
+    np.testing.assert_allclose(actual['rotation'], rotation, atol=0.02 if mode == 'coarse' else 0.005)
+
+    unrelated_catalog = Table({'x': np.random.uniform(0.0, 4096.0, size=200),
+                               'y': np.random.uniform(0.0, 4096.0, size=200)})
+    unrelated = get_pixel_scale_ratio_and_rotation(unrelated_catalog, reference_catalog, mode=mode)
+    assert actual['significance'] > 5 * unrelated['significance']
 
 
 @pytest.mark.slow
@@ -123,3 +171,48 @@ def test_find_best_offset():
 
     actual = find_best_offset(Table({'x': shifted_x, 'y': shifted_y}), reference_catalog, scale)
     np.testing.assert_allclose([actual['x'], actual['y']], expected, atol=1e-4, rtol=0.0)
+
+
+def test_find_best_offset_shift_scale():
+    x = np.random.uniform(-100.0, 100.0, size=30)
+    y = np.random.uniform(-100.0, 100.0, size=30)
+    reference_catalog = Table({'x': x, 'y': y})
+
+    scale = 1.05
+    x_shift = 3.3
+    y_shift = -4.6
+    shifted_x, shifted_y = warp_coordinates(x, y, [x_shift, scale, 0.0, y_shift, 0.0, scale], 1)
+
+    actual = find_best_offset(Table({'x': shifted_x, 'y': shifted_y}), reference_catalog, scale)
+    np.testing.assert_allclose([actual['x'], actual['y']], [x_shift, y_shift], atol=0.051)
+
+
+def test_grid_metrics_match_serial_metric():
+    x = np.random.uniform(-100.0, 100.0, size=30)
+    y = np.random.uniform(-100.0, 100.0, size=30)
+    scale = 1.05
+    shifted_x, shifted_y = warp_coordinates(x, y, [3.0, scale, 0.0, -4.0, 0.0, scale], 1)
+    input_tree = cKDTree(np.column_stack([shifted_x, shifted_y]))
+
+    x_shifts = np.array([-25.0, 0.0, 3.0, 10.0])
+    y_shifts = np.array([25.0, 0.0, -4.0, -7.0])
+    # Use a small chunk size to exercise the batching
+    actual = linear_grid_metrics(input_tree, Table({'x': x, 'y': y}), scale, x_shifts, y_shifts,
+                                 max_points_per_query=70)
+    for metric, x_shift, y_shift in zip(actual, x_shifts, y_shifts):
+        distances, _ = input_tree.query(np.column_stack([x_shift + scale * x, y_shift + scale * y]), k=2)
+        matches = distances[:, 0] <= 25
+        expected = (distances[matches, 0] ** 2).sum() / (distances[matches, 1] ** 2).sum()
+        np.testing.assert_allclose(metric, expected)
+    assert np.argmin(actual) == 2
+
+
+@pytest.mark.parametrize('grid_search', ['full', 'coarse_to_fine'])
+def test_grid_search_offset(grid_search):
+    x = np.random.uniform(-100.0, 100.0, size=30)
+    y = np.random.uniform(-100.0, 100.0, size=30)
+    scale = 1.05
+    shifted_x, shifted_y = warp_coordinates(x, y, [12.0, scale, 0.0, -7.0, 0.0, scale], 1)
+    input_tree = cKDTree(np.column_stack([shifted_x, shifted_y]))
+    actual = grid_search_offset(input_tree, Table({'x': x, 'y': y}), scale, grid_search=grid_search)
+    assert actual == (12, -7)
@@ -0,0 +1,305 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pytest
+from astropy.io import fits
+from nrespipe import settings
+from nrespipe.utils import instrument_lock, get_md5, cache_md5, MD5Writer, md5_chunk_size, funpack
+from nrespipe.utils import download_from_s3, prefetch_frames, square_offset, offsets_within
+from nrespipe.utils import read_member_from_tarball, tarball_index_filename
+
+
+def test_instrument_lock_is_exclusive(tmpdir):
+    data_reduction_root = str(tmpdir)
+    acquired = threading.Event()
+
+    def take_lock():
+        with instrument_lock(data_reduction_root, 'lsc', 'nres01'):
+            acquired.set()
+
+    with instrument_lock(data_reduction_root, 'lsc', 'nres01'):
+        waiting_thread = threading.Thread(target=take_lock)
+        waiting_thread.start()
+        assert not acquired.wait(0.5)
+        # A different instrument is not blocked
+        with instrument_lock(data_reduction_root, 'elp', 'nres02'):
+            pass
+    assert acquired.wait(5)
+    waiting_thread.join()
+    assert os.path.exists(os.path.join(data_reduction_root, 'lsc', 'nres01', 'reduced', 'csv', '.nrespipe.lock'))
+
+
+def test_get_md5_streams_and_caches(tmpdir):
+    filepath = os.path.join(str(tmpdir), 'frame.fits')
+    data = os.urandom(3 * md5_chunk_size + 17)
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    assert get_md5(filepath) == hashlib.md5(data).hexdigest()
+
+    # A cached checksum is returned without rereading the file
+    cache_md5(filepath, 'cached')
+    assert get_md5(filepath) == 'cached'
+
+    # Rewriting the file changes its size so the cache entry no longer applies
+    with open(filepath, 'wb') as f:
+        f.write(data[:100])
+    assert get_md5(filepath) == hashlib.md5(data[:100]).hexdigest()
+
+
+def test_md5_writer(tmpdir):
+    filepath = os.path.join(str(tmpdir), 'frame.fits')
+    chunks = [os.urandom(1000) for _ in range(5)]
+    with open(filepath, 'wb') as f:
+        writer = MD5Writer(f)
+        for chunk in chunks:
+            writer.write(chunk)
+    assert writer.hexdigest() == hashlib.md5(b''.join(chunks)).hexdigest()
+    with open(filepath, 'rb') as f:
+        assert f.read() == b''.join(chunks)
+
+
+def make_compressed_frame(filepath, data):
+    primary_hdu = fits.PrimaryHDU(header=fits.Header([('SITEID', 'lsc')]))
+    image_hdu = fits.CompImageHDU(data, header=fits.Header([('OBSTYPE', 'TARGET')]), name='SPECTRUM')
+    table_hdu = fits.BinTableHDU.from_columns([fits.Column(name='JD_START', format='D', array=np.arange(3.0))],
+                                              name='EXPOSURE_METER')
+    fits.HDUList([primary_hdu, image_hdu, table_hdu]).writeto(filepath)
+
+
+def test_funpack_decompresses_in_process(tmpdir):
+    input_path = os.path.join(str(tmpdir), 'frame.fits.fz')
+    output_directory = str(tmpdir.mkdir('unpacked'))
+    data = np.random.randint(0, 65535, size=(50, 60)).astype(np.uint16)
+    make_compressed_frame(input_path, data)
+
+    output_path = funpack(input_path, output_directory)
+    assert output_path == os.path.join(output_directory, 'frame.fits')
+    with fits.open(output_path, do_not_scale_image_data=True) as hdulist:
+        assert [hdu.name for hdu in hdulist] == ['PRIMARY', 'SPECTRUM', 'EXPOSURE_METER']
+        assert hdulist['SPECTRUM'].data.dtype.itemsize == 2
+        assert hdulist['SPECTRUM'].header['BZERO'] == 32768
+    with fits.open(output_path) as hdulist:
+        np.testing.assert_array_equal(hdulist['SPECTRUM'].data, data)
+        assert hdulist['SPECTRUM'].header['OBSTYPE'] == 'TARGET'
+        np.testing.assert_array_equal(hdulist['EXPOSURE_METER'].data['JD_START'], np.arange(3.0))
+
+
+def test_funpack_restores_fpacked_primary(tmpdir):
+    input_path = os.path.join(str(tmpdir), 'frame.fits.fz')
+    data = np.random.randint(0, 65535, size=(50, 60)).astype(np.uint16)
+    make_compressed_frame(input_path, data)
+    # Mark the compressed image as having come from the primary HDU, the way fpack does
+    with fits.open(input_path, mode='update', disable_image_compression=True) as hdulist:
+        for keyword in ['ZTENSION', 'ZPCOUNT', 'ZGCOUNT']:
+            del hdulist[1].header[keyword]
+        hdulist[1].header.insert('ZBITPIX', ('ZSIMPLE', True))
+
+    output_path = funpack(input_path, str(tmpdir.mkdir('unpacked')))
+    with fits.open(output_path) as hdulist:
+        assert len(hdulist) == 2
+        np.testing.assert_array_equal(hdulist[0].data, data)
+        assert hdulist[0].header['OBSTYPE'] == 'TARGET'
+        assert hdulist[1].name == 'EXPOSURE_METER'
+
+
+def test_funpack_links_uncompressed_files(tmpdir):
+    input_path = os.path.join(str(tmpdir), 'frame.fits')
+    fits.PrimaryHDU(np.zeros((10, 10))).writeto(input_path)
+    output_path = funpack(input_path, str(tmpdir.mkdir('unpacked')))
+    assert os.path.samefile(input_path, output_path)
+
+
+class StubArchiveHandler(BaseHTTPRequestHandler):
+    """Serves frame records under /frames/ and file contents under /files/ with Range support"""
+    files = {}
+    # Number of bytes to send before dropping the connection on the next full (non-Range) request
+    truncate_after = None
+    honour_range = True
+    # Extra bytes to claim in Content-Length on the truncated response, so the client sees a short read
+    overstate_length = 0
+    # Content to serve in place of a file once its truncated response has been sent
+    replacement = None
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests_seen.append((self.path, self.headers.get('Range')))
+        name = self.path.split('/')[-1]
+        if self.path.startswith('/frames/'):
+            body = json.dumps({'filename': name + '.fits.fz',
+                               'url': 'http://{host}:{port}/files/{name}'.format(host=self.server.server_address[0],
+                                                                                 port=self.server.server_address[1],
+                                                                                 name=name)}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        content = self.files[name]
+        requested_range = self.headers.get('Range')
+        if requested_range and self.honour_range:
+            start = int(requested_range.replace('bytes=', '').rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{total}'.format(total=len(content)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {start}-{end}/{total}'.format(start=start, end=len(content) - 1,
+                                                                                  total=len(content)))
+            content = content[start:]
+        else:
+            self.send_response(200)
+        if self.truncate_after is not None and not requested_range:
+            self.send_header('Content-Length', str(len(content) + self.overstate_length))
+            self.end_headers()
+            self.wfile.write(content[:self.truncate_after])
+            StubArchiveHandler.truncate_after = None
+            if self.replacement is not None:
+                self.files[name] = self.replacement
+            self.close_connection = True
+            return
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def stub_archive(monkeypatch):
+    StubArchiveHandler.files = {str(i): os.urandom(3 * md5_chunk_size + i) for i in range(6)}
+    StubArchiveHandler.truncate_after = None
+    StubArchiveHandler.honour_range = True
+    StubArchiveHandler.overstate_length = 0
+    StubArchiveHandler.replacement = None
+    StubArchiveHandler.requests_seen = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubArchiveHandler)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    monkeypatch.setattr(settings, 'ARCHIVE_FRAME_URL',
+                        'http://127.0.0.1:{port}/frames/'.format(port=server.server_address[1]))
+    yield StubArchiveHandler
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_from_s3_streams_to_disk(tmpdir, stub_archive):
+    path = download_from_s3('1', str(tmpdir))
+    assert path == os.path.join(str(tmpdir), '1.fits.fz')
+    with open(path, 'rb') as f:
+        assert f.read() == stub_archive.files['1']
+    assert get_md5(path) == hashlib.md5(stub_archive.files['1']).hexdigest()
+
+
+def test_download_resumes_with_range_request(tmpdir, stub_archive):
+    stub_archive.truncate_after = md5_chunk_size + 5
+    path = download_from_s3('2', str(tmpdir))
+    with open(path, 'rb') as f:
+        assert f.read() == stub_archive.files['2']
+    file_requests = [request for request in stub_archive.requests_seen if request[0].startswith('/files/')]
+    assert file_requests[-1][1] is not None and file_requests[-1][1] != 'bytes=0-'
+    assert get_md5(path) == hashlib.md5(stub_archive.files['2']).hexdigest()
+
+
+def test_download_restarts_if_range_is_ignored(tmpdir, stub_archive):
+    stub_archive.truncate_after = 1000
+    stub_archive.honour_range = False
+    path = download_from_s3('3', str(tmpdir))
+    with open(path, 'rb') as f:
+        assert f.read() == stub_archive.files['3']
+    assert get_md5(path) == hashlib.md5(stub_archive.files['3']).hexdigest()
+
+
+def test_download_complete_when_resume_is_out_of_range(tmpdir, stub_archive):
+    # The whole file arrives but the connection drops early, so the resumed request asks for nothing
+    stub_archive.truncate_after = len(stub_archive.files['4'])
+    stub_archive.overstate_length = 10
+    path = download_from_s3('4', str(tmpdir))
+    with open(path, 'rb') as f:
+        assert f.read() == stub_archive.files['4']
+    assert get_md5(path) == hashlib.md5(stub_archive.files['4']).hexdigest()
+    file_requests = [request for request in stub_archive.requests_seen if request[0].startswith('/files/')]
+    assert len(file_requests) == 2
+
+
+def test_download_restarts_if_resume_is_rejected(tmpdir, stub_archive):
+    # The file shrinks after the first part is sent, so the server answers the resumed request with 416
+    stub_archive.truncate_after = md5_chunk_size
+    stub_archive.replacement = os.urandom(md5_chunk_size // 2)
+    path = download_from_s3('5', str(tmpdir))
+    with open(path, 'rb') as f:
+        assert f.read() == stub_archive.replacement
+    assert get_md5(path) == hashlib.md5(stub_archive.replacement).hexdigest()
+
+
+def test_prefetch_frames_in_order(tmpdir, stub_archive):
+    frameids = ['0', '1', '2', '3', '4', '5']
+    downloaded = []
+    for frameid, download in prefetch_frames(frameids, str(tmpdir), n_ahead=2):
+        path = download.result()
+        with open(path, 'rb') as f:
+            assert f.read() == stub_archive.files[frameid]
+        os.remove(path)
+        downloaded.append(frameid)
+    assert downloaded == frameids
+
+
+def test_square_offset_matches_brute_force():
+    x1, y1 = np.random.uniform(0, 100, size=(2, 40))
+    x2, y2 = np.random.uniform(0, 100, size=(2, 25))
+    square_distances = (x1[:, None] - x2[None, :]) ** 2 + (y1[:, None] - y2[None, :]) ** 2
+    expected = np.sort(square_distances, axis=1).T
+    np.testing.assert_allclose(square_offset(x1, y1, x2, y2), expected[0])
+    np.testing.assert_allclose(square_offset(x1, y1, x2, y2, ranks=[0, 1]), expected[:2])
+
+
+def test_offsets_within():
+    x1, y1 = np.random.uniform(0, 100, size=(2, 40))
+    x2, y2 = np.random.uniform(0, 100, size=(2, 25))
+    x_offsets = (x2[None, :] - x1[:, None]).ravel()
+    y_offsets = (y2[None, :] - y1[:, None]).ravel()
+    close = np.logical_and(np.abs(x_offsets) <= 10, np.abs(y_offsets) <= 10)
+    actual = offsets_within(x1, y1, x2, y2, 10)
+    assert sorted(zip(actual['x'], actual['y'])) == pytest.approx(sorted(zip(x_offsets[close], y_offsets[close])))
+
+
+def make_tarball(tar_filename, members):
+    with tarfile.open(tar_filename, 'w:gz') as tar_file:
+        for name, data in members:
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar_file.addfile(member, io.BytesIO(data))
+
+
+def test_read_member_from_tarball(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'tarball_index_directory', str(tmpdir.join('tarball_index')))
+    tar_filename = os.path.join(str(tmpdir.mkdir('specproc')), 'frame.tar.gz')
+    members = [('frame/frame.fits.fz', os.urandom(100000)), ('frame/frame.pdf', os.urandom(5000)),
+               ('frame/README', b'readme')]
+    make_tarball(tar_filename, members)
+
+    assert read_member_from_tarball(tar_filename, 'frame/frame.pdf') == members[1][1]
+    # The index goes in the cache directory, not next to the tarball
+    assert os.path.dirname(tarball_index_filename(tar_filename)) == settings.tarball_index_directory
+    assert os.listdir(os.path.dirname(tar_filename)) == ['frame.tar.gz']
+    # Streaming stops at the requested member, so the index only has the members up to it
+    with open(tarball_index_filename(tar_filename)) as index_file:
+        assert sorted(json.load(index_file)['members']) == ['frame/frame.fits.fz', 'frame/frame.pdf']
+    # Read again through the index
+    assert read_member_from_tarball(tar_filename, 'frame/frame.pdf') == members[1][1]
+    assert read_member_from_tarball(tar_filename, 'frame/frame.fits.fz') == members[0][1]
+    assert read_member_from_tarball(tar_filename, 'frame/missing.pdf') is None
+
+    # A rewritten tarball invalidates the index
+    new_members = [('frame/frame.pdf', b'new pdf')]
+    make_tarball(tar_filename, new_members)
+    os.utime(tar_filename, ns=(0, 0))
+    assert read_member_from_tarball(tar_filename, 'frame/frame.pdf') == b'new pdf'
@@ -1,6 +1,6 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import numpy as np
-from nrespipe.utils import evaluate_poly_coords, warp_coordinates
+from nrespipe.utils import evaluate_poly_coords, warp_coordinates, PolynomialBasis
 
 def test_shift_in_x():
     x = np.arange(100)
@@ -76,3 +76,26 @@ def test_warping_coordiantes():
                                                  y_shift, y_xscale, y_x2coeff, y_yscale, y_crossterm, y_y2coeff], 2)
     np.testing.assert_allclose(actual_x, expected_x, atol=1e-5)
     np.testing.assert_allclose(actual_y, expected_y, atol=1e-5)
+
+
+def test_polynomial_basis_batches_parameter_sets():
+    x = np.arange(100)
+    y = np.arange(-100, 0)
+    basis = PolynomialBasis(x, y, 2)
+    params = np.random.uniform(-1, 1, size=(7, 12))
+
+    batch_x, batch_y = basis.warp(params)
+    assert batch_x.shape == (7, 100)
+    for i in range(len(params)):
+        expected_x, expected_y = warp_coordinates(x, y, params[i], 2)
+        np.testing.assert_allclose(batch_x[i], expected_x)
+        np.testing.assert_allclose(batch_y[i], expected_y)
+
+
+def test_polynomial_basis_scalar_coordinates():
+    coeffs = [4.3, 0.03, 6e-4, 1.10, 5e-4, 5e-5]
+    x, y = 500.0, 1250.0
+    expected = 4.3 + 0.03 * x + 6e-4 * x * x + 1.10 * y + 5e-4 * x * y + 5e-5 * y * y
+    actual = evaluate_poly_coords(x, y, coeffs, 2)
+    assert np.shape(actual) == ()
+    np.testing.assert_allclose(actual, expected)
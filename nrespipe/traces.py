@@ -1,8 +1,13 @@
+import logging
+import time
 import numpy as np
 from astropy.io import fits
 from nrespipe import utils
-from nrespipe.utils import warp_coordinates, square_offset, n_poly_coefficients
+from nrespipe.utils import n_poly_coefficients, PolynomialBasis
 from scipy import optimize
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger('nrespipe')
 
 
 def overlay_traces(trace_file, fibers, output_region_filename, pixel_sampling=20):
@@ -38,90 +43,359 @@ def overlay_traces(trace_file, fibers, output_region_filename, pixel_sampling=20
         output_region_file.write(ds9_lines)
 
 
-def get_pixel_scale_ratio_and_rotation(sources, reference_catalog):
+def get_pixel_scale_ratio_and_rotation(sources, reference_catalog, mode='coarse_to_fine', max_log_scale=np.log(4.0),
+                                       coarse_log_bin=0.005, coarse_angle_bin=0.02,
+                                       fine_log_bin=0.0002, fine_angle_bin=0.005):
     """
-
-    :param sources:
-    :param reference_catalog:
-    :return:
+    Find the scale and rotation that convert the reference catalog to the input catalog
+
+    Parameters
+    ----------
+    sources : astropy.table.Table
+              Measured sources with x and y columns
+    reference_catalog : astropy.table.Table
+                        Reference sources with x and y columns
+    mode : str
+           'coarse' only correlates binned histograms of the pair geometry.
+           'coarse_to_fine' then refines the peak at the fine bin sizes in a small window.
+    max_log_scale : float
+                    Largest |ln(scale)| to search
+    coarse_log_bin, coarse_angle_bin : float
+                                       Bin sizes of the coarse histograms in ln(pixels) and radians
+    fine_log_bin, fine_angle_bin : float
+                                   Bin sizes used for the refinement
+
+    Returns
+    -------
+    result : dict
+             'scale': input / reference pixel scale ratio,
+             'rotation': rotation of the input relative to the reference in radians in [-pi/2, pi/2),
+             'significance': height of the coarse correlation peak above the median of the
+             background subtracted correlation surface in units of its robust standard deviation
 
     Notes
     -----
     This roughly follows what scamp does which follows Kaiser+ 1999 https://arxiv.org/abs/astro-ph/9907229.
-    This calculates the scale to convert the reference to input.
-
-    In principle, one could use the ransac algorithm here to get the homography and
-    kd trees here to speed up the distance calculations.
+    A scale change shifts the log separations of all pairs and a rotation shifts their position angles,
+    so the peak of the cross-correlation of the 2-D (log separation, position angle) histograms gives both.
+
+    The correlation is done with FFTs. The angle axis is periodic (with period pi), so it is correlated
+    circularly. The log separation axis is zero padded by the largest lag we search so that it does not wrap.
+    The coarse histograms are a few thousand by a few hundred bins. The refinement correlates the 1-D
+    marginal histograms at the fine bin sizes and only keeps lags within two coarse bins of the coarse peak,
+    so the full-resolution 2-D histograms are never made.
     """
-    # Calculate the log distance between every pair of sources
-    input_log_distances = get_log_distances(sources)
-    input_position_angles = get_position_angles(sources)
+    if mode not in ['coarse', 'coarse_to_fine']:
+        raise ValueError('Unknown correlation mode: {mode}'.format(mode=mode))
+
+    # Calculate the log distance and position angle between every pair of sources
+    input_log_distances, input_position_angles = pairwise_geometry(sources['x'], sources['y'])
+    reference_log_distances, reference_position_angles = pairwise_geometry(reference_catalog['x'],
+                                                                           reference_catalog['y'])
+    # Use the same log distance bin edges for both catalogs so that a lag in bins is a shift in ln(scale)
+    log_distance_range = (min(input_log_distances.min(), reference_log_distances.min()),
+                          max(input_log_distances.max(), reference_log_distances.max()))
+
+    coarse_correlation, log_lags, angle_lags = correlate_histograms(input_log_distances, input_position_angles,
+                                                                    reference_log_distances,
+                                                                    reference_position_angles,
+                                                                    log_distance_range, coarse_log_bin,
+                                                                    coarse_angle_bin, max_log_scale)
+    # Unrelated pairs give a background that depends on the scale lag but hardly on the rotation, so remove it
+    # row by row. Otherwise it dominates both the peak and the scatter used for the significance.
+    coarse_correlation -= np.median(coarse_correlation, axis=1, keepdims=True)
+    peak_log_index, peak_angle_index = np.unravel_index(np.argmax(coarse_correlation), coarse_correlation.shape)
+    log_scale = log_lags[peak_log_index]
+    rotation = angle_lags[peak_angle_index]
+
+    median_correlation = np.median(coarse_correlation)
+    robust_std = 1.4826 * np.median(np.abs(coarse_correlation - median_correlation))
+    if robust_std > 0:
+        significance = (coarse_correlation.max() - median_correlation) / robust_std
+    else:
+        significance = np.inf if coarse_correlation.max() > median_correlation else 0.0
+
+    if mode == 'coarse_to_fine':
+        log_correlation, log_lags = correlate_marginal(input_log_distances, reference_log_distances,
+                                                       log_distance_range, fine_log_bin, max_log_scale)
+        in_window = np.abs(log_lags - log_scale) <= 2.0 * coarse_log_bin
+        log_scale = log_lags[in_window][np.argmax(log_correlation[in_window])]
+
+        angle_correlation, angle_lags = correlate_marginal(input_position_angles, reference_position_angles,
+                                                           (0.0, np.pi), fine_angle_bin, None)
+        # Angles wrap, so measure the distance from the coarse rotation around the circle
+        angle_difference = (angle_lags - rotation + np.pi / 2.0) % np.pi - np.pi / 2.0
+        in_window = np.abs(angle_difference) <= 2.0 * coarse_angle_bin
+        rotation = angle_lags[in_window][np.argmax(angle_correlation[in_window])]
+
+    return {'scale': np.exp(log_scale), 'rotation': (rotation + np.pi / 2.0) % np.pi - np.pi / 2.0,
+            'significance': significance}
+
+
+def _fft_correlate(input_histogram, reference_histogram, max_log_lag):
+    """
+    correlation[lag] = sum_i input_histogram[i + lag] * reference_histogram[i] along every axis using FFTs
 
-    reference_log_distances = get_log_distances(reference_catalog)
-    reference_position_angles = get_position_angles(reference_catalog)
+    The first axis is zero padded so that lags up to max_log_lag bins do not wrap. The other axes are circular.
+    """
+    n_padded = input_histogram.shape[0] + max_log_lag
+    axes = tuple(range(input_histogram.ndim))
+    shape = (n_padded,) + input_histogram.shape[1:]
+    correlation = np.fft.irfftn(np.fft.rfftn(input_histogram, shape, axes=axes) *
+                                np.conj(np.fft.rfftn(reference_histogram, shape, axes=axes)), shape, axes=axes)
+    # Lags run from -max_log_lag to max_log_lag along the first axis
+    return np.concatenate([correlation[n_padded - max_log_lag:], correlation[:max_log_lag + 1]])
 
-    # The maximum offset in the catalog is sqrt(2) * 4096
-    # Use a single pixel as the minimum offset bin
-    # Use bins of 1 / 4096 ~ 0.0002 so that we can account for scales down to a pixel
-    scale_bins = np.arange(0.0, np.log(np.sqrt(2.0) * 4096) + 0.0002, 0.0002)
-    position_angle_bins = np.arange(0, np.pi + 0.1, 0.005)
 
-    # Make a histogram of the values
-    input_histogram = np.histogram2d(input_log_distances, input_position_angles, [scale_bins, position_angle_bins])[0]
-    reference_histogram = np.histogram2d(reference_log_distances, reference_position_angles, [scale_bins, position_angle_bins])[0]
+def correlate_histograms(input_log_distances, input_position_angles, reference_log_distances,
+                         reference_position_angles, log_distance_range, log_bin, angle_bin, max_log_scale):
+    """
+    Cross-correlate the 2-D (log separation, position angle) histograms of two catalogs
+
+    Returns
+    -------
+    correlation : array
+                  correlation[log lag, angle lag]
+    log_lags : array
+               ln(scale) of each row
+    angle_lags : array
+                 Rotation in [0, pi) of each column
+    """
+    n_angle_bins = int(np.round(np.pi / angle_bin))
+    n_log_bins = int(np.ceil((log_distance_range[1] - log_distance_range[0]) / log_bin)) + 1
+    bins = [log_distance_range[0] + log_bin * np.arange(n_log_bins + 1), np.linspace(0.0, np.pi, n_angle_bins + 1)]
+    input_histogram = np.histogram2d(input_log_distances, input_position_angles, bins)[0]
+    reference_histogram = np.histogram2d(reference_log_distances, reference_position_angles, bins)[0]
 
-    # Cross correlate the two histograms
-    correlation = np.correlate(input_histogram, reference_histogram, mode='full')
+    max_log_lag = min(int(np.ceil(max_log_scale / log_bin)), n_log_bins)
+    correlation = _fft_correlate(input_histogram, reference_histogram, max_log_lag)
+    log_lags = log_bin * np.arange(-max_log_lag, max_log_lag + 1)
+    angle_lags = np.pi / n_angle_bins * np.arange(n_angle_bins)
+    return correlation, log_lags, angle_lags
 
-    scale_offsets = np.arange(-max(scale_bins) + 0.0002, max(scale_bins) , 0.0002)
-    return np.exp(scale_offsets[np.argmax(correlation)]),
 
+def correlate_marginal(input_values, reference_values, value_range, bin_size, max_lag):
+    """
+    Cross-correlate 1-D histograms of two catalogs
+
+    Parameters
+    ----------
+    max_lag : float
+              Largest lag to keep. If None, the histogram is treated as circular over value_range
+              (used for position angles).
+
+    Returns
+    -------
+    correlation : array
+    lags : array
+           Lag of each element of correlation in the same units as the values
+    """
+    if max_lag is None:
+        n_bins = int(np.round((value_range[1] - value_range[0]) / bin_size))
+        bins = np.linspace(value_range[0], value_range[1], n_bins + 1)
+        bin_size = bins[1] - bins[0]
+    else:
+        n_bins = int(np.ceil((value_range[1] - value_range[0]) / bin_size)) + 1
+        bins = value_range[0] + bin_size * np.arange(n_bins + 1)
+    input_histogram = np.histogram(input_values, bins)[0].astype(float)
+    reference_histogram = np.histogram(reference_values, bins)[0].astype(float)
+    if max_lag is None:
+        correlation = np.fft.irfft(np.fft.rfft(input_histogram) * np.conj(np.fft.rfft(reference_histogram)), n_bins)
+        return correlation, bin_size * np.arange(n_bins)
+    max_lag_bins = min(int(np.ceil(max_lag / bin_size)), n_bins)
+    correlation = _fft_correlate(input_histogram, reference_histogram, max_lag_bins)
+    return correlation, bin_size * np.arange(-max_lag_bins, max_lag_bins + 1)
+
+
+def pairwise_geometry(x, y, chunk_size=None):
+    """
+    Log distance and position angle for every pair of sources
+
+    Parameters
+    ----------
+    x, y : array
+           Source positions
+    chunk_size : int
+                 Number of sources to pair with the rest of the catalog at a time. This bounds the size of the
+                 temporary arrays to chunk_size x n_sources. All sources are done at once if None.
+
+    Returns
+    -------
+    log_distances : array
+                    Natural log of the separation of each pair
+    position_angles : array
+                      Angle of the separation vector of each pair, measured from the x-axis in [0, pi).
 
-def calculated_pairwise(func, sources):
-    n_sources = len(sources)
-    results = np.zeros(utils.choose_2(n_sources))
-    # Go through every pair of sources, not double counting
+    Notes
+    -----
+    Pairs are ordered (0, 1), (0, 2), ..., (0, n-1), (1, 2), ..., (n-2, n-1), i.e. the upper triangle of the
+    pair matrix taken row by row, with each pair counted once. The direction of a separation vector
+    depends on which source comes first, so position angles are folded into [0, pi).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_sources = len(x)
+    if chunk_size is None:
+        chunk_size = max(n_sources, 1)
+
+    log_distances = np.zeros(utils.choose_2(n_sources))
+    position_angles = np.zeros(utils.choose_2(n_sources))
+    columns = np.arange(n_sources)
     start_index = 0
-    stop_index = n_sources - 1
-    for i, source in enumerate(sources[:-1]):
-        results[start_index:stop_index] = func(source, sources[i + 1:])
+    for start in range(0, max(n_sources - 1, 0), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, n_sources - 1))
+        # Only keep the pairs above the diagonal
+        upper_triangle = columns[None, :] > rows[:, None]
+        x_separations = (x[None, :] - x[rows, None])[upper_triangle]
+        y_separations = (y[None, :] - y[rows, None])[upper_triangle]
+        stop_index = start_index + len(x_separations)
+        log_distances[start_index:stop_index] = np.log(np.hypot(x_separations, y_separations))
+        position_angles[start_index:stop_index] = np.arctan2(y_separations, x_separations) % np.pi
         start_index = stop_index
-        stop_index += n_sources - i - 2
-    return results
+    return log_distances, position_angles
 
 
-def get_position_angles(sources):
-    return calculated_pairwise(utils.position_angle, sources)
+def get_position_angles(sources, chunk_size=None):
+    return pairwise_geometry(sources['x'], sources['y'], chunk_size=chunk_size)[1]
 
 
-def get_log_distances(sources):
-    distances =calculated_pairwise(utils.offset, sources)
-    return np.log(distances)
+def get_log_distances(sources, chunk_size=None):
+    return pairwise_geometry(sources['x'], sources['y'], chunk_size=chunk_size)[0]
 
 
 def find_best_offset(input_sources, reference_sources, scale_guess):
-    # calculate the x and y offsets for each pair of sources
-    all_pairwise_offsets = utils.calculate_offsets(scale_guess * reference_sources['x'],
-                                                   scale_guess * reference_sources['y'],
-                                                   input_sources['x'], input_sources['y'])
+    # calculate the x and y offsets (input - scaled reference) for each pair of sources
+    # Only pairs that fall inside the histogram can change the answer, so don't calculate the rest
+    close_pairwise_offsets = utils.offsets_within(scale_guess * reference_sources['x'],
+                                                  scale_guess * reference_sources['y'],
+                                                  input_sources['x'], input_sources['y'], 25.1)
     # make a 2D histogram of the results
     # Make bins with centers from -25 to 25 in steps of 0.1
     bins = np.arange(-25.05, 25.1, 0.1)
-    offset_histogram, xedges, yedges = np.histogram2d(all_pairwise_offsets['x'].flatten(),
-                                                      all_pairwise_offsets['y'].flatten(), bins=(bins, bins))
+    offset_histogram, xedges, yedges = np.histogram2d(close_pairwise_offsets['x'], close_pairwise_offsets['y'],
+                                                      bins=(bins, bins))
     # The peak in the histogram is the initial guess
-    peak_index = np.argmax(offset_histogram)
+    peak_x_index, peak_y_index = np.unravel_index(np.argmax(offset_histogram), offset_histogram.shape)
     # Get the location of the bin, add 0.05 to get the center instead of the edge
-    return {'x': xedges[peak_index] + 0.05, 'y': yedges[peak_index] + 0.05}
+    return {'x': xedges[peak_x_index] + 0.05, 'y': yedges[peak_y_index] + 0.05}
 
 
-def fit_warping_polynomial(input_sources, reference_sources, scale_guess, polynomial_order=3, matching_threshold=25):
+def linear_grid_metrics(input_tree, reference_sources, scale_guess, x_shifts, y_shifts, matching_threshold=25,
+                        max_points_per_query=2000000):
+    """
+    Evaluate the matching metric for a grid of shifts with a fixed scale in one batch
+
+    Parameters
+    ----------
+    input_tree : scipy.spatial.cKDTree
+                 KD-tree of the measured source positions
+    reference_sources : astropy.table.Table
+                        Reference catalog with x and y columns
+    scale_guess : float
+                  Scale to convert the reference positions to input positions
+    x_shifts, y_shifts : array
+                         Shifts to try (the same length)
+    matching_threshold : float
+                         Maximum distance for a reference source to count as matched
+    max_points_per_query : int
+                           Maximum number of shifted positions to send to the KD-tree at once (limits memory)
+
+    Returns
+    -------
+    metrics : array
+              Ratio of the sum of squared distances to the closest and second closest measured sources
+              for each shift. 1e10 where no sources are matched.
+
+    Notes
+    -----
+    This is the same metric as fit_warping_polynomial uses, restricted to the shift + scale transformations
+    used for the initial grid. All of the shifted reference catalogs are queried against the tree together.
+    """
+    reference_x = scale_guess * np.asarray(reference_sources['x'], dtype=float)
+    reference_y = scale_guess * np.asarray(reference_sources['y'], dtype=float)
+    x_shifts = np.asarray(x_shifts, dtype=float)
+    y_shifts = np.asarray(y_shifts, dtype=float)
+    metrics = np.zeros(len(x_shifts))
+    shifts_per_query = max(1, max_points_per_query // len(reference_x))
+    for start in range(0, len(x_shifts), shifts_per_query):
+        stop = start + shifts_per_query
+        model_x = x_shifts[start:stop, None] + reference_x[None, :]
+        model_y = y_shifts[start:stop, None] + reference_y[None, :]
+        distances, _ = input_tree.query(np.column_stack([model_x.ravel(), model_y.ravel()]), k=2)
+        distances = distances.reshape(model_x.shape + (2,))
+        square_distances = distances * distances
+        matches = distances[:, :, 0] <= matching_threshold
+        best = np.where(matches, square_distances[:, :, 0], 0.0).sum(axis=1)
+        second_best = np.where(matches, square_distances[:, :, 1], 0.0).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics[start:stop] = np.where(matches.any(axis=1), best / second_best, 1e10)
+    return metrics
+
+
+def grid_search_offset(input_tree, reference_sources, scale_guess, offset_guess=None, matching_threshold=25,
+                       grid_search='full'):
+    """
+    Find the best initial shift between the reference and input catalogs on a grid
+
+    Parameters
+    ----------
+    input_tree : scipy.spatial.cKDTree
+                 KD-tree of the measured source positions
+    reference_sources : astropy.table.Table
+                        Reference catalog with x and y columns
+    scale_guess : float
+                  Scale to convert the reference positions to input positions
+    offset_guess : dict
+                   'x' and 'y' offsets to center the grid on. The grid is centered on zero if None.
+    matching_threshold : float
+                         Maximum distance for a reference source to count as matched
+    grid_search : str
+                  'full' tries every pixel shift from -25 to 25 in x and y.
+                  'coarse_to_fine' tries every 5th pixel and then every pixel within 5 of the best coarse shift.
+
+    Returns
+    -------
+    x, y : float
+           Shift with the lowest matching metric
+    """
+    if offset_guess is None:
+        center_x, center_y = 0, 0
+    else:
+        center_x, center_y = np.round(offset_guess['x']), np.round(offset_guess['y'])
+
+    if grid_search == 'full':
+        steps = [(25, 1)]
+    elif grid_search == 'coarse_to_fine':
+        steps = [(25, 5), (5, 1)]
+    else:
+        raise ValueError('Unknown grid search mode: {mode}'.format(mode=grid_search))
+
+    for half_width, step in steps:
+        X, Y = np.meshgrid(np.arange(-half_width, half_width + 1, step) + center_x,
+                           np.arange(-half_width, half_width + 1, step) + center_y)
+        X = X.ravel()
+        Y = Y.ravel()
+        fit_metrics = linear_grid_metrics(input_tree, reference_sources, scale_guess, X, Y,
+                                          matching_threshold=matching_threshold)
+        center_x, center_y = X[np.argmin(fit_metrics)], Y[np.argmin(fit_metrics)]
+    return center_x, center_y
+
+
+def fit_warping_polynomial(input_sources, reference_sources, scale_guess, offset_guess=None, polynomial_order=3,
+                           matching_threshold=25, grid_search='full'):
     # Warp the coordinates using a polynomial to figure out what the shifts are
+    # The powers of the reference coordinates don't change, so only calculate them once
+    reference_basis = PolynomialBasis(reference_sources['x'], reference_sources['y'], polynomial_order)
+    # The measured sources don't move either, so index them once for the nearest neighbour searches
+    input_tree = cKDTree(np.column_stack([np.asarray(input_sources['x'], dtype=float),
+                                          np.asarray(input_sources['y'], dtype=float)]))
 
     def model_function(params):
-        model_x, model_y = warp_coordinates(reference_sources['x'], reference_sources['y'], params, polynomial_order)
-        square_distances = square_offset(input_sources['x'], input_sources['y'], model_x, model_y, [0,1])
-        matches = square_distances[0] ** 0.5 <= matching_threshold
+        model_x, model_y = reference_basis.warp(params)
+        # Distance from each warped reference source to its closest and second closest measured source
+        distances, _ = input_tree.query(np.column_stack([model_x, model_y]), k=2)
+        square_distances = (distances * distances).T
+        matches = distances[:, 0] <= matching_threshold
         if matches.sum() == 0:
             metric = 1e10
         else:
@@ -130,27 +404,24 @@ def fit_warping_polynomial(input_sources, reference_sources, scale_guess, polyno
         return metric
 
     # Run a grid of -25 to 25 pixels and find the best initial guess
-    X, Y = np.meshgrid(np.arange(-25, 26), np.arange(-25, 26))
-    X = X.ravel()
-    Y = Y.ravel()
-    fit_metrics = np.zeros(51 * 51)
+    grid_start = time.time()
+    initial_x, initial_y = grid_search_offset(input_tree, reference_sources, scale_guess, offset_guess=offset_guess,
+                                              matching_threshold=matching_threshold, grid_search=grid_search)
+    grid_time = time.time() - grid_start
+
     n_coefficients = n_poly_coefficients(polynomial_order)
-    for i, (x, y) in enumerate(zip(X, Y)):
-        # Start with just the linear component
-        params = np.zeros(2 * n_coefficients)
-        params[0] = x
-        params[n_coefficients] = y
-        params[1] = scale_guess
-        params[n_coefficients + polynomial_order + 1] = scale_guess
-        fit_metrics[i] = model_function(params)
-
-    initial_x, initial_y = X[np.argmin(fit_metrics)], Y[np.argmin(fit_metrics)]
-
-    params = np.zeros(2 * n_poly_coefficients(polynomial_order))
+    # Start with just the linear component
+    params = np.zeros(2 * n_coefficients)
     params[0] = initial_x
     params[n_coefficients] = initial_y
     params[1] = scale_guess
     params[n_coefficients + polynomial_order + 1] = scale_guess
 
     # Run Nelder-Mead to find the initial shifts between the input catalog and the new files
-    return optimize.minimize(model_function, params, method='Nelder-Mead')['x']
+    optimizer_start = time.time()
+    best_fit = optimize.minimize(model_function, params, method='Nelder-Mead')['x']
+    optimizer_time = time.time() - optimizer_start
+    logger.info('Fit warping polynomial: grid search took {grid:.3f} s, optimizer took {optimizer:.3f} s'.format(
+        grid=grid_time, optimizer=optimizer_time),
+        extra={'tags': {'grid_search': grid_search, 'grid_time': grid_time, 'optimizer_time': optimizer_time}})
+    return best_fit
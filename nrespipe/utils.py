@@ -1,6 +1,11 @@
 import datetime
+import fcntl
+import gzip
 import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
 import sep
 import shutil
@@ -12,14 +17,18 @@ from email.mime.text import MIMEText
 from glob import glob
 from PyPDF2 import PdfFileReader, PdfFileWriter
 import tarfile
-import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 import requests
+from scipy.spatial import cKDTree
 from astropy.io import fits
 from astropy.table import Table
 from kombu import Connection, Exchange
 from time import sleep
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 
 from lco_ingester import ingester
 from lco_ingester.exceptions import RetryError, DoNotRetryError, BackoffRetryError, NonFatalDoNotRetryError
@@ -29,16 +38,49 @@ from nrespipe import dbs
 from nrespipe import settings
 from nrespipe.plots import plot_signal_to_noise
 
-from astroquery.simbad import Simbad
+from nrespipe.magnitudes import MagnitudeResolver, get_default_targets_filenames
 import re
 
 
 logger = logging.getLogger('nrespipe')
 
 
+# Read files in 1 MB chunks when calculating checksums so memory use does not depend on the file size
+md5_chunk_size = 1024 * 1024
+
+# Checksums of files we have already seen, keyed by (path, size, mtime)
+checksum_cache = OrderedDict()
+checksum_cache_size = 10000
+
+
+def _checksum_cache_key(filepath):
+    file_stats = os.stat(filepath)
+    return os.path.abspath(filepath), file_stats.st_size, file_stats.st_mtime_ns
+
+
+def cache_md5(filepath, md5):
+    """
+    Record the MD5 checksum of a file so that get_md5 does not need to reread it
+
+    Parameters
+    ----------
+    filepath : str
+               Full path to file
+    md5 : str
+          Hexadecimal representation of the MD5 checksum, e.g. calculated while the file was written
+
+    Notes
+    -----
+    The cache is keyed on the file size and modification time, so this must be called after the file is closed.
+    """
+    checksum_cache[_checksum_cache_key(filepath)] = md5
+    while len(checksum_cache) > checksum_cache_size:
+        checksum_cache.popitem(last=False)
+
+
 def get_md5(filepath):
     """
-    Calculate the MD% checksum of a file
+    Calculate the MD5 checksum of a file
 
     Parameters
     ----------
@@ -49,12 +91,49 @@ def get_md5(filepath):
     -------
     md5 : str
           Hexadecimal representation of the MD5 checksum
+
+    Notes
+    -----
+    The file is read in chunks of md5_chunk_size bytes. If a file with the same path, size and modification time
+    has already been hashed, the cached checksum is returned without reading the file.
     """
+    cache_key = _checksum_cache_key(filepath)
+    if cache_key in checksum_cache:
+        checksum_cache.move_to_end(cache_key)
+        return checksum_cache[cache_key]
+
+    md5 = hashlib.md5()
     with open(filepath, 'rb') as file:
-        md5 = hashlib.md5(file.read()).hexdigest()
+        for chunk in iter(lambda: file.read(md5_chunk_size), b''):
+            md5.update(chunk)
+    md5 = md5.hexdigest()
+    cache_md5(filepath, md5)
     return md5
 
 
+class MD5Writer(object):
+    """
+    Wrap a binary file object to calculate the MD5 checksum of everything written to it
+
+    Parameters
+    ----------
+    file : file object
+           File opened for writing in binary mode
+    md5 : hashlib md5 object
+          Running checksum to continue, e.g. when appending to a partially downloaded file
+    """
+    def __init__(self, file, md5=None):
+        self.file = file
+        self.md5 = hashlib.md5() if md5 is None else md5
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
 def need_to_process(filename, checksum, db_address):
     record = dbs.get_processing_state(filename, checksum, db_address)
     return not record.processed or checksum != record.checksum
@@ -179,23 +258,81 @@ def funpack(input_path, directory):
     directory : str
                 output directory
 
+    Returns
+    -------
+    output_path : str
+                  Path to the unpacked file
+
     Notes
     -----
-    If fits file is already unpacked, we just copy the file to the output directory
+    Tile compressed files are decompressed in this process with astropy rather than by running funpack,
+    following the same conventions as funpack: an image that fpack moved out of the primary HDU (ZSIMPLE = T) is
+    restored to the primary HDU, so extension numbers match the original file. Unsigned 16-bit data are written
+    back as 16-bit integers with BZERO = 32768, as in the original file.
 
+    If fits file is already unpacked, we hard link it into the output directory. We only fall back to
+    copying the file if the output directory is on a different file system.
     """
     if os.path.splitext(input_path)[1] == '.fz':
         uncompressed_filename = os.path.splitext(os.path.basename(input_path))[0]
         output_path = os.path.join(directory, uncompressed_filename)
-        os.system('funpack -O {0} {1}'.format(output_path, input_path))
+        with fits.open(input_path) as compressed_hdulist:
+            unpacked_hdulist = fits.HDUList()
+            for i, hdu in enumerate(compressed_hdulist):
+                if isinstance(hdu, fits.CompImageHDU):
+                    compressed_header = fits.getheader(input_path, i, disable_image_compression=True)
+                    if i == 1 and compressed_header.get('ZSIMPLE', False) and compressed_hdulist[0].data is None:
+                        # fpack moved the primary image into the first extension. Put it back.
+                        unpacked_hdulist = fits.HDUList()
+                        hdu_class = fits.PrimaryHDU
+                    else:
+                        hdu_class = fits.ImageHDU
+                    unpacked_hdulist.append(hdu_class(data=hdu.data, header=hdu.header.copy()))
+                else:
+                    unpacked_hdulist.append(hdu.copy())
+            unpacked_hdulist.writeto(output_path, output_verify='silentfix', overwrite=True)
 
     else:
         output_path = os.path.join(directory, os.path.basename(input_path))
-        shutil.copy(input_path, directory)
+        try:
+            os.link(input_path, output_path)
+        except OSError:
+            shutil.copy(input_path, directory)
 
     return output_path
 
 
+@contextmanager
+def instrument_lock(data_reduction_root, site, nres_instrument):
+    """
+    Hold an exclusive lock on the reduced/csv directory of an NRES instrument
+
+    Parameters
+    ----------
+    data_reduction_root : str
+                          Top level directory for reduced data
+    site : str
+           Site ID (e.g. elp)
+    nres_instrument : str
+                      NRES instance (e.g. nres01)
+
+    Notes
+    -----
+    The IDL pipeline reads and rewrites the shared tables in reduced/csv (standards.csv, zeros.csv, etc.)
+    without any locking of its own. Jobs for the same instrument therefore have to run one at a time, while jobs for
+    different instruments can run in parallel. The lock is an advisory flock, so it also serializes jobs
+    running in different worker processes.
+    """
+    csv_directory = os.path.join(data_reduction_root, site, nres_instrument, 'reduced', 'csv')
+    os.makedirs(csv_directory, exist_ok=True)
+    with open(os.path.join(csv_directory, '.nrespipe.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def copy_to_final_directory(file_to_upload, data_reduction_root, site, nres_instrument, dayobs):
     """
     Copy the product from the IDL pipeline in beammeup.txt to its final resting place (folder)
@@ -386,29 +523,79 @@ def coordinate_variance(x, y, xerr2, yerr2):
     return (x * x * xerr2 + y * y * yerr2) / (x * x + y * y)
 
 
-def warp_coordinates(x, y, params, polynomial_order):
-    x_coeffs = params[:len(params) // 2]
-    warped_x = evaluate_poly_coords(x, y, x_coeffs, polynomial_order)
-    y_coeffs = params[len(params) // 2:]
-    warped_y  = evaluate_poly_coords(x, y, y_coeffs, polynomial_order)
-    return warped_x, warped_y
+class PolynomialBasis(object):
+    """
+    The monomials x ** i * y ** j of a 2-D polynomial evaluated once for a fixed set of coordinates
+
+    Parameters
+    ----------
+    x, y : float or array
+           Coordinates to evaluate the polynomial at
+    order : int
+            Order of the polynomial
+
+    Notes
+    -----
+    The monomials follow the same coefficient ordering as evaluate_poly_coords: the power of y is the outer index
+    and the power of x is the inner index, i.e. 1, x, x^2, ..., y, xy, ..., y^order.
+    Evaluating the polynomial is then a single matrix product. Coefficients can also be a 2-D array
+    (n_parameter_sets, n_coefficients), in which case every parameter set is evaluated at once.
+    """
+    def __init__(self, x, y, order):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.shape = x.shape
+        self.order = order
+        self.n_coefficients = n_poly_coefficients(order)
+
+        powers = np.arange(order + 1)[:, None]
+        x_powers = x.ravel()[None, :] ** powers
+        y_powers = y.ravel()[None, :] ** powers
+        # matrix[n_coefficients, n_points]
+        self.matrix = np.array([x_powers[i] * y_powers[j] for j in range(order + 1) for i in range(order - j + 1)])
+
+    def evaluate(self, coeffs):
+        """
+        Evaluate the polynomial for one or more sets of coefficients
+
+        Parameters
+        ----------
+        coeffs : array
+                 n_coefficients or (n_parameter_sets, n_coefficients)
+
+        Returns
+        -------
+        values : array
+                 Same shape as the input coordinates, with a leading axis of n_parameter_sets if coeffs is 2-D
+        """
+        coeffs = np.asarray(coeffs, dtype=float)
+        values = coeffs @ self.matrix
+        return values.reshape(coeffs.shape[:-1] + self.shape)
+
+    def warp(self, params):
+        """
+        Warp the coordinates with separate polynomials in x and y
+
+        Parameters
+        ----------
+        params : array
+                 x coefficients followed by y coefficients: 2 * n_coefficients
+                 or (n_parameter_sets, 2 * n_coefficients)
+
+        Returns
+        -------
+        warped_x, warped_y : array
+        """
+        params = np.asarray(params, dtype=float)
+        return self.evaluate(params[..., :self.n_coefficients]), self.evaluate(params[..., self.n_coefficients:])
 
 
-def position_angle(source0, sources):
-    # law of cosines u dot v / mag(u) (mag v) = cos theta
-    length = lambda x: (x['x'] ** 2.0  + x['y'] * 2.0) ** 0.5
-    cos_theta =  (source0['x'] * sources['x'] + source0['y'] * sources['y']) / (length(source0) * length(sources))
-    return np.arccos(cos_theta)
+def warp_coordinates(x, y, params, polynomial_order):
+    return PolynomialBasis(x, y, polynomial_order).warp(params)
 
 
 def evaluate_poly_coords(x, y, coeffs, order):
-    warped_x = 0.0
-    coeff_index = 0
-    for j in range(order + 1):
-        for i in range(order - j + 1):
-            warped_x += coeffs[coeff_index] * (x ** i) * (y ** j)
-            coeff_index += 1
-    return warped_x
+    return PolynomialBasis(x, y, order).evaluate(coeffs)
 
 
 def calculate_offsets(x1, y1, x2, y2):
@@ -419,18 +606,66 @@ def calculate_offsets(x1, y1, x2, y2):
 
 
 def square_offset(x1, y1, x2, y2, ranks=0):
-    # Calculate the pairwise distance between all of the points
-    xdiff = x1 - np.tile(x2, (len(x1), 1)).T
-    ydiff = y1 - np.tile(y2, (len(y1), 1)).T
-    offsets = xdiff * xdiff + ydiff * ydiff
+    """
+    Squared distance from each point in set 1 to its nearest neighbours in set 2
+
+    Parameters
+    ----------
+    x1, y1 : array
+             Coordinates of the points to match
+    x2, y2 : array
+             Coordinates of the points to match against
+    ranks : int or list of int
+            0 for the nearest neighbour, 1 for the second nearest, etc.
+
+    Returns
+    -------
+    square_distances : array
+                       square_distances[rank, n_star1] (or square_distances[n_star1] if ranks is an int)
+
+    Notes
+    -----
+    This uses a KD-tree on set 2 rather than the full n_star1 x n_star2 distance matrix.
+    If set 2 has fewer points than a requested rank, the distance is infinite.
+    """
+    tree = cKDTree(np.column_stack([np.asarray(x2, dtype=float), np.asarray(y2, dtype=float)]))
+    n_neighbours = np.max(ranks) + 1
+    distances, _ = tree.query(np.column_stack([np.asarray(x1, dtype=float), np.asarray(y1, dtype=float)]),
+                              k=n_neighbours)
+    distances = distances.reshape(len(distances), n_neighbours)
+    return (distances * distances).T[ranks]
+
 
-    # Offsets now has the distance
-    # offsets[n_star2, n_star1]
-    # Sort by distance
-    offsets.sort(axis=0)
+def offsets_within(x1, y1, x2, y2, max_offset):
+    """
+    Offsets (x2 - x1, y2 - y1) for every pair of points that are within a box of a given half-width
+
+    Parameters
+    ----------
+    x1, y1 : array
+             Coordinates of the first set of points
+    x2, y2 : array
+             Coordinates of the second set of points
+    max_offset : float
+                 Only pairs with both |x2 - x1| and |y2 - y1| <= max_offset are returned
+
+    Returns
+    -------
+    offsets : dict
+              'x' and 'y' offsets of all of the close pairs as 1-D arrays
 
-    # return the offset of the closest match
-    return offsets[ranks]
+    Notes
+    -----
+    Pairs are found with a KD-tree on the second set, so the cost scales with the number of close
+    pairs rather than with n1 x n2.
+    """
+    tree = cKDTree(np.column_stack([np.asarray(x2, dtype=float), np.asarray(y2, dtype=float)]))
+    points = np.column_stack([np.asarray(x1, dtype=float), np.asarray(y1, dtype=float)])
+    neighbours = tree.query_ball_point(points, r=max_offset, p=np.inf)
+    n_neighbours = np.array([len(neighbour) for neighbour in neighbours], dtype=int)
+    indices1 = np.repeat(np.arange(len(points)), n_neighbours)
+    indices2 = np.concatenate(neighbours).astype(int) if n_neighbours.sum() > 0 else np.zeros(0, dtype=int)
+    return {'x': tree.data[indices2, 0] - points[indices1, 0], 'y': tree.data[indices2, 1] - points[indices1, 1]}
 
 
 def offset(source, catalog):
@@ -483,19 +718,170 @@ def send_email(subject, recipient_emails, sender_email, sender_password, email_b
     server.quit()
 
 
-def extract_from_pdfs(input_directory, extraction_function):
-    # Get all of the tar files in the input_directory
-    tar_files = glob(os.path.join(input_directory, '*.tar.gz'))
+def tarball_index_filename(tar_filename):
+    """
+    Path of the member index for a tarball, in settings.tarball_index_directory
+
+    Notes
+    -----
+    The index file is named for a hash of the tarball's absolute path, so nothing is written next to the
+    tarballs. The size and mtime of the tarball are saved in the index and checked when it is read.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(tar_filename).encode()).hexdigest()
+    return os.path.join(settings.tarball_index_directory, path_hash + '.json')
+
+
+def _read_tarball_index(tar_filename):
+    # The index is only valid for the exact tarball it was made from
+    try:
+        with open(tarball_index_filename(tar_filename)) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+    file_stats = os.stat(tar_filename)
+    if index.get('path') != os.path.abspath(tar_filename) or index.get('size') != file_stats.st_size or \
+            index.get('mtime_ns') != file_stats.st_mtime_ns:
+        return None
+    return index
+
+
+def _write_tarball_index(tar_filename, members):
+    file_stats = os.stat(tar_filename)
+    index = {'path': os.path.abspath(tar_filename), 'size': file_stats.st_size, 'mtime_ns': file_stats.st_mtime_ns,
+             'members': members}
+    index_filename = tarball_index_filename(tar_filename)
+    try:
+        os.makedirs(os.path.dirname(index_filename), exist_ok=True)
+        # Unique temporary name, as the same tarball can be read by more than one process at a time
+        temp_filename = '{filename}.{pid}.tmp'.format(filename=index_filename, pid=os.getpid())
+        with open(temp_filename, 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_filename, index_filename)
+    except OSError as e:
+        # The index only saves time, so carry on without it.
+        logger.debug('Could not write tarball index: {exception}'.format(exception=e),
+                     extra={'tags': {'filename': os.path.basename(tar_filename)}})
+
+
+def read_member_from_tarball(tar_filename, member_name):
+    """
+    Read a single file from a gzipped tarball without unpacking the rest of it
+
+    Parameters
+    ----------
+    tar_filename : str
+                   Full path to the .tar.gz file
+    member_name : str
+                  Name of the file in the tarball
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for tar_filename in tar_files:
-            basename = os.path.basename(tar_filename).replace('.tar.gz', '')
-            with tarfile.open(tar_filename) as open_tar_file:
-                # Extract the pdf file from the tar directory into a temporary directory
-                open_tar_file.extract('{basename}/{basename}.pdf'.format(basename=basename), path=temp_dir)
-                tmp_pdf_filename = os.path.join(temp_dir, basename, '{basename}.pdf'.format(basename=basename))
-                pdf_reader = PdfFileReader(tmp_pdf_filename)
-                extraction_function(pdf_reader)
+    Returns
+    -------
+    data : bytes or None
+           Contents of the member. None if the tarball does not contain it.
+
+    Notes
+    -----
+    The first time a tarball is read, its members are streamed in order and decompression stops as soon as the
+    requested member has been read. The uncompressed offsets and sizes of the members seen are saved in an index
+    in settings.tarball_index_directory (see tarball_index_filename()). Later reads seek straight to the member
+    with the index. Gzip does not support random access, so the stream is still decompressed up to the member,
+    but none of the tar headers are parsed and nothing after the member is read.
+    """
+    index = _read_tarball_index(tar_filename)
+    if index is not None and member_name in index['members']:
+        offset, size = index['members'][member_name]
+        with gzip.open(tar_filename) as gzip_file:
+            gzip_file.seek(offset)
+            return gzip_file.read(size)
+
+    members = {}
+    data = None
+    with tarfile.open(tar_filename, 'r|gz') as open_tar_file:
+        for member in open_tar_file:
+            members[member.name] = [member.offset_data, member.size]
+            if member.name == member_name:
+                data = open_tar_file.extractfile(member).read()
+                break
+    _write_tarball_index(tar_filename, members)
+    return data
+
+
+def read_pdf_from_tarball(tar_filename):
+    """
+    Read the summary pdf from a reduced frame's tarball
+
+    Returns
+    -------
+    tar_filename : str
+    pdf_data : bytes or None
+               None if the tarball does not contain the pdf
+    """
+    basename = os.path.basename(tar_filename).replace('.tar.gz', '')
+    return tar_filename, read_member_from_tarball(tar_filename, '{basename}/{basename}.pdf'.format(basename=basename))
+
+
+def read_pdfs_from_tarballs(tar_files, n_processes=None):
+    """
+    Read the summary pdfs out of reduced frame tarballs
+
+    Parameters
+    ----------
+    tar_files : list of str
+                Full paths to the .tar.gz files
+    n_processes : int
+                  Number of tarballs to decompress at once. Defaults to settings.tarball_scan_processes.
+
+    Yields
+    ------
+    tar_filename : str
+    pdf_data : bytes
+               Tarballs without a summary pdf are logged and skipped
+
+    Notes
+    -----
+    The tarballs are read in a process pool and the pdfs are passed back as bytes, in the order of tar_files.
+    Celery worker processes are daemons and cannot start a process pool, so threads are used there instead
+    (zlib releases the GIL while it decompresses).
+    """
+    if n_processes is None:
+        n_processes = settings.tarball_scan_processes
+    if not tar_files:
+        return
+
+    if n_processes > 1 and not multiprocessing.current_process().daemon:
+        executor = ProcessPoolExecutor(max_workers=n_processes)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max(n_processes, 1))
+    with executor:
+        for tar_filename, pdf_data in executor.map(read_pdf_from_tarball, tar_files):
+            if pdf_data is None:
+                logger.error('No summary pdf found in tarball', extra={'tags': {'filename': os.path.basename(tar_filename)}})
+                continue
+            yield tar_filename, pdf_data
+
+
+def extract_from_pdfs(input_directory, extraction_function, n_processes=None):
+    """
+    Run a function on the summary pdf of every reduced frame tarball in a directory
+
+    Parameters
+    ----------
+    input_directory : str
+                      Directory with the .tar.gz files
+    extraction_function : callable
+                          Called with a PdfFileReader for each pdf, in the order of the tarballs
+    n_processes : int
+                  Number of tarballs to decompress at once. Defaults to settings.tarball_scan_processes.
+
+    Notes
+    -----
+    The pdfs are read with read_pdfs_from_tarballs(), so extraction_function runs in this process and can
+    update local state.
+    """
+    # Get all of the tar files in the input_directory
+    tar_files = sorted(glob(os.path.join(input_directory, '*.tar.gz')))
+    for tar_filename, pdf_data in read_pdfs_from_tarballs(tar_files, n_processes=n_processes):
+        extraction_function(PdfFileReader(io.BytesIO(pdf_data)))
 
 
 def make_summary_pdf(input_directory, output_pdf_filename):
@@ -506,15 +892,34 @@ def make_summary_pdf(input_directory, output_pdf_filename):
         pdf_writer.write(output_stream)
 
 
-def make_signal_to_noise_pdf(input_directories, sites, daysobs, output_text_filenames, output_pdf_filename):
+def make_signal_to_noise_pdf(input_directories, sites, daysobs, output_text_filenames, output_pdf_filename,
+                             signal_to_noise_rows=None):
 
-    signal_to_noise_table = Table(names=['target', 'mag', 'sn', 'exptime', 'site', 'dayobs'], dtype=('S60', np.float,
-                                                                                                     np.float, np.float,
+    signal_to_noise_table = Table(names=['target', 'mag', 'sn', 'exptime', 'site', 'dayobs'], dtype=('S60', float,
+                                                                                                     float, float,
                                                                                                      'S3', 'S8'))
-    for input_directory, site, dayobs, output_text_filename in zip(input_directories, sites, daysobs, output_text_filenames):
-        extraction_function = lambda pdf_reader: extract_signal_to_noise_from_pdf(pdf_reader, signal_to_noise_table, site, dayobs)
-        # Extract the Signal to noise
-        extract_from_pdfs(input_directory, extraction_function)
+    if signal_to_noise_rows is None:
+        signal_to_noise_rows = [None] * len(input_directories)
+    for input_directory, rows, site, dayobs in zip(input_directories, signal_to_noise_rows, sites, daysobs):
+        # Use the S/N saved as each frame was reduced if we have it. Otherwise, dig it out of the tarballs.
+        if rows is not None:
+            for row in rows:
+                signal_to_noise_table.add_row(row)
+        else:
+            extraction_function = lambda pdf_reader: extract_signal_to_noise_from_pdf(pdf_reader, signal_to_noise_table,
+                                                                                      site, dayobs, lookup_magnitude=False)
+            # Extract the Signal to noise
+            extract_from_pdfs(input_directory, extraction_function)
+
+    # Look up all of the missing magnitudes together rather than one Simbad query per frame
+    missing_magnitudes = np.isnan(signal_to_noise_table['mag'])
+    if missing_magnitudes.any():
+        target_names = [target.decode() if isinstance(target, bytes) else str(target)
+                        for target in signal_to_noise_table['target'][missing_magnitudes]]
+        magnitudes = get_magnitude_resolver().get_magnitudes(target_names)
+        signal_to_noise_table['mag'][missing_magnitudes] = [magnitudes[target_name] for target_name in target_names]
+
+    for site, dayobs, output_text_filename in zip(sites, daysobs, output_text_filenames):
         output_table = signal_to_noise_table[np.logical_and(signal_to_noise_table['site'] == site,
                                                             signal_to_noise_table['dayobs'] == dayobs)]
         if output_text_filename is not None:
@@ -523,17 +928,34 @@ def make_signal_to_noise_pdf(input_directories, sites, daysobs, output_text_file
     plot_signal_to_noise(output_pdf_filename, signal_to_noise_table, sites, daysobs)
 
 
-def extract_signal_to_noise_from_pdf(pdf_reader: PdfFileReader, output_table: Table, site: str, dayobs: str):
+def parse_signal_to_noise(pdf_reader: PdfFileReader, site: str, dayobs: str, lookup_magnitude: bool = True):
+    """
+    Get the S/N row for a frame from the first page of its summary pdf
+
+    Returns
+    -------
+    row : dict or None
+          target, mag, sn, exptime, site and dayobs. None if the S/N could not be found.
+          mag is nan if lookup_magnitude is False.
+    """
     pdf_text_to_search = pdf_reader.getPage(0).extractText()
     # parse the output with an easy to read regex.
     regex = '^([\w_\s\+-]+)\,\s.+expt\s?=\s?(\d+) s\,.+N=\s*(\d+\.\d+),'
     m = re.search(regex, pdf_text_to_search)
-    if m is not None:
-        output_table.add_row({'target': m.group(1), 'mag': get_mag_from_simbad(m.group(1)),
-                              'sn': m.group(3), 'exptime': m.group(2), 'site': site, 'dayobs': dayobs})
-    else:
+    if m is None:
         logger.error("Failed to extract S/N", extra={'tags': {'regex': regex,
                                                               'search_text': pdf_text_to_search}})
+        return None
+    mag = get_mag_from_simbad(m.group(1)) if lookup_magnitude else np.nan
+    return {'target': m.group(1), 'mag': mag, 'sn': float(m.group(3)),
+            'exptime': float(m.group(2)), 'site': site, 'dayobs': dayobs}
+
+
+def extract_signal_to_noise_from_pdf(pdf_reader: PdfFileReader, output_table: Table, site: str, dayobs: str,
+                                     lookup_magnitude: bool = True):
+    signal_to_noise_row = parse_signal_to_noise(pdf_reader, site, dayobs, lookup_magnitude=lookup_magnitude)
+    if signal_to_noise_row is not None:
+        output_table.add_row(signal_to_noise_row)
 
 
 def get_missing_files(raw_directory, specproc_directory):
@@ -552,36 +974,194 @@ def get_calibration_files_taken(raw_directory):
     return bias_files, dark_files, flat_files, arc_files
 
 
-target_name_translations = {'PSIPHE' : 'psi Phe',
-                            'MUCAS' : 'mu Cas',
-                            'KS18C14487' :'TYC 8856-529-1',
-                            'BD093070': 'BD-09 3070'}
+# Magnitude resolvers keyed by process id so forked workers each read and write the cache themselves
+magnitude_resolvers = {}
+
+
+def get_magnitude_resolver():
+    """
+    Get the cached Simbad magnitude resolver for this process, configured from the settings
+
+    Returns
+    -------
+    resolver : nrespipe.magnitudes.MagnitudeResolver
+    """
+    if os.getpid() not in magnitude_resolvers:
+        if settings.simbad_offline_targets:
+            targets_filenames = settings.simbad_offline_targets.split(',')
+        else:
+            targets_filenames = get_default_targets_filenames(settings.data_reduction_root)
+        magnitude_resolvers[os.getpid()] = MagnitudeResolver(cache_filename=settings.simbad_cache_filename,
+                                                             ttl=settings.simbad_cache_ttl,
+                                                             negative_ttl=settings.simbad_negative_cache_ttl,
+                                                             offline=bool(settings.simbad_offline),
+                                                             targets_filenames=targets_filenames)
+    return magnitude_resolvers[os.getpid()]
 
 
 def get_mag_from_simbad(target_name : str):
+    return get_magnitude_resolver().get_magnitude(target_name)
+
+
+# requests sessions keyed by process id so forked workers don't share keep-alive connections
+archive_sessions = {}
+
+
+def get_archive_session():
+    """
+    Get the requests session used to talk to the archive from this process
+
+    Returns
+    -------
+    session : requests.Session
+
+    Notes
+    -----
+    Reusing the session keeps connections to the archive API and to S3 alive between frames.
+    The connection pool is big enough for the prefetch threads in prefetch_frames.
+    """
+    if os.getpid() not in archive_sessions:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, settings.archive_prefetch_count + 1))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        archive_sessions[os.getpid()] = session
+    return archive_sessions[os.getpid()]
+
+
+def content_range_total(content_range):
+    """
+    Total size in bytes from a Content-Range header (e.g. 'bytes */1234' or 'bytes 0-99/1234'), or None
+    if the header is missing or the size is unknown
+    """
     try:
-        simbad_query = Simbad()
-        simbad_query.add_votable_fields('flux(V)')
+        return int(content_range.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def download_file(url, output_path, session=None, max_attempts=5, retry_delay=1.0, timeout=60):
+    """
+    Stream a file to disk, resuming with an HTTP Range request if the transfer is interrupted
+
+    Parameters
+    ----------
+    url : str
+          URL of the file to download
+    output_path : str
+                  Full path to write the file to
+    session : requests.Session
+              Session to use for the requests. Defaults to the shared archive session.
+    max_attempts : int
+                   Number of times to try before giving up
+    retry_delay : float
+                  Seconds to wait before the first retry. This doubles after each failed attempt.
+    timeout : float
+              Seconds to wait for the server to respond
+
+    Returns
+    -------
+    md5 : str
+          Hexadecimal representation of the MD5 checksum of the downloaded file
 
-        search_name = target_name.split('_')[0]
-        if search_name in target_name_translations:
-            search_name = target_name_translations[search_name]
-        logger.info('Querying Simbad for {target}'.format(target=search_name))
-        result = simbad_query.query_object(search_name)
-        mag = float(result['FLUX_V'][0])
-    except Exception as e:
-        logger.error('Simbad query failed for {target}: {exeception}'.format(target=target_name, exeception=e))
-        mag = np.nan
+    Notes
+    -----
+    The checksum is calculated as the file is written and is added to the checksum cache used by get_md5.
+    If the server ignores the Range header, or rejects it (416) for a file of a different size than what
+    has been written, the download starts again from the beginning.
+    """
+    if session is None:
+        session = get_archive_session()
+
+    md5 = hashlib.md5()
+    bytes_written = 0
+    attempt = 1
+    while True:
+        headers = {'Range': 'bytes={start}-'.format(start=bytes_written)} if bytes_written else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if bytes_written and response.status_code == 416:
+                    # The server will not send anything from where we stopped: either we already have the
+                    # whole file or it has changed underneath us
+                    if content_range_total(response.headers.get('Content-Range')) == bytes_written:
+                        break
+                    logger.warning('Server rejected the resumed download. Starting over.',
+                                   extra={'tags': {'filename': os.path.basename(output_path)}})
+                    md5 = hashlib.md5()
+                    bytes_written = 0
+                    continue
+                response.raise_for_status()
+                if bytes_written and response.status_code != 206:
+                    logger.warning('Server does not support resuming downloads. Starting over.',
+                                   extra={'tags': {'filename': os.path.basename(output_path)}})
+                    md5 = hashlib.md5()
+                    bytes_written = 0
+                with open(output_path, 'ab' if bytes_written else 'wb') as f:
+                    writer = MD5Writer(f, md5=md5)
+                    for chunk in response.iter_content(chunk_size=md5_chunk_size):
+                        writer.write(chunk)
+                        bytes_written += len(chunk)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as exception:
+            if attempt >= max_attempts:
+                raise
+            logger.warning('Download interrupted after {n} bytes: {exception}. Retrying.'.format(n=bytes_written,
+                                                                                                  exception=exception),
+                           extra={'tags': {'filename': os.path.basename(output_path)}})
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+            attempt += 1
 
-    return mag
+    cache_md5(output_path, md5.hexdigest())
+    return md5.hexdigest()
 
 
-def download_from_s3(frameid, output_directory):
+def download_from_s3(frameid, output_directory, session=None):
+    if session is None:
+        session = get_archive_session()
     url = f'{settings.ARCHIVE_FRAME_URL}/{frameid}'
-    response = requests.get(url, headers=settings.ARCHIVE_AUTH_TOKEN, stream=True).json()
-    with open(os.path.join(output_directory, response['filename']), 'wb') as f:
-        f.write(requests.get(response['url']).content)
-    return os.path.join(output_directory, response['filename'])
+    response = session.get(url, headers=settings.ARCHIVE_AUTH_TOKEN)
+    response.raise_for_status()
+    frame = response.json()
+    output_path = os.path.join(output_directory, frame['filename'])
+    download_file(frame['url'], output_path, session=session)
+    return output_path
+
+
+def prefetch_frames(frameids, output_directory, n_ahead=2):
+    """
+    Download archive frames in background threads ahead of when they are needed
+
+    Parameters
+    ----------
+    frameids : iterable
+               Archive frame ids in the order they will be processed
+    output_directory : str
+                       Directory to download the frames into
+    n_ahead : int
+              Maximum number of downloads in flight while the caller works on the current frame
+
+    Yields
+    ------
+    frameid : int
+    download : concurrent.futures.Future
+               Call download.result() to get the path of the downloaded file. This raises if the download failed.
+
+    Notes
+    -----
+    At most n_ahead + 1 frames are on disk at a time, provided the caller deletes each file when it is done with it.
+    """
+    frameids = iter(frameids)
+    with ThreadPoolExecutor(max_workers=n_ahead) as executor:
+        downloads = deque()
+        for frameid in itertools.islice(frameids, n_ahead):
+            downloads.append((frameid, executor.submit(download_from_s3, frameid, output_directory)))
+        while downloads:
+            frameid, download = downloads.popleft()
+            # Queue up the next frame so n_ahead downloads run while the caller processes this one
+            next_frameid = next(frameids, None)
+            if next_frameid is not None:
+                downloads.append((next_frameid, executor.submit(download_from_s3, next_frameid, output_directory)))
+            yield frameid, download
 
 
 def ingest_file(file_path):
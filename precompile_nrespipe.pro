@@ -5,6 +5,7 @@ pro precompile_nrespipe
   endif else begin
     resolve_all,resolve_procedure='stack_nres_calibrations'
     resolve_all,resolve_procedure='run_nres_pipeline'
+    resolve_all,resolve_procedure='nres_idl_server'
     resolve_all,resolve_function='thar_mpfit'
     resolve_all,resolve_function='rv_mpfit'
     resolve_all,resolve_procedure='run_nres_trace_refine'
@@ -0,0 +1,236 @@
+'''
+Block-by-block radial velocity fits of a star spectrum against its ZERO
+spectrum, as done by the block loop of radial_velocity.pro, with
+blockfit2.pro and lsqblkfit2.pro.
+
+Each order is cut into nblock blocks, and in each block the lowpassed
+star spectrum d is fit by a redshifted, scaled copy of the ZERO spectrum z
+(already interpolated onto the star wavelength grid lam):
+    model = (z(lam*(1+rr)) - aa)*bb + aa
+Rather than fitting the blocks one at a time, all (order, block) pairs
+are stacked into (nblk,npt) arrays, and every Gauss-Newton iteration of
+lsqblkfit2 is done for all of them at once: the interpolation of the
+ZERO spectrum, the derivatives, and the solution of the 3x3 normal
+equations.  Blocks stop iterating as they converge (the redshift step
+is below delmin) or run away (|rr| >= rr0max), and keep their values
+while the others go on.  Blocks whose normal equations are singular, or
+that do not overlap the ZERO spectrum, stop at once and are flagged as
+failed rather than converged.
+'''
+import numpy as np
+
+c = 2.99792458e5          # speed of light, km/s
+delmin = 3.e-10           # 10 cm/s
+rr0max = 0.001            # 300 km/s = comparable to width of block
+itermax = 10              # max allowed number of iterations
+taper = np.array([0., .02, .10, .21, .35, .50, .65, .79, .90, .98])
+
+
+def interpol_quadratic(y, x, u):
+    '''
+    Quadratic interpolation of y(x) at u along the last axis, for each row
+    of (nblk,n) arrays, as IDL interpol(y,x,u,/quadratic) does.  Each row
+    of x must be monotonic.  Points outside x are extrapolated from the
+    parabola through the end points.
+    '''
+    nblk, n = x.shape
+    # make every row increasing, and stack the rows end to end so one searchsorted serves all of them
+    sign = np.where(x[:, -1] >= x[:, 0], 1., -1.)[:, np.newaxis]
+    xs = (x - x[:, :1]) * sign
+    us = (u - x[:, :1]) * sign
+    width = xs[:, -1].max() + 1.
+    offsets = width * np.arange(nblk)[:, np.newaxis]
+    rows = n * np.arange(nblk)[:, np.newaxis]
+    s = np.searchsorted((xs + offsets).ravel(), (us + offsets).ravel(), side='right').reshape(u.shape) - 1
+    s = np.clip(s - rows, 0, n - 3)
+    x0, x1, x2 = [np.take_along_axis(x, s + i, axis=-1) for i in range(3)]
+    y0, y1, y2 = [np.take_along_axis(y, s + i, axis=-1) for i in range(3)]
+    return (y0 * (u - x1) * (u - x2) / ((x0 - x1) * (x0 - x2)) +
+            y1 * (u - x0) * (u - x2) / ((x1 - x0) * (x1 - x2)) +
+            y2 * (u - x0) * (u - x1) / ((x2 - x0) * (x2 - x1)))
+
+
+def deriv(y):
+    '''
+    Derivative along the last axis by 3-point Lagrange differences, as IDL
+    deriv(y) does.
+    '''
+    return np.gradient(y, axis=-1, edge_order=2)
+
+
+def lsqblkfit(lamblock, zblock, dblock, wts):
+    '''
+    Iterated least-squares fit of the model (z(lam*(1+rr)) - aa)*bb + aa
+    to dblock, for every row of the (nblk,npt) arrays lamblock, zblock,
+    dblock and wts, as lsqblkfit2.pro does for one block.
+
+    Returns a dictionary with rr, aa and bb (nblk), cov(nblk,3,3), the
+    covariance of {rr, aa, bb}, converged (nblk, True where the last
+    redshift step was below delmin), failed (nblk, True where the fit
+    could not be done: no overlap with the ZERO spectrum or singular
+    normal equations), niter (nblk), and modelo and resido (nblk,npt),
+    the best-fit model and the residuals dblock - modelo.
+    '''
+    nblk, npt = dblock.shape
+    sumw = wts.sum(axis=-1)
+    uu0 = zblock - ((zblock * wts).sum(axis=-1) / sumw)[:, np.newaxis]
+    aa0 = (dblock * wts).sum(axis=-1) / sumw
+    # a flat ZERO block gives no first guess at bb; such blocks fail below
+    sumu2 = (uu0 ** 2 * wts).sum(axis=-1)
+    bb0 = np.where(sumu2 > 0., ((dblock - aa0[:, np.newaxis]) * uu0 * wts).sum(axis=-1) /
+                   np.where(sumu2 > 0., sumu2, 1.), 0.)
+    rr0 = np.zeros(nblk)
+    cov = np.zeros((nblk, 3, 3))
+    scale = np.zeros(nblk)
+    modelo = np.zeros((nblk, npt))
+    active = np.ones(nblk, dtype=bool)
+    converged = np.zeros(nblk, dtype=bool)
+    failed = np.zeros(nblk, dtype=bool)
+    niter = np.zeros(nblk, dtype=int)
+
+    for iteration in range(itermax):
+        if not active.any():
+            break
+        lamt = lamblock * (1. + rr0[:, np.newaxis])          # current redshifted wavelength array
+        dlamdx = deriv(lamt)
+        zbt = interpol_quadratic(zblock, lamblock, lamt)     # ZERO array on current lam grid
+        um = zbt - aa0[:, np.newaxis]
+        model = um * bb0[:, np.newaxis] + aa0[:, np.newaxis]
+        dzdx = deriv(model)
+        resid = dblock - model
+
+        # weighted normal equations for corrections to aa, bb and the shift in pixels, all blocks at once
+        funs = np.stack([np.ones_like(um), um, dzdx], axis=-1) * wts[..., np.newaxis]
+        alpha = np.einsum('bpi,bpj->bij', funs, funs)
+        beta = np.einsum('bpi,bp->bi', funs, resid * wts)
+        # blocks that do not overlap the ZERO spectrum, or give singular equations, are not changed and stop
+        ok = active & (np.abs(zbt).max(axis=-1) > 0.) & (np.abs(np.linalg.det(alpha)) > 0.)
+        alpha = np.where(ok[:, np.newaxis, np.newaxis], alpha, np.eye(3))
+        inverse = np.linalg.inv(alpha)
+        cc = np.where(ok[:, np.newaxis], np.einsum('bij,bj->bi', inverse, beta), 0.)
+
+        # modify model parameters
+        aa0 = aa0 + cc[:, 0]
+        bb0 = bb0 + cc[:, 1]
+        step = (dlamdx / lamt).mean(axis=-1)          # pix shift expressed as redshift
+        delrr = cc[:, 2] * step
+        rr0 = rr0 + delrr
+        niter += active
+        cov = np.where(ok[:, np.newaxis, np.newaxis], inverse, cov)
+        scale = np.where(active, step, scale)
+        modelo = np.where(active[:, np.newaxis], (zbt - aa0[:, np.newaxis]) * bb0[:, np.newaxis] +
+                          aa0[:, np.newaxis] + cc[:, 2, np.newaxis] * dzdx, modelo)
+
+        # we are finished if delrr is small enough, or if rr0 is too big
+        small = np.abs(delrr) <= delmin
+        failed |= active & ~ok
+        converged |= active & ok & small
+        active &= ok & ~small & (np.abs(rr0) < rr0max)
+
+    # reorder the covariance to {rr, aa, bb}, with the shift in pixels converted to redshift
+    transform = np.zeros((nblk, 3, 3))
+    transform[:, 0, 2] = scale
+    transform[:, 1, 0] = 1.
+    transform[:, 2, 1] = 1.
+    cov = np.einsum('bij,bjk,blk->bil', transform, cov, transform)
+    return {'rr': rr0, 'aa': aa0, 'bb': bb0, 'cov': cov, 'converged': converged, 'failed': failed,
+            'niter': niter, 'modelo': modelo, 'resido': dblock - modelo}
+
+
+def block_weights(dblock):
+    '''
+    Weights for each row of dblock(nblk,npt): 1, tapered over the first and
+    last 10 nonzero points.  Also returns a mask of the rows with more
+    than 20 nonzero points, which are the only ones blockfit2 fits.
+    '''
+    nonzero = dblock != 0.
+    count = np.cumsum(nonzero, axis=-1)
+    ns = count[:, -1:]
+    wts = np.ones(dblock.shape)
+    first = nonzero & (count <= 10)
+    last = nonzero & (count > ns - 10)
+    wts[first] = taper[count[first] - 1]
+    wts[last] = taper[::-1][(count - (ns - 10))[last] - 1]
+    return wts, ns[:, 0] > 20
+
+
+def pldp(lamblock, dblock):
+    '''
+    Photon-limited Doppler precision (km/s) of each row of dblock, taking
+    the values to be in e-, as in blockfit2.pro.
+    '''
+    npt = dblock.shape[-1]
+    dlamdx = (lamblock.max(axis=-1) - lamblock.min(axis=-1)) / (npt - 1)
+    lammid = 0.5 * (lamblock.max(axis=-1) + lamblock.min(axis=-1))
+    didlam = deriv(dblock) / dlamdx[:, np.newaxis]
+    pldpix = 1. / np.sqrt(np.maximum(didlam ** 2 / np.maximum(dblock, 1.), 1.e-20).sum(axis=-1))
+    return c * pldpix / lammid
+
+
+def fit_blocks(slam, zdat, sdat, nblock, lammin=None, lammax=None):
+    '''
+    Fit redshift and continuum scaling in every block of every order.
+    slam(nx,nord) is the star wavelength grid, zdat(nx,nord) the ZERO
+    spectrum interpolated onto it and sdat(nx,nord) the lowpassed star
+    spectrum, in the nres_comm layout.  Blocks are blen = nx//nblock pixels
+    long, starting at long(k*nx/nblock), as in radial_velocity.pro.  Blocks
+    with no data, or with wavelengths outside (lammin, lammax) (the range
+    of matched ThAr lines), are not fit and get zeros.
+
+    Returns a dictionary with rr, aa, bb, err (the formal uncertainty of
+    rr), eaa, ebb, pldp, converged, failed and niter, each (nord,nblock), cov
+    (nord,nblock,3,3), the covariance of {rr, aa, bb}, and modelo and
+    resido (nord,nblock,blen).
+    '''
+    nx, nord = slam.shape
+    blen = nx // nblock
+    bbot = (np.arange(nblock) * (nx / float(nblock))).astype(int)
+    columns = bbot[:, np.newaxis] + np.arange(blen)                 # (nblock,blen)
+    lamblock = slam.T[:, columns].reshape(nord * nblock, blen)
+    zblock = zdat.T[:, columns].reshape(nord * nblock, blen)
+    dblock = sdat.T[:, columns].reshape(nord * nblock, blen)
+
+    # check that the blocks contain data that make sense
+    good = (dblock.mean(axis=-1) != 0.) & (zblock.mean(axis=-1) != 0.)
+    if lammin is not None:
+        good &= lamblock.min(axis=-1) > lammin
+    if lammax is not None:
+        good &= lamblock.max(axis=-1) < lammax
+    wts, enough = block_weights(dblock)
+    good &= enough
+
+    nblk = nord * nblock
+    result = {'rr': np.zeros(nblk), 'aa': np.zeros(nblk), 'bb': np.zeros(nblk), 'cov': np.zeros((nblk, 3, 3)),
+              'converged': np.zeros(nblk, dtype=bool), 'failed': np.zeros(nblk, dtype=bool),
+              'niter': np.zeros(nblk, dtype=int),
+              'modelo': np.zeros((nblk, blen)), 'resido': np.zeros((nblk, blen)), 'pldp': np.zeros(nblk)}
+    if good.any():
+        fit = lsqblkfit(lamblock[good], zblock[good], dblock[good], wts[good])
+        for key, values in fit.items():
+            result[key][good] = values
+        result['pldp'][good] = pldp(lamblock[good], dblock[good])
+
+    variances = np.maximum(np.einsum('bii->bi', result['cov']), 0.)
+    result['err'], result['eaa'], result['ebb'] = np.sqrt(variances).T
+    return {key: values.reshape((nord, nblock) + values.shape[1:]) for key, values in result.items()}
+
+
+def robust_average(rr, err):
+    '''
+    Robust average of block redshifts rr with uncertainties err, over the
+    blocks where both are nonzero, as in radial_velocity.pro.  Blocks more
+    than 4 sigma (from the interquartile range) from the median are left
+    out.  Returns the weighted average, the median and the uncertainty of
+    the average, or zeros if there are no usable blocks.
+    '''
+    good = (rr != 0.) & (err != 0.)
+    if not good.any():
+        return 0., 0., 0.
+    rrg = rr[good]
+    errg = err[good]
+    q25, med, q75 = np.percentile(rrg, [25., 50., 75.])
+    sg = np.abs(rrg - med) <= 4. * (q75 - q25) / 1.35
+    if not sg.any():
+        return 0., 0., 0.
+    wts = 1. / errg[sg] ** 2
+    return (rrg[sg] * wts).sum() / wts.sum(), np.median(rrg[sg]), 1. / np.sqrt(wts.sum())
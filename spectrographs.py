@@ -0,0 +1,122 @@
+import csv
+import os
+import os.path
+from collections import namedtuple
+import numpy as np
+
+# Fields of one line of spectrographs.csv, in the order of the specdat structure made by get_specdat
+SpecDat = namedtuple('SpecDat', ['site', 'mjd', 'ord0', 'grspc', 'grinc', 'dgrinc', 'fl', 'dfl', 'y0', 'dy0',
+                                 'z0', 'dz0', 'gltype', 'apex', 'lamcen', 'rot', 'pixsiz', 'nx', 'nord',
+                                 'nblock', 'nfib', 'npoly', 'ordwid', 'medboxsz', 'sinalp', 'coefs', 'ncoefs',
+                                 'fibcoefs'])
+
+# spectrographs.csv column for each scalar field, and its type
+columns = [('site', 'Site', str), ('mjd', 'MJD', float), ('ord0', 'Ord0', int), ('grspc', 'GrSpc', float),
+           ('grinc', 'GrInc', float), ('dgrinc', 'dGrInc', float), ('fl', 'FL', float), ('dfl', 'dFL', float),
+           ('y0', 'Y0', float), ('dy0', 'dY0', float), ('z0', 'Z0', float), ('dz0', 'dZ0', float),
+           ('gltype', 'Glass', str), ('apex', 'Apex', float), ('lamcen', 'LamCen', float), ('rot', 'Rot', float),
+           ('pixsiz', 'PixSiz', float), ('nx', 'Nx', int), ('nord', 'Nord', int), ('nblock', 'Nblock', int),
+           ('nfib', 'Nfib', int), ('npoly', 'Npoly', int), ('ordwid', 'Ordwid', float),
+           ('medboxsz', 'Medboxsz', float)]
+ncoefs = 15
+coef_columns = ['C{i}'.format(i=i) for i in range(ncoefs)]
+fibcoef_columns = ['F{i:02d}'.format(i=i) for i in range(20)]
+
+
+def _read_only(values):
+    array = np.array(values, dtype=float)
+    array.flags.writeable = False
+    return array
+
+
+def _make_record(line):
+    '''
+    Turn one line of spectrographs.csv (a dictionary keyed by column name)
+    into a SpecDat.
+    '''
+    values = {}
+    for field, column, kind in columns:
+        value = line[column].strip()
+        values[field] = kind(float(value)) if kind is int else kind(value)
+    values['sinalp'] = np.sin(np.radians(values['grinc']))
+    values['coefs'] = _read_only([float(line[column]) for column in coef_columns])
+    values['ncoefs'] = ncoefs
+    # Two rows of 10, one for each of the fibers either side of the middle one, as in get_specdat.pro
+    values['fibcoefs'] = _read_only([float(line[column]) for column in fibcoef_columns]).reshape(2, 10)
+    return SpecDat(**values)
+
+
+class SpectrographRegistry(object):
+    '''
+    The lines of spectrographs.csv, parsed once per worker and reloaded
+    only when the file changes (its size or modification time differ).
+
+    Each line becomes a SpecDat: a read-only record with typed values and
+    numpy arrays for coefs (15) and fibcoefs (2 x 10).  The line chosen
+    for a site and date is the one get_specdat.pro picks: the smallest
+    mjd - MJD, which is the newest line for the site.
+
+    Usage:
+    registry = get_registry(nr.nresroot + 'reduced/csv/spectrographs.csv')
+    specdat = registry.get(nr.site, nr.mjdc)
+    specdats = registry.get_many(nr.site, mjds)
+    '''
+
+    def __init__(self, csv_file):
+        self.csv_file = csv_file
+        self.stat = None
+        self.sites = {}
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Re-read spectrographs.csv if it has changed.
+        '''
+        stat = os.stat(self.csv_file)
+        stat = (stat.st_size, stat.st_mtime_ns)
+        if stat == self.stat:
+            return
+        with open(self.csv_file) as csvfile:
+            records = [_make_record(line) for line in csv.DictReader(csvfile, skipinitialspace=True)]
+        sites = {}
+        for record in records:
+            sites.setdefault(record.site.upper(), []).append(record)
+        self.sites = {}
+        for site, site_records in sites.items():
+            # Kept in file order, so ties go to the earlier line, as with min() in get_specdat.pro
+            self.sites[site] = (np.array([record.mjd for record in site_records]), site_records)
+        self.stat = stat
+
+    def get_many(self, site, mjds):
+        '''
+        Return the SpecDat for each of mjds for a site: the line with the
+        smallest mjd - MJD, as in get_specdat.pro.  The entries are None if
+        the site is unknown.
+        '''
+        self.refresh()
+        mjds = np.atleast_1d(np.asarray(mjds, dtype=float))
+        if site.strip().upper() not in self.sites:
+            return [None] * len(mjds)
+        site_mjds, records = self.sites[site.strip().upper()]
+        indexes = np.argmin(mjds[:, np.newaxis] - site_mjds[np.newaxis, :], axis=1)
+        return [records[i] for i in indexes]
+
+    def get(self, site, mjd):
+        '''
+        Return the SpecDat for a site and mjd, or None if the site is unknown.
+        '''
+        return self.get_many(site, [mjd])[0]
+
+
+registries = {}
+
+
+def get_registry(csv_file):
+    '''
+    Return the SpectrographRegistry for a spectrographs.csv file, loading
+    it once per process.
+    '''
+    key = (os.path.abspath(csv_file), os.getpid())
+    if key not in registries:
+        registries[key] = SpectrographRegistry(csv_file)
+    return registries[key]
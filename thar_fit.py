@@ -0,0 +1,441 @@
+'''
+Wavelength solutions from ThAr spectra, as done by thar_fitall.pro,
+thar_mpfit.pro, thar_rcubic.pro and lambda3ofx.pro, but for many spectra
+at once.
+
+Each spectrum to be fit (one fiber of one ThAr frame; in reprocessing,
+every ThAr fiber of many DOUBLE frames) is a problem, described by a
+ThArLines record holding the fiber index and the catalog of lines found
+in it (as by thar_catalog.pro).  The lines of all problems are padded into
+(nprob,nline) arrays, so that every step of the fit is done for all
+problems together:
+
+ - The spectrograph model (lambda3ofx) is evaluated directly at the line
+   positions for every problem and every perturbed parameter set.
+ - Lines are matched to the standard line list through a LineIndex (see
+   thar_lines.py), which leaves out the lines flagged in badlams.txt.
+ - The "big four" parameters {sinalp, fl, y0, z0} are fit by damped
+   Gauss-Newton (Levenberg-Marquardt) iterations, with the normal
+   equations of all problems solved in one call.  As in thar_setup.pro,
+   z0 is tied to fl, and parameters with no allowed range in
+   spectrographs.csv are held fixed.  Lines with unusually large
+   normalized residuals are then clipped and the fit is done again, as in
+   thar_fitall.pro.
+ - The 15 restricted-cubic (Legendre) correction coefficients are fit by
+   robust weighted least squares, as in thar_rcubic.pro, again for all
+   problems at once.
+
+Problems are independent, so a long list of them may also be split
+between processes (NRES_THAR_PROCESSES, default 1).
+'''
+import multiprocessing
+import os
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+radian = 180. / np.pi
+processes = int(os.getenv('NRES_THAR_PROCESSES', 1))
+
+# One spectrum to be fit: the fiber index (0, 1 or 2) and, for each catalog line, its
+# order index, x-position (pix), amplitude and width (pix)
+ThArLines = namedtuple('ThArLines', ['fibno', 'iord', 'xpos', 'amp', 'wid'])
+
+dwu = 0.1           # (nm) unmatched lines get their difference against model set to this
+dwmatch = 0.05      # (nm) match lines whose model and list wavelengths differ by less than this
+minmatch = 20       # must match at least this many lines to run the rcubic fit
+ncoefs = 15
+tied_z0 = 0.00015751     # z0 perturbation is tied to this times the fl perturbation
+
+# (x, order) degrees of the Legendre polynomials multiplying each rcubic coefficient
+rcubic_terms = [(0, 0), (0, 1), (0, 2), (0, 3), (1, 0), (1, 1), (1, 2), (2, 0), (2, 1), (3, 0), (0, 4), (1, 3),
+                (2, 2), (3, 1), (4, 0)]
+# (x, order) powers of the polynomial in fibcoefs giving the shift of fibers 0 and 2 from fiber 1
+fibcoef_terms = [(0, 0), (0, 1), (1, 0), (1, 1), (0, 2), (1, 2), (2, 0), (2, 1), (3, 0), (0, 3)]
+
+glass_a = {'BK7': [2.2697665, -9.6395197e-3, 1.1025458e-2, 7.9465126e-5, 1.0120957e-5, -4.4096694e-7],
+           'SF2': [2.6360314, -8.9450876e-3, 2.5228056e-2, 1.1120943e-3, -3.7887387e-5, 6.3760973e-6]}
+glass_bc = {'SiO2': ([0.67071081, 0.433322857, 0.877379057], [0.00449192312, 0.0132812976, 95.8899878]),
+            'LLF1': ([1.21640125, 1.33664540e-1, 8.83399468e-1], [8.57807248e-3, 4.20143003e-2, 1.07593060e+2]),
+            'PBM2': ([1.39446503, 1.59230985e-1, 2.45470216e-1], [1.10571872e-2, 5.07194882e-2, 3.14440142e1]),
+            'LF5': ([1.28035628, 1.6350597e-1, 8.93930112e-1], [9.29854416e-3, 4.49135769e-2, 1.10493685e2])}
+
+
+def glass_index(gltype, lam):
+    '''
+    Refractive index of glass type gltype (one of BK7, SF2, SiO2, LLF1, PBM2,
+    LF5) at wavelengths lam (micron), as in glass_index.pro.
+    '''
+    gltype = gltype.strip()
+    lam2 = np.asarray(lam, dtype=float) ** 2
+    if gltype in glass_a:
+        a = glass_a[gltype]
+        return np.sqrt(a[0] + a[1] * lam2 + a[2] / lam2 + a[3] / lam2 ** 2 + a[4] / lam2 ** 3 + a[5] / lam2 ** 4)
+    if gltype in glass_bc:
+        b, c = glass_bc[gltype]
+        return np.sqrt(1. + sum(b[i] * lam2 / (lam2 - c[i]) for i in range(3)))
+    raise ValueError('illegal glass type {gltype}'.format(gltype=gltype))
+
+
+def mylegendre(x):
+    '''
+    Legendre polynomials of degree 0-4 at x, without the |x| <= 1
+    restriction, as a list.
+    '''
+    x2 = x * x
+    return [np.ones_like(x), x, (3. * x2 - 1.) / 2., (5. * x2 - 3.) * x / 2., ((35. * x2 - 30.) * x2 + 3.) / 8.]
+
+
+def rcubic_funs(xpix, iord, nx, nord):
+    '''
+    The 15 restricted-cubic functions of x-position and order index, as in
+    thar_rcubic.pro.  Returns an array with a last axis of length 15.
+    '''
+    lx = 2. * (xpix - nx / 2.) / nx
+    lord = 2. * (iord - nord / 2.) / nord
+    lxs = mylegendre(lx)
+    los = mylegendre(lord)
+    return np.stack([lxs[i] * los[j] for i, j in rcubic_terms], axis=-1)
+
+
+def lambda3ofx(xpix, iord, fibno, specdat, sinalp, fl, y0, z0, coefs):
+    '''
+    This routine computes vacuum wavelength lam (nm) at x-positions xpix
+    (pixels) in order indexes iord, for fiber fibno, as lambda3ofx.pro does.
+    specdat supplies the fixed properties of the spectrograph (grspc,
+    gltype, apex, lamcen, rot, pixsiz, nx, nord, ord0, fibcoefs).  The
+    parameters fibno, sinalp, fl, y0, z0 and coefs(...,15) may be arrays,
+    and are broadcast against xpix and iord, so that many spectra and
+    parameter sets are evaluated in one call.
+
+    Rather than computing lam on a pixel grid and interpolating to get the
+    wavelengths of fibers 0 and 2, the model is evaluated directly at the
+    shifted positions.  Returns lam and the y-position (mm) of the center
+    of each order y0m.
+    '''
+    nx = specdat.nx
+    nord = specdat.nord
+    jx = np.asarray(xpix, dtype=float) - nx / 2.
+    jord = np.asarray(iord, dtype=float) - nord / 2.
+    fibno = np.asarray(fibno)
+    coefs = np.asarray(coefs, dtype=float)
+
+    # fibers 0 and 2 see the fiber 1 wavelengths shifted by dx pixels
+    shifted = fibno != 1
+    if shifted.any():
+        fibcoefs = np.asarray(specdat.fibcoefs)[np.where(shifted, fibno // 2, 0)]
+        dx = sum(fibcoefs[..., k] * jx ** i * jord ** j for k, (i, j) in enumerate(fibcoef_terms))
+        jx = jx - np.where(shifted, dx, 0.)
+
+    # prism deflection gives the y-position of each order
+    mm = specdat.ord0 + np.asarray(iord)
+    nnmid = glass_index(specdat.gltype, specdat.lamcen)
+    delta = np.arcsin(nnmid * np.sin(specdat.apex / (2. * radian))) - specdat.apex / (2. * radian)
+    lamc = specdat.grspc * 2. * sinalp / mm          # central wavelength for each order (micron)
+    y0m = 4. * fl * delta * (glass_index(specdat.gltype, lamc) - nnmid)
+    cosgam = np.cos(np.arcsin((y0m - y0) / fl))
+
+    # diffraction equation, in the rotated detector frame
+    xo = specdat.pixsiz * jx + y0m * np.sin(specdat.rot / radian)
+    bet = -np.arcsin(sinalp) - np.arctan(xo / fl)
+    lam = (specdat.grspc / mm) * (sinalp - np.sin(bet)) * cosgam
+    lam = lam / (1. + z0) * 1.e3
+
+    # add the restricted cubic correction
+    if np.any(coefs != 0.):
+        lxs = mylegendre(2. * jx / nx)
+        los = mylegendre(2. * jord / nord)
+        for k, (i, j) in enumerate(rcubic_terms):
+            lam = lam + coefs[..., k] * lxs[i] * los[j]
+    return lam, y0m
+
+
+def quartile(values, good):
+    '''
+    Median and interquartile range of values over the entries in good,
+    along the last axis.  nan where there are no good entries.
+    '''
+    values = np.where(good, values, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q25, med, q75 = np.nanpercentile(values, [25., 50., 75.], axis=-1)
+    return med, q75 - q25
+
+
+def _pad(problems, field, fill):
+    nline = max([len(getattr(problem, field)) for problem in problems] + [1])
+    padded = np.full((len(problems), nline), fill, dtype=float)
+    for k, problem in enumerate(problems):
+        padded[k, :len(getattr(problem, field))] = getattr(problem, field)
+    return padded
+
+
+class _Model(object):
+    '''
+    The lines of all problems, and the model wavelengths of those lines for
+    perturbations of the big four parameters.
+    '''
+
+    def __init__(self, problems, specdat, index, coefs, oskip):
+        self.specdat = specdat
+        self.index = index
+        self.fibno = np.array([problem.fibno for problem in problems])
+        self.iord = _pad(problems, 'iord', 0.).astype(int)
+        self.xpos = _pad(problems, 'xpos', specdat.nx / 2.)
+        self.amp = _pad(problems, 'amp', 1.)
+        self.wid = _pad(problems, 'wid', 0.)
+        self.valid = np.zeros(self.xpos.shape, dtype=bool)
+        for k, problem in enumerate(problems):
+            self.valid[k, :len(problem.xpos)] = True
+        if oskip is not None:
+            self.valid &= self.iord != oskip
+        self.coefs = coefs
+        self.base = np.array([specdat.sinalp, specdat.fl, specdat.y0, specdat.z0])
+
+        # leave out lines in the detector boxes flagged in badlams.txt, placed using the starting model
+        x = np.arange(specdat.nx, dtype=float)[:, np.newaxis]
+        lam1 = lambda3ofx(x, np.arange(specdat.nord)[np.newaxis, :], 1, specdat, specdat.sinalp, specdat.fl,
+                          specdat.y0, specdat.z0, specdat.coefs)[0]
+        self.valid &= ~index.xbad(lam1, self.iord, self.xpos)
+
+        # line position errors (nm), from the starting model, as in thar_setup
+        lam0 = self.lam(np.zeros((len(problems), 4)))
+        lam1 = self.lam(np.zeros((len(problems), 4)), dx=1.)
+        self.dldx = lam1 - lam0
+        self.xperr = np.where(self.valid, np.abs(self.dldx) * self.wid / np.sqrt(np.maximum(self.amp, 10.)), 1.)
+        self.xperr = np.where(self.xperr > 0., self.xperr, 1.)
+        self.clip = self.valid.astype(float)
+
+    def lam(self, parms, dx=0.):
+        '''
+        Model wavelengths of the lines for perturbations parms(...,nprob,4).
+        '''
+        parms = self.base + parms
+        return lambda3ofx(self.xpos + dx, self.iord, self.fibno[:, np.newaxis], self.specdat,
+                          parms[..., 0, np.newaxis], parms[..., 1, np.newaxis], parms[..., 2, np.newaxis],
+                          parms[..., 3, np.newaxis], self.coefs[:, np.newaxis, :])[0]
+
+    def residuals(self, lam):
+        '''
+        The normalized residual of every line (as returned by thar_mpfit.pro),
+        the model - list wavelength differences and the matched lines.
+        '''
+        nearest, diff, matched = self.index.match(lam, self.fibno[:, np.newaxis], dwmatch)
+        matched &= self.valid
+        diff = np.where(matched, diff, dwu)
+        return np.where(self.valid, self.clip * diff / self.xperr, 0.), diff, matched, nearest
+
+
+def _tie(parms):
+    parms = np.array(parms)
+    parms[..., 3] = parms[..., 1] * tied_z0
+    return parms
+
+
+def fit_parms(model, free, max_iter=50, ftol=1.e-6):
+    '''
+    Fit perturbations of the big four parameters for all problems by
+    Levenberg-Marquardt iterations, re-matching the lines at every step.
+    free(3) flags which of sinalp, fl and y0 may vary (z0 follows fl).
+    Returns the perturbations, whether each problem converged, whether it
+    failed (the damping ran away without the cost settling, so the result
+    should not be trusted) and the number of iterations each took.
+    '''
+    nprob = model.xpos.shape[0]
+    nfree = 3
+    # finite-difference steps for sinalp, fl, y0
+    steps = np.array([1.e-7, 1.e-4, 1.e-4])
+    parms = np.zeros((nprob, 4))
+    damping = np.full(nprob, 1.e-3)
+    active = np.ones(nprob, dtype=bool)
+    converged = np.zeros(nprob, dtype=bool)
+    diverged = np.zeros(nprob, dtype=bool)
+    niter = np.zeros(nprob, dtype=int)
+    resid, diff, matched, nearest = model.residuals(model.lam(parms))
+    cost = (resid ** 2).sum(axis=1)
+    for iteration in range(max_iter):
+        if not active.any():
+            break
+        # derivatives of the model wavelengths, holding the matches fixed
+        trial = np.repeat(parms[np.newaxis], nfree + 1, axis=0)
+        for j in range(nfree):
+            trial[j + 1, :, j] += steps[j]
+        lams = model.lam(_tie(trial))
+        jac = (lams[1:] - lams[0]) / steps[:, np.newaxis, np.newaxis]
+        jac = np.where(matched, jac * model.clip / model.xperr, 0.)
+        jac = jac * free[:, np.newaxis, np.newaxis]
+        jac = np.moveaxis(jac, 0, -1)                                     # (nprob,nline,nfree)
+        alpha = np.einsum('pli,plj->pij', jac, jac)
+        beta = -np.einsum('pli,pl->pi', jac, resid)
+        diag = np.einsum('pii->pi', alpha)
+        # fixed parameters, or ones no line constrains, are left alone
+        held = diag <= 0.
+        alpha = alpha + np.eye(nfree) * np.where(held, 1., damping[:, np.newaxis] * diag)[:, :, np.newaxis]
+        delta = np.linalg.solve(alpha, beta[..., np.newaxis])[..., 0]
+        delta = np.where(held, 0., delta)
+
+        new_parms = parms.copy()
+        new_parms[:, :nfree] += np.where(active[:, np.newaxis], delta, 0.)
+        new_parms = _tie(new_parms)
+        new_resid, new_diff, new_matched, new_nearest = model.residuals(model.lam(new_parms))
+        new_cost = (new_resid ** 2).sum(axis=1)
+
+        better = active & (new_cost <= cost)
+        niter += active
+        small = better & (cost - new_cost <= ftol * np.maximum(cost, 1.e-30))
+        parms = np.where(better[:, np.newaxis], new_parms, parms)
+        resid = np.where(better[:, np.newaxis], new_resid, resid)
+        diff = np.where(better[:, np.newaxis], new_diff, diff)
+        matched = np.where(better[:, np.newaxis], new_matched, matched)
+        nearest = np.where(better[:, np.newaxis], new_nearest, nearest)
+        cost = np.where(better, new_cost, cost)
+        damping = np.where(better, damping / 10., damping * 10.)
+        converged |= small
+        diverged |= active & ~small & (damping > 1.e10)
+        active &= ~(converged | diverged)
+    return parms, converged, diverged, niter, diff, matched, nearest
+
+
+def _clip_outliers(model, diff):
+    '''
+    Give zero weight to lines with unusually large normalized residuals, as
+    thar_fitall.pro does.  Returns True for problems where lines were clipped.
+    '''
+    small = model.valid & (np.abs(diff) <= 0.8 * dwu)
+    normdif = diff / model.xperr
+    med, dq = quartile(normdif, small)
+    sigq = dq / 1.349
+    enough = small.sum(axis=1) > 10
+    with np.errstate(invalid='ignore'):
+        bad = small & (np.abs(normdif) > 4. * sigq[:, np.newaxis]) & enough[:, np.newaxis]
+    model.clip = np.where(bad, 0., model.clip)
+    return bad.any(axis=1)
+
+
+def _weighted_lstsq(dat, funs, wts):
+    '''
+    Weighted linear least squares for each problem, as lstsqr.pro does
+    (wts are 1/sigma).  Returns the coefficients and the residuals
+    dat - fit.
+    '''
+    funw = funs * wts[..., np.newaxis]
+    alpha = np.einsum('pli,plj->pij', funw, funw)
+    beta = np.einsum('pli,pl->pi', funw, dat * wts)
+    coefs = np.einsum('pij,pj->pi', np.linalg.pinv(alpha, hermitian=True), beta)
+    return coefs, dat - np.einsum('pli,pi->pl', funs, coefs)
+
+
+def fit_rcubic(model, matchdif, matched, cubfrz=False):
+    '''
+    Robust weighted fit of the restricted cubic to the wavelength residuals
+    of the matched lines, for all problems, as thar_rcubic.pro does.
+    Updates model.coefs unless cubfrz is set.  Returns the rms of the
+    residuals of the lines that were used.
+    '''
+    thr1 = 0.02             # threshold dif for retaining data (nm)
+    thrshm = 3.             # threshold dif for retaining data, median-sigma
+    tiny = 1.e-10
+    nmatch = matched.sum(axis=1)
+    usable = nmatch > ncoefs
+    dlam2 = (np.where(matched, matchdif, 0.) ** 2).sum(axis=1) / np.maximum(nmatch, 1)
+    dlam2 = np.where(dlam2 > 0., dlam2, 1.)
+
+    funs = rcubic_funs(model.xpos, model.iord, model.specdat.nx, model.specdat.nord)
+    wts0 = 1. / (1. + matchdif ** 2 / dlam2[:, np.newaxis])
+    thrsh = np.minimum(3. * np.sqrt(dlam2), thr1)
+    wts0 = np.where(np.abs(matchdif) > thrsh[:, np.newaxis], tiny, wts0)
+    wts0 = np.where(matched, wts0, 0.)
+    coefs0, outp0 = _weighted_lstsq(matchdif, funs, wts0)
+
+    sg = matched & (wts0 >= 1.5 * tiny)
+    med0, dq = quartile(outp0, sg)
+    rmsm = dq / 1.35
+    rmsm = np.where(rmsm > 0., rmsm, 1.)
+    dif = outp0 - med0[:, np.newaxis]
+    wts = 1. / (1. + dif ** 2 / rmsm[:, np.newaxis] ** 2)
+    thrsh = np.minimum(thrshm * rmsm, 0.01)
+    wts = np.where(np.abs(dif) >= thrsh[:, np.newaxis], tiny, wts)
+    wts = np.where((sg.sum(axis=1) > 4)[:, np.newaxis], wts, 1.)
+    wts = np.where(matched, wts, 0.)
+    incr, outp = _weighted_lstsq(matchdif, funs, wts)
+
+    sg = matched & (wts >= 1.5 * tiny)
+    rms = np.sqrt((np.where(sg, outp, 0.) ** 2).sum(axis=1) / np.maximum(sg.sum(axis=1), 1))
+    rms = np.where(usable, rms, 0.)
+    if not cubfrz:
+        model.coefs = np.where(usable[:, np.newaxis], model.coefs - incr, model.coefs)
+    return rms
+
+
+def _fit(problems, specdat, index, cubfrz, oskip, max_iter):
+    nprob = len(problems)
+    coefs = np.repeat(np.asarray(specdat.coefs, dtype=float)[np.newaxis], nprob, axis=0)
+    model = _Model(problems, specdat, index, coefs, oskip)
+
+    # parameters are fixed if their allowed range in spectrographs.csv is zero
+    dsinalp = abs(np.sin((specdat.grinc + specdat.dgrinc) / radian) - specdat.sinalp)
+    free = np.array([dsinalp != 0., specdat.dfl != 0., specdat.dy0 != 0.], dtype=float)
+
+    parms, converged, diverged, niter, diff, matched, nearest = fit_parms(model, free, max_iter)
+    if _clip_outliers(model, diff).any():
+        # redo the fit with the bad lines clipped, starting from scratch as thar_fitall does
+        parms, converged, diverged, niter, diff, matched, nearest = fit_parms(model, free, max_iter)
+
+    nmatch = matched.sum(axis=1)
+    dlam2 = (np.where(matched, diff, 0.) ** 2).sum(axis=1) / np.maximum(nmatch, 1)
+    rms = np.zeros(nprob)
+    do_rcubic = nmatch >= minmatch
+    if do_rcubic.any():
+        rms = np.where(do_rcubic, fit_rcubic(model, diff, matched & do_rcubic[:, np.newaxis], cubfrz), 0.)
+
+    # final wavelength solutions on the pixel grid
+    parms = model.base + parms
+    x = np.arange(specdat.nx, dtype=float)[:, np.newaxis]
+    iord = np.arange(specdat.nord)[np.newaxis, :]
+    lam = np.empty((nprob, specdat.nx, specdat.nord))
+    for k in range(nprob):
+        lam[k] = lambda3ofx(x, iord, model.fibno[k], specdat, parms[k, 0], parms[k, 1], parms[k, 2],
+                            parms[k, 3], model.coefs[k])[0]
+
+    # wavelength span across the Mg b order, minus a nominal value
+    if specdat.site.strip().upper() == 'SQA':
+        mgbord, dlamnom = 20, 8.
+    else:
+        mgbord, dlamnom = 38, 10.5777
+    mgbdisp = np.where(do_rcubic, lam[:, -1, mgbord] - lam[:, 0, mgbord] - dlamnom, 0.)
+    lammid = np.where(do_rcubic, lam[:, min(2000, specdat.nx - 1), mgbord - 5:mgbord + 6].mean(axis=1), 0.)
+
+    return {'fibno': model.fibno, 'lam': lam, 'sinalp': parms[:, 0], 'fl': parms[:, 1], 'y0': parms[:, 2],
+            'z0': parms[:, 3], 'grinc': radian * np.arcsin(parms[:, 0]), 'coefs': model.coefs, 'nmatch': nmatch,
+            'amoerr': np.sqrt(dlam2), 'rmsgood': rms, 'mgbdisp': mgbdisp, 'lammid': lammid,
+            'converged': converged, 'diverged': diverged, 'niter': niter}
+
+
+def fit_all(problems, specdat, index, cubfrz=False, oskip=None, max_iter=50, nprocesses=None):
+    '''
+    Fit wavelength solutions to a list of ThAr spectra (ThArLines records),
+    starting from the spectrograph configuration specdat (a SpecDat from
+    spectrographs.py) and matching against the standard line list in
+    index (a LineIndex from thar_lines.get_index).
+
+    If cubfrz is set, the rcubic coefficients are not changed.  If oskip is
+    given, lines in order index oskip are left out of the fit.
+
+    Returns a dictionary of arrays with one entry per problem, like the
+    tharred structure made by thar_wavelen.pro: lam(nprob,nx,nord), sinalp,
+    fl, y0, z0, grinc, coefs(nprob,15), nmatch, amoerr, rmsgood, mgbdisp
+    and lammid, plus converged, diverged and niter from the fit of the big
+    four parameters.  Problems flagged diverged did not reach a solution
+    and should be rejected.
+    '''
+    nprocesses = processes if nprocesses is None else nprocesses
+    nprocesses = min(nprocesses, len(problems))
+    if nprocesses <= 1 or multiprocessing.current_process().daemon:
+        return _fit(problems, specdat, index, cubfrz, oskip, max_iter)
+    chunks = np.array_split(np.arange(len(problems)), nprocesses)
+    with ProcessPoolExecutor(max_workers=nprocesses) as executor:
+        futures = [executor.submit(_fit, [problems[k] for k in chunk], specdat, index, cubfrz, oskip, max_iter)
+                   for chunk in chunks]
+        results = [future.result() for future in futures]
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
@@ -0,0 +1,172 @@
+'''
+Matching of observed ThAr lines to a standard line list (normally
+arc_ThAr_Redman.txt), replacing the searches of matchline.pro and
+thar_catalog.pro.
+
+A LineIndex is built once per line list: the list wavelengths are sorted,
+and the lines to leave out for each fiber, from badlams.txt (see
+mk_badlamwts.pro), are found once and removed from a sorted copy of the
+list kept for that fiber.  Matching a set of model wavelengths is then a
+bisection (searchsorted) into the fiber's list: the lines within the
+window lam +/- tol bracket each model wavelength, and the nearest of them
+is the match.  This is O(n log m) for n model wavelengths and m list
+lines, and is done for all lines of all spectra in one call.
+
+badlams.txt entries are of two types:
+  'w'  a wavelength range lam_cen +/- halfwidth (nm), bad in the star
+       fibers 0 and 2 (e.g. atmospheric absorption).  List lines in the
+       range are left out for those fibers.
+  'x'  a box of +/- halfwidth pixels and +/- halfheight orders around the
+       pixel where fiber 1 sees lam_cen (e.g. bloomed Ar lines), bad in all
+       fibers.  These are fixed on the detector, so observed lines in the
+       boxes are flagged (see LineIndex.xbad) rather than list lines.
+'''
+import os
+import os.path
+from collections import namedtuple
+import numpy as np
+
+# One entry of badlams.txt
+BadLam = namedtuple('BadLam', ['etype', 'elam', 'ehwid', 'ehht'])
+
+
+def read_linelist(filename, lammin=370., lammax=870.):
+    '''
+    Read a ThAr standard line list (two header lines, then wavelength (nm)
+    and brightness on each line) and return the wavelengths and
+    brightnesses of the lines between lammin and lammax, sorted by
+    wavelength.
+    '''
+    table = np.loadtxt(filename, skiprows=2, usecols=(0, 1), ndmin=2)
+    table = table[(table[:, 0] >= lammin) & (table[:, 0] <= lammax)]
+    table = table[np.argsort(table[:, 0], kind='stable')]
+    return table[:, 0], table[:, 1]
+
+
+def read_badlams(filename):
+    '''
+    Read badlams.txt (two header lines, then type, lam_cen (nm), halfwidth
+    and optionally halfheight on each line), as rd_badlams.pro does.
+    '''
+    entries = []
+    with open(filename) as infile:
+        lines = infile.readlines()[2:]
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        if len(words) < 3:
+            raise ValueError('Bad input line in {filename}: {line}'.format(filename=filename, line=line))
+        ehht = int(float(words[3])) if len(words) >= 4 else 0
+        entries.append(BadLam(words[0], float(words[1]), float(words[2]), ehht))
+    return entries
+
+
+def _read_only(array):
+    array = np.array(array)
+    array.flags.writeable = False
+    return array
+
+
+class LineIndex(object):
+    '''
+    A sorted standard line list with the bad lines for each fiber removed.
+
+    Usage:
+    index = get_index(linelist_file, badlams_file)
+    nearest, diff, matched = index.match(lam, fibno)
+    '''
+
+    def __init__(self, linelist_file, badlams_file=None, lammin=370., lammax=870.):
+        linelam, lineamp = read_linelist(linelist_file, lammin, lammax)
+        self.linelam = _read_only(linelam)
+        self.lineamp = _read_only(lineamp)
+        badlams = read_badlams(badlams_file) if badlams_file is not None else []
+
+        # 'w' ranges leave lines out for fibers 0 and 2
+        wbad = np.zeros(len(linelam), dtype=bool)
+        for entry in badlams:
+            if entry.etype == 'w':
+                lo = np.searchsorted(linelam, entry.elam - entry.ehwid, side='left')
+                hi = np.searchsorted(linelam, entry.elam + entry.ehwid, side='right')
+                wbad[lo:hi] = True
+        self.bad = {0: _read_only(wbad), 1: _read_only(np.zeros(len(linelam), dtype=bool)), 2: _read_only(wbad)}
+        # for each fiber, the indexes into linelam of the lines that are kept, and their wavelengths
+        self.kept = {fibno: _read_only(np.flatnonzero(~bad)) for fibno, bad in self.bad.items()}
+        self.keptlam = {fibno: _read_only(linelam[kept]) for fibno, kept in self.kept.items()}
+
+        xentries = [entry for entry in badlams if entry.etype == 'x']
+        self.xlam = _read_only([entry.elam for entry in xentries])
+        self.xhwid = _read_only([entry.ehwid for entry in xentries])
+        self.xhht = _read_only([entry.ehht for entry in xentries])
+
+    def window(self, lam, fibno, tol):
+        '''
+        The range [lo, hi) of indexes into the kept lines of fiber fibno
+        that lie within lam +/- tol.
+        '''
+        keptlam = self.keptlam[fibno]
+        return (np.searchsorted(keptlam, lam - tol, side='left'),
+                np.searchsorted(keptlam, lam + tol, side='right'))
+
+    def _match(self, lam, fibno, tol):
+        keptlam = self.keptlam[fibno]
+        lo, hi = self.window(lam, fibno, tol)
+        # the nearest kept line is one of the two either side of lam, which bracket the window
+        right = np.clip(np.searchsorted(keptlam, lam), 1, len(keptlam) - 1)
+        left = right - 1
+        nearest = np.where(np.abs(lam - keptlam[left]) <= np.abs(keptlam[right] - lam), left, right)
+        return self.kept[fibno][nearest], lam - keptlam[nearest], hi > lo
+
+    def match(self, lam, fibno, tol):
+        '''
+        Match model wavelengths lam to the nearest line kept for fiber fibno
+        (an int, or an array broadcastable against lam).  Returns the index
+        into linelam of the nearest line, the difference lam - linelam of
+        that line, and a mask of the model wavelengths that have a line
+        within tol.
+        '''
+        lam = np.asarray(lam, dtype=float)
+        fibno = np.broadcast_to(fibno, lam.shape)
+        nearest = np.zeros(lam.shape, dtype=int)
+        diff = np.zeros(lam.shape)
+        matched = np.zeros(lam.shape, dtype=bool)
+        for fib in np.unique(fibno):
+            these = fibno == fib
+            nearest[these], diff[these], matched[these] = self._match(lam[these], int(fib), tol)
+        return nearest, diff, matched
+
+    def xbad(self, lam1, iord, xpos):
+        '''
+        Flag observed lines at order indexes iord and x-positions xpos that
+        fall in the 'x' boxes of badlams.txt.  lam1(nx,nord) is the fiber 1
+        wavelength solution used to find where each box is centered.
+        '''
+        iord = np.asarray(iord)
+        xpos = np.asarray(xpos, dtype=float)
+        bad = np.zeros(np.broadcast(iord, xpos).shape, dtype=bool)
+        nx, nord = lam1.shape
+        for elam, ehwid, ehht in zip(self.xlam, self.xhwid, self.xhht):
+            ix, jord = np.unravel_index(np.argmin(np.abs(lam1 - elam)), lam1.shape)
+            xmin = max(ix - ehwid, 0)
+            xmax = min(ix + ehwid, nx - 1)
+            omin = max(jord - ehht, 0)
+            omax = min(jord + ehht, nord - 1)
+            bad |= (xpos >= xmin) & (xpos <= xmax) & (iord >= omin) & (iord <= omax)
+        return bad
+
+
+indexes = {}
+
+
+def get_index(linelist_file, badlams_file=None):
+    '''
+    Return the LineIndex for a line list and badlams file, building it
+    once per process and again only if either file changes.
+    '''
+    files = [os.path.abspath(filename) for filename in (linelist_file, badlams_file) if filename is not None]
+    version = tuple((os.stat(filename).st_size, os.stat(filename).st_mtime_ns) for filename in files)
+    key = (tuple(files), os.getpid())
+    if key not in indexes or indexes[key][0] != version:
+        indexes[key] = (version, LineIndex(linelist_file, badlams_file))
+    return indexes[key][1]